@@ -0,0 +1,146 @@
+"""
+Compares the regex BGP neighbor extractors against the genie parsers.
+
+Run against captured device output with --xr-file / --nxos-file, or without them against generated output:
+
+    python benchmarks/bench_bgp_neighbors.py --peers 500 --vrfs 20
+"""
+import logging
+import os
+import sys
+import time
+from typing import Callable, Text
+
+import configargparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bgp_neighbors import OS_NEIGHBOR_EXTRACTOR  # noqa: E402
+from collection_helper import parse_genie  # noqa: E402
+
+
+def generate_xr_neighbors(peers: int, vrfs: int) -> Text:
+    """
+    IOS-XR "show bgp vrf all neighbors" style output with peers neighbors spread over vrfs VRFs
+    """
+    lines = []
+    for i in range(peers):
+        vrf = "default" if vrfs == 0 else f"VRF{i % vrfs}"
+        neighbor = f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+        lines.append(f"BGP neighbor is {neighbor}" + ("" if vrf == "default" else f", vrf {vrf}"))
+        lines.extend([
+            f" Remote AS {65000 + i}, local AS 65000, external link",
+            f" Remote router ID {neighbor}",
+            "  BGP state = Established, up for 1w2d",
+            "  Last read 00:00:04, Last read before reset 00:00:00",
+            "  Hold time is 180, keepalive interval is 60 seconds",
+            "  Configured hold time: 180, keepalive: 60, min acceptable hold time: 3",
+            "  Last write 00:00:04, attempted 19, written 19",
+            "  Received 12345 messages, 0 notifications, 0 in queue",
+            "  Sent 12345 messages, 0 notifications, 0 in queue",
+            "  Minimum time between advertisement runs is 0 secs",
+            "",
+            " For Address Family: IPv4 Unicast",
+            "  BGP neighbor version 1234",
+            "  Update group: 0.2 Filter-group: 0.1  No Refresh request being processed",
+            "  Route refresh request: received 0, sent 0",
+            "  100 accepted prefixes, 100 are bestpaths",
+            "  Cumulative no. of prefixes denied: 0.",
+            "  Prefix advertised 100, suppressed 0, withdrawn 0",
+            "  Maximum prefixes allowed 1048576",
+            "  Threshold for warning message 75%, restart interval 0 min",
+            "  An EoR was received during read-only mode",
+            "  Last ack version 1234, Last synced ack version 0",
+            "  Outstanding version objects: current 0, max 1",
+            "  Additional-paths operation: None",
+            "",
+            "  Connections established 1; dropped 0",
+            "  Local host: 10.255.255.1, Local port: 179, IF Handle: 0x00000000",
+            f"  Foreign host: {neighbor}, Foreign port: 51234",
+            "  Last reset 00:00:00",
+            "",
+        ])
+    return "\n".join(lines)
+
+
+def generate_nxos_summary(peers: int, vrfs: int) -> Text:
+    """
+    NX-OS "show bgp vrf all all summary" style output with peers neighbors spread over vrfs VRFs
+    """
+    vrf_names = ["default"] + [f"VRF{i}" for i in range(vrfs)]
+    lines = []
+    for vrf_index, vrf in enumerate(vrf_names):
+        lines.extend([
+            f"BGP summary information for VRF {vrf}, address family IPv4 Unicast",
+            "BGP router identifier 10.255.255.1, local AS number 65000",
+            "BGP table version is 1234, IPv4 Unicast config peers 10, capable peers 10",
+            "100 network entries and 100 paths using 12345 bytes of memory",
+            "",
+            "Neighbor        V    AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd",
+        ])
+        for i in range(vrf_index, peers, len(vrf_names)):
+            neighbor = f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+            lines.append(f"{neighbor:<15} 4 {65000 + i:>5}   12345   12345     1234    0    0     1w2d 100")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def time_call(func: Callable, repeat: int):
+    start = time.perf_counter()
+    result = None
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def neighbor_set(neighbors) -> set:
+    return {(vrf, neighbor) for vrf, vrf_neighbors in (neighbors or {}).items() for neighbor in vrf_neighbors}
+
+
+def bench(device_os: Text, cmd: Text, output: Text, repeat: int, logger) -> None:
+    extractor, genie_converter = OS_NEIGHBOR_EXTRACTOR[device_os]
+    print(f"### {device_os}: {cmd}, {len(output)} bytes")
+
+    extract_time, extracted = time_call(lambda: extractor(output), repeat)
+    print(f"regex extractor: {extract_time * 1000:.2f} ms, {len(neighbor_set(extracted))} neighbors")
+
+    genie_time, parsed = time_call(lambda: parse_genie("bench", output, cmd, device_os, logger), repeat)
+    if parsed is None:
+        print(f"genie parser: {genie_time * 1000:.2f} ms, failed to parse")
+        return
+    genie_neighbors = genie_converter(parsed)
+    print(f"genie parser: {genie_time * 1000:.2f} ms, {len(neighbor_set(genie_neighbors))} neighbors")
+    print(f"speedup: {genie_time / extract_time:.1f}x")
+
+    if neighbor_set(extracted) != neighbor_set(genie_neighbors):
+        print(f"MISMATCH: only in regex extractor {neighbor_set(extracted) - neighbor_set(genie_neighbors)}, "
+              f"only in genie {neighbor_set(genie_neighbors) - neighbor_set(extracted)}")
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--xr-file", help="Captured output of IOS-XR 'show bgp vrf all neighbors'", default=None)
+    parser.add_argument("--nxos-file", help="Captured output of NX-OS 'show bgp vrf all all summary'", default=None)
+    parser.add_argument("--peers", help="Number of peers in generated output", type=int, default=500)
+    parser.add_argument("--vrfs", help="Number of VRFs in generated output", type=int, default=20)
+    parser.add_argument("--repeat", help="Number of times to run each parser", type=int, default=3)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    bench_logger = logging.getLogger("bench_bgp_neighbors")
+
+    if args.xr_file is not None:
+        with open(args.xr_file) as f:
+            xr_output = f.read()
+    else:
+        xr_output = generate_xr_neighbors(args.peers, args.vrfs)
+
+    if args.nxos_file is not None:
+        with open(args.nxos_file) as f:
+            nxos_output = f.read()
+    else:
+        nxos_output = generate_nxos_summary(args.peers, args.vrfs)
+
+    bench("iosxr", "show bgp vrf all neighbors", xr_output, args.repeat, bench_logger)
+    bench("nxos", "show bgp vrf all all summary", nxos_output, args.repeat, bench_logger)
@@ -0,0 +1,171 @@
+"""
+Measures collection throughput against the simulated devices of ssh_farm.py as the number of concurrent sessions
+changes.
+
+Every collector run is a separate process, so its peak RSS is measured on its own:
+
+    python benchmarks/bench_collection.py --devices 200 --concurrency 10,30,60 --latency 0.2 --drop-rate 0.01
+
+Arguments the farm understands, like --latency or --stall-rate, are passed on to it.
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Text
+
+import configargparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(SCRIPT_DIR)
+
+COLLECTOR_SCRIPTS = {
+    "config": "config_collector.py",
+    "show": "show_data_collector.py",
+}
+FARM_START_TIMEOUT = 120  # seconds to wait for the farm to write its inventory
+
+
+def start_farm(devices: int, inventory_file: Text, farm_args: List[Text]) -> subprocess.Popen:
+    farm = subprocess.Popen([sys.executable, f"{SCRIPT_DIR}/ssh_farm.py", "--devices", str(devices),
+                             "--inventory", inventory_file] + farm_args)
+    deadline = time.time() + FARM_START_TIMEOUT
+    while not os.path.exists(inventory_file):
+        if farm.poll() is not None:
+            raise Exception(f"SSH farm exited with {farm.returncode}")
+        if time.time() > deadline:
+            farm.terminate()
+            raise Exception(f"SSH farm did not start in {FARM_START_TIMEOUT} seconds")
+        time.sleep(0.5)
+    return farm
+
+
+def device_times(spans_file: Text) -> List[float]:
+    """
+    Per device collection times from the device spans written by --timing-export
+    """
+    times = []
+    if not os.path.exists(spans_file):
+        return times
+    with open(spans_file) as f:
+        for line in f:
+            span = json.loads(line)
+            if span["span"] == "device":
+                times.append(span["seconds"])
+    return times
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def run_collector(collector: Text, inventory_file: Text, work_dir: Text, concurrency: int, username: Text,
+                  password: Text, extra_args: List[Text]) -> Dict:
+    """
+    Runs one collector against the farm and returns its throughput, per device times and peak RSS
+    """
+    snapshot_name = f"bench_{collector}_{concurrency}"
+    timing_dir = f"{work_dir}/timing"
+    cmd = [sys.executable, f"{REPO_DIR}/{COLLECTOR_SCRIPTS[collector]}", "--inventory", inventory_file,
+           "--collection-dir", work_dir, "--snapshot-name", snapshot_name, "--max-threads", str(concurrency),
+           "--timing-export", timing_dir, "--log-level", "error"]
+    if collector == "show":
+        cmd.extend(["--command-file", f"{REPO_DIR}/show_commands.yml"])
+    env = dict(os.environ, BF_COLLECTOR_USER=username, BF_COLLECTOR_PASSWORD=password)
+
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd + extra_args, env=env, stdout=subprocess.DEVNULL)
+    # wait4 returns the resource usage of the collector process alone
+    _, exit_status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(exit_status)
+
+    times = device_times(f"{timing_dir}/{snapshot_name}_{collector}_spans.jsonl")
+    return {
+        "collector": collector,
+        "concurrency": concurrency,
+        "exit_code": process.returncode,
+        "seconds": seconds,
+        "devices": len(times),
+        "devices_per_minute": len(times) / seconds * 60 if seconds else 0,
+        "p50": percentile(times, 50),
+        "p99": percentile(times, 99),
+        "mean": statistics.mean(times) if len(times) != 0 else 0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": rusage.ru_maxrss / 1024,
+    }
+
+
+def print_results(results: List[Dict]) -> None:
+    print(f"{'collector':<10}{'sessions':>9}{'devices':>9}{'seconds':>10}{'dev/min':>10}{'p50 s':>9}{'p99 s':>9}"
+          f"{'RSS MB':>9}")
+    for result in results:
+        line = (f"{result['collector']:<10}{result['concurrency']:>9}{result['devices']:>9}"
+                f"{result['seconds']:>10.1f}{result['devices_per_minute']:>10.1f}{result['p50']:>9.2f}"
+                f"{result['p99']:>9.2f}{result['peak_rss_mb']:>9.1f}")
+        if result['exit_code'] != 0:
+            line += f"  exit code {result['exit_code']}"
+        print(line)
+
+
+def main(devices: int, concurrency_levels: List[int], collectors: List[Text], farm_args: List[Text],
+         collector_args: List[Text], work_dir: Text, json_file: Text = None) -> List[Dict]:
+    os.makedirs(work_dir, exist_ok=True)
+    inventory_file = f"{work_dir}/farm_inventory.yml"
+    if os.path.exists(inventory_file):
+        os.remove(inventory_file)
+
+    farm = start_farm(devices, inventory_file, farm_args)
+    results = []
+    try:
+        for concurrency in concurrency_levels:
+            for collector in collectors:
+                print(f"### {collector} collection of {devices} devices, {concurrency} concurrent sessions",
+                      flush=True)
+                results.append(run_collector(collector, inventory_file, work_dir, concurrency, "bench", "bench",
+                                             collector_args))
+    finally:
+        farm.terminate()
+        farm.wait()
+
+    print_results(results)
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--devices", help="Number of simulated devices", type=int, default=100)
+    parser.add_argument("--concurrency", help="Comma separated --max-threads values to run the collectors with",
+                        default="10,30,60")
+    parser.add_argument("--collectors", help="Comma separated collectors to run", default="config,show")
+    parser.add_argument("--collector-args", help="Extra arguments for the collectors, like '--adaptive'",
+                        default="")
+    parser.add_argument("--work-dir", help="Directory for the inventory and collected data. Default is a "
+                                           "temporary directory that is removed afterwards", default=None)
+    parser.add_argument("--json", help="Also write the results to this JSON file", default=None)
+
+    args, farm_args = parser.parse_known_args()
+
+    collectors = args.collectors.split(",")
+    for collector in collectors:
+        if collector not in COLLECTOR_SCRIPTS:
+            raise Exception(f"Unknown collector {collector}, expected one of {list(COLLECTOR_SCRIPTS.keys())}")
+    concurrency_levels = [int(concurrency) for concurrency in args.concurrency.split(",")]
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="bench_collection_")
+    try:
+        main(args.devices, concurrency_levels, collectors, farm_args, args.collector_args.split(), work_dir,
+             args.json)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,69 @@
+"""
+Measures what the asyncio scheduling of the collection engine gains over a plain thread pool, without devices.
+
+Each simulated device blocks its worker thread for --device-seconds, like a netmiko session does. A share of the
+devices, --retry-rate, has to wait --retry-delay seconds before its collection can be retried. With a plain thread
+pool the wait holds a worker thread, which is what the engine does after max_retries. With deferred retries the
+device gives its session slot back while it waits:
+
+    python benchmarks/bench_engine.py --devices 200 --max-threads 20 --retry-rate 0.1 --retry-delay 10
+"""
+import os
+import sys
+import threading
+import time
+from typing import Dict
+
+import configargparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from collection_engine import CollectionTask, run_collection  # noqa: E402
+from collection_helper import CollectionStatus, wait_before_retry  # noqa: E402
+
+
+class SimulatedDevices(object):
+
+    def __init__(self, device_seconds: float, retry_every: int, retry_delay: int):
+        self._device_seconds = device_seconds
+        self._retry_every = retry_every
+        self._retry_delay = retry_delay
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def collect(self, index: int) -> Dict:
+        name = f"device{index}"
+        with self._lock:
+            attempt = self._attempts[name] = self._attempts.get(name, 0) + 1
+        if self._retry_every and index % self._retry_every == 0 and attempt == 1:
+            # raises CollectionRetry if the engine defers retries, sleeps on the worker thread otherwise
+            wait_before_retry(name, self._retry_delay, "simulated")
+        time.sleep(self._device_seconds)
+        return {"name": name, "status": CollectionStatus.PASS, "failed_commands": [], "message": ""}
+
+
+def run(devices: int, max_threads: int, device_seconds: float, retry_rate: float, retry_delay: int,
+        max_retries: int) -> float:
+    simulated = SimulatedDevices(device_seconds, int(round(1 / retry_rate)) if retry_rate else 0, retry_delay)
+    tasks = [CollectionTask(f"device{i}", simulated.collect, dict(index=i)) for i in range(devices)]
+    start = time.perf_counter()
+    run_collection(tasks, max_threads, max_retries=max_retries, retry_backoff=1)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--devices", help="Number of simulated devices", type=int, default=200)
+    parser.add_argument("--max-threads", help="Concurrent sessions", type=int, default=20)
+    parser.add_argument("--device-seconds", help="Time each device blocks its worker thread", type=float,
+                        default=1.0)
+    parser.add_argument("--retry-rate", help="Share of the devices that wait before a retry", type=float,
+                        default=0.1)
+    parser.add_argument("--retry-delay", help="Seconds those devices wait", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'retries':<22}{'seconds':>10}{'dev/min':>10}")
+    for label, max_retries in [("wait on worker thread", 0), ("deferred", 2)]:
+        seconds = run(args.devices, args.max_threads, args.device_seconds, args.retry_rate, args.retry_delay,
+                      max_retries)
+        print(f"{label:<22}{seconds:>10.1f}{args.devices / seconds * 60:>10.1f}")
@@ -0,0 +1,48 @@
+"""
+Regression check for the route store parsers.
+
+Parses the captured route tables and BGP RIBs in captures/ and compares the routes with the expected tuples in
+captures/route_store_expected.json. The captures cover classful routes printed without a length, ECMP paths on
+continuation lines and BGP prefixes too long for their column, with the next hop on the line after.
+
+    python benchmarks/check_route_store.py
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import route_store  # noqa: E402
+
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "captures")
+
+
+def main():
+    with open(os.path.join(CAPTURE_DIR, "route_store_expected.json")) as f:
+        expected_routes = json.load(f)
+
+    failed = False
+    for capture, expected in expected_routes.items():
+        parser = getattr(route_store, expected["parser"])
+        with open(os.path.join(CAPTURE_DIR, capture)) as f:
+            routes = list(parser(f))
+        expected_tuples = [tuple(route) for route in expected["routes"]]
+        if routes != expected_tuples:
+            failed = True
+            print(f"### {capture}: {expected['parser']} returned {len(routes)} routes, "
+                  f"expected {len(expected_tuples)}")
+            for route in routes:
+                if route not in expected_tuples:
+                    print(f"###   unexpected {route}")
+            for route in expected_tuples:
+                if route not in routes:
+                    print(f"###   missing {route}")
+    if failed:
+        sys.exit("route store parser check failed")
+
+    print("### Route store parser check passed")
+
+
+if __name__ == "__main__":
+    main()
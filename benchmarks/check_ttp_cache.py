@@ -0,0 +1,46 @@
+"""
+Regression check for the shared TTP parser cache.
+
+Parses a captured A10 "show version" twice through TTP_TEMPLATES. Both parses must return the ACOS version,
+results handed out by the cache must not be emptied by the next parse on the same template.
+
+    python benchmarks/check_ttp_cache.py
+"""
+import os
+import sys
+from typing import Optional, Text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from collection_helper import TTP_TEMPLATES, A10_VERSION_TTP_TEMPLATE, a10_parse_version  # noqa: E402
+
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "captures")
+
+
+def acos_version(result) -> Optional[Text]:
+    try:
+        return result[0][0][0].get("acos_version")
+    except IndexError:
+        return None
+
+
+def main():
+    with open(os.path.join(CAPTURE_DIR, "a10_show_version.txt")) as f:
+        output = f.read()
+
+    first = TTP_TEMPLATES.parse(A10_VERSION_TTP_TEMPLATE, output)
+    second = TTP_TEMPLATES.parse(A10_VERSION_TTP_TEMPLATE, output)
+    if acos_version(first) != "4.1.4-GR1-P5":
+        sys.exit(f"first parse lost the version: {first}")
+    if first != second:
+        sys.exit(f"parses differ: {first} != {second}")
+
+    versions = [a10_parse_version(output), a10_parse_version(output)]
+    if versions != ["v4p", "v4p"]:
+        sys.exit(f"a10_parse_version returned {versions}, expected v4p twice")
+
+    print("### TTP cache check passed")
+
+
+if __name__ == "__main__":
+    main()
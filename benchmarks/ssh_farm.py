@@ -0,0 +1,714 @@
+"""
+Local SSH server farm emulating the prompts, paging and outputs of the platforms the collectors support.
+
+Every device listens on its own port on 127.0.0.1 and the farm writes an inventory for the collectors:
+
+    python benchmarks/ssh_farm.py --devices 100 --inventory /tmp/farm_inventory.yml --latency 0.2 --drop-rate 0.01
+
+Any username is accepted, with any password. Junos devices also serve the netconf SSH subsystem on the same port,
+--netconf sets ansible_connection: netconf for them in the inventory. Arista and NX-OS devices also serve eAPI and
+NX-API over plain HTTP on a second port, --httpapi sets ansible_connection: httpapi for them in the inventory.
+Cumulus devices serve their configuration files over SFTP.
+"""
+import functools
+import io
+import json
+import logging
+import os
+import random
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Text, Tuple
+from xml.sax.saxutils import escape
+
+import configargparse
+import paramiko
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from collection_helper import AnsibleOsToNetmikoOs  # noqa: E402
+from bench_bgp_neighbors import generate_xr_neighbors, generate_nxos_summary  # noqa: E402
+from bgp_neighbors import extract_nxos_summary_neighbors  # noqa: E402
+
+# netmiko OS -> (inventory group, as in example_inventory.yml and show_commands.yml, prompt)
+PLATFORMS = {
+    "arista_eos": ("aristaeos", "{name}#"),
+    "a10": ("a10", "{name}#"),
+    "checkpoint_gaia": ("checkpointgaia", "{name}>"),
+    "cisco_asa": ("ciscoasa", "{name}#"),
+    "cisco_ios": ("ciscoios", "{name}#"),
+    "cisco_nxos": ("cisconxos", "{name}#"),
+    "cisco_xr": ("ciscoiosxr", "RP/0/RSP0/CPU0:{name}#"),
+    "juniper_junos": ("juniper", "{user}@{name}>"),
+    "linux": ("cumulus", "{user}@{name}:~$"),
+}
+NETMIKO_TO_ANSIBLE_OS = {netmiko_os: ansible_os for ansible_os, netmiko_os in AnsibleOsToNetmikoOs.items()}
+
+# what netmiko waits for after the commands it sends while preparing the session
+SETUP_RESPONSES = {
+    "terminal width 511": "Width set to 511 columns.",
+    "terminal length 0": "Pagination disabled.",
+    "set cli screen-width 511": "Screen width set to 511",
+    "set cli complete-on-space off": "Disabling complete-on-space",
+    "set cli screen-length 0": "Screen length set to 0",
+}
+PAGING_OFF_COMMANDS = ["terminal length 0", "terminal pager 0", "set cli screen-length 0", "set clienv rows 0"]
+# the commands config_collector.py uses to tell whether a configuration changed
+CHANGE_MARKER_COMMANDS = ["| include", "| match", "show checksum", "commit list", "show system commit"]
+PAGING_PROMPT = " --More-- "
+SEND_CHUNK_SIZE = 16384
+REQUEST_REPLY_DELAY = 0.05  # seconds
+
+# platforms that serve the netconf SSH subsystem
+NETCONF_PLATFORMS = ["juniper_junos"]
+NETCONF_NS = "urn:ietf:params:xml:ns:netconf:base:1.0"
+NETCONF_BASE_1_1 = "urn:ietf:params:netconf:base:1.1"
+NETCONF_END_OF_MESSAGE = b"]]>]]>"
+
+# platforms that serve the files cat prints over the sftp SSH subsystem
+SFTP_PLATFORMS = ["linux"]
+
+# platforms that serve their JSON-RPC HTTP API, and its path
+HTTPAPI_PLATFORMS = {
+    "arista_eos": "/command-api",
+    "cisco_nxos": "/ins",
+}
+
+
+class FarmConfig(object):
+    """
+    Output sizes and faults of the emulated devices
+    """
+
+    def __init__(self, latency: float = 0, output_lines: int = 2000, route_lines: int = 20000, bgp_neighbors: int = 4,
+                 page_lines: int = 24, stall_rate: float = 0, stall_seconds: float = 30, drop_rate: float = 0,
+                 auth_fail_rate: float = 0, seed: int = 0, exec_channels: int = 8, netconf_framing: Text = "1.1"):
+        self.latency = latency
+        self.output_lines = output_lines
+        self.route_lines = route_lines
+        self.bgp_neighbors = bgp_neighbors
+        self.page_lines = page_lines
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.drop_rate = drop_rate
+        self.auth_fail_rate = auth_fail_rate
+        self.seed = seed
+        # exec channels a device runs at once, 0 refuses exec requests
+        self.exec_channels = exec_channels
+        # NETCONF base version the devices offer, 1.1 for chunked framing
+        self.netconf_framing = netconf_framing
+
+
+def _lines(prefix: Text, count: int) -> Text:
+    # no prompt terminators in the output, so it can not be mistaken for the prompt
+    return "\n".join(f"{prefix} line {i} value {i * 7919 % 100003}" for i in range(count))
+
+
+def _config(name: Text, count: int, trailer: Text = "end") -> Text:
+    return "\n".join([f"hostname {name}", _lines(" config", count), trailer])
+
+
+def _a10_show_version() -> Text:
+    return "\n".join([
+        "Thunder Series Unified Application Service Gateway TH3030S",
+        "  Copyright 2007-2021 by A10 Networks, Inc.  All A10 Networks products are",
+        "          64-bit Advanced Core OS (ACOS) version 4.1.4-GR1-P5, build 81 (Jan-19-2021,18:23)",
+        "          Serial Number: TH30A12345678901",
+        "          Firmware version: 2.0.4",
+        "          aFleX version: 2.0.0",
+        "          aXAPI version: 3.0",
+    ])
+
+
+def _a10_show_partition(partitions: List[Text]) -> Text:
+    lines = [f"Total Number of active partitions: {len(partitions)}",
+             "Partition Name   Id     L3V/SP     Parent L3V           App Type   Admin Count",
+             "-" * 78]
+    lines.extend(f"{partition:<16} {i + 1:<6} L3V        -                    -          0"
+                 for i, partition in enumerate(partitions))
+    return "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=4096)
+def device_output(platform: Text, name: Text, cmd: Text, config: FarmConfig) -> Text:
+    """
+    Output of cmd on the device, the same every time it is run
+    """
+    if cmd in SETUP_RESPONSES:
+        return SETUP_RESPONSES[cmd]
+    if cmd in ["terminal pager 0", "set clienv rows 0", "show curpriv", "login"]:
+        return ""
+
+    if platform == "a10":
+        partitions = ["p1", "p2"]
+        if cmd == "show version":
+            return _a10_show_version()
+        if cmd == "show partition":
+            return _a10_show_partition(partitions)
+        if cmd == "show running-config":
+            return _config(name, config.output_lines)
+        if cmd.startswith("show running-config partition "):
+            partition = cmd.split()[-1]
+            return _config(name, config.output_lines // 4, f"active-partition {partition}\n!\nend")
+        if cmd == "show running-config partition-config all":
+            sections = [_config(name, config.output_lines, "!")]
+            sections.extend(f"active-partition {partition}\n{_lines(' partition', config.output_lines // 4)}"
+                            for partition in partitions)
+            return "\n!\n".join(sections + ["end"])
+
+    if platform == "cisco_xr" and cmd in ["show bgp all all neighbors", "show bgp vrf all neighbors"]:
+        return generate_xr_neighbors(config.bgp_neighbors, 0 if "all all" in cmd else 2)
+    if platform == "cisco_nxos" and cmd == "show bgp vrf all all summary":
+        return generate_nxos_summary(config.bgp_neighbors, 2)
+
+    if any(marker in cmd for marker in CHANGE_MARKER_COMMANDS):
+        return f"{name} configuration revision {config.seed}"
+    if "route" in cmd or (cmd.startswith("show bgp") and "summary" not in cmd):
+        return _lines(f"{name} {cmd}", config.route_lines)
+    if cmd.startswith("show running-config") or cmd.startswith("show configuration") or cmd.startswith("cat "):
+        return _config(name, config.output_lines)
+    return _lines(f"{name} {cmd}", max(config.output_lines // 10, 1))
+
+
+class DeviceServer(paramiko.ServerInterface):
+
+    def __init__(self, config: FarmConfig, rng: random.Random, platform: Text, name: Text):
+        self._config = config
+        self._rng = rng
+        self._platform = platform
+        self._name = name
+        self._exec_slots = threading.BoundedSemaphore(max(config.exec_channels, 1))
+        self.username = None
+        # set when the shell or the netconf subsystem is requested
+        self.session_requested = threading.Event()
+        self.subsystem = None
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if self._rng.random() < self._config.auth_fail_rate:
+            return paramiko.AUTH_FAILED
+        self.username = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.session_requested.set()
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        if name == "sftp" and self._platform in SFTP_PLATFORMS:
+            # runs the handler set with set_subsystem_handler on its own thread
+            return super().check_channel_subsystem_request(channel, name)
+        if name != "netconf" or self._platform not in NETCONF_PLATFORMS:
+            return False
+        self.subsystem = name
+        self.session_requested.set()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        if self._config.exec_channels == 0:
+            return False
+        threading.Thread(target=self._exec, args=(channel, command.decode("utf-8", errors="ignore")),
+                         daemon=True).start()
+        return True
+
+    def _exec(self, channel: paramiko.Channel, cmd: Text) -> None:
+        # commands beyond the device's exec channel limit wait, like they would for the device's CPU
+        with self._exec_slots:
+            try:
+                # paramiko accepts the exec request after this handler returns, output sent before that
+                # would reach the client ahead of the reply
+                time.sleep(max(self._config.latency, REQUEST_REPLY_DELAY))
+                output = device_output(self._platform, self._name, cmd.strip(), self._config)
+                for i in range(0, len(output), SEND_CHUNK_SIZE):
+                    channel.sendall(output[i:i + SEND_CHUNK_SIZE].encode("utf-8"))
+                channel.send_exit_status(0)
+            except (EOFError, OSError, paramiko.SSHException):
+                pass
+            finally:
+                channel.close()
+
+
+class DeviceSftp(paramiko.SFTPServerInterface):
+    """
+    Read only SFTP server of one device, every file has the output of cat for it followed by a newline
+    """
+
+    def __init__(self, server: DeviceServer, platform: Text, name: Text, config: FarmConfig, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self._platform = platform
+        self._name = name
+        self._config = config
+
+    def _content(self, path: Text) -> bytes:
+        return (device_output(self._platform, self._name, f"cat {path}", self._config) + "\n").encode("utf-8")
+
+    def stat(self, path):
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = len(self._content(path))
+        attributes.st_mode = 0o100644
+        return attributes
+
+    def lstat(self, path):
+        return self.stat(path)
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        handle = paramiko.SFTPHandle(flags)
+        handle.readfile = io.BytesIO(self._content(path))
+        # fstat, which the client uses to prefetch the file
+        handle.stat = functools.partial(self.stat, path)
+        return handle
+
+
+class DeviceShell(object):
+    """
+    Interactive CLI of one device on one SSH channel
+    """
+
+    def __init__(self, channel: paramiko.Channel, platform: Text, name: Text, username: Text, config: FarmConfig,
+                 rng: random.Random):
+        self._channel = channel
+        self._platform = platform
+        self._name = name
+        self._config = config
+        self._rng = rng
+        self._prompt = PLATFORMS[platform][1].format(name=name, user=username)
+        # linux does not page
+        self._paging = platform != "linux"
+
+    def _send(self, text: Text) -> None:
+        self._channel.sendall(text.encode("utf-8"))
+
+    def run(self) -> None:
+        self._send(f"\r\n{self._prompt}")
+        line = ""
+        previous = ""
+        while True:
+            data = self._channel.recv(4096)
+            if not data:
+                return
+            echo = ""
+            for char in data.decode("utf-8", errors="ignore"):
+                if char == "\n" and previous == "\r":
+                    previous = char
+                    continue
+                previous = char
+                if char in "\r\n":
+                    self._send(f"{echo}\r\n")
+                    echo = ""
+                    self._execute(line.strip())
+                    line = ""
+                elif char in "\x08\x7f":
+                    line = line[:-1]
+                else:
+                    line += char
+                    echo += char
+            if echo:
+                self._send(echo)
+
+    def _execute(self, cmd: Text) -> None:
+        if cmd == "":
+            self._send(self._prompt)
+            return
+        if cmd in PAGING_OFF_COMMANDS:
+            self._paging = False
+        if self._rng.random() < self._config.drop_rate:
+            self._channel.get_transport().close()
+            raise EOFError(f"Dropped {self._name} on {cmd}")
+
+        time.sleep(self._config.latency)
+        output = device_output(self._platform, self._name, cmd, self._config)
+        if output:
+            self._send_output(output.replace("\n", "\r\n") + "\r\n")
+        self._send(self._prompt)
+
+    def _send_output(self, output: Text) -> None:
+        stall_at = None
+        if self._rng.random() < self._config.stall_rate:
+            stall_at = self._rng.randrange(len(output))
+
+        if self._paging:
+            pages = output.split("\r\n")
+            for i in range(0, len(pages), self._config.page_lines):
+                self._send("\r\n".join(pages[i:i + self._config.page_lines]))
+                if i + self._config.page_lines < len(pages):
+                    self._send(PAGING_PROMPT)
+                    if not self._channel.recv(1):
+                        raise EOFError(f"{self._name} closed while paging")
+                    self._send("\r" + " " * len(PAGING_PROMPT) + "\r")
+                else:
+                    self._send("\r\n")
+            return
+
+        for i in range(0, len(output), SEND_CHUNK_SIZE):
+            if stall_at is not None and i <= stall_at < i + SEND_CHUNK_SIZE:
+                time.sleep(self._config.stall_seconds)
+            self._send(output[i:i + SEND_CHUNK_SIZE])
+
+
+class NetconfDevice(object):
+    """
+    NETCONF server of one device on one SSH channel, answering get-configuration and <command> RPCs like Junos
+    """
+
+    def __init__(self, channel: paramiko.Channel, platform: Text, name: Text, config: FarmConfig,
+                 rng: random.Random):
+        self._channel = channel
+        self._platform = platform
+        self._name = name
+        self._config = config
+        self._rng = rng
+        self._buffer = b""
+        self._chunked = False
+
+    def _recv(self) -> bytes:
+        data = self._channel.recv(65536)
+        if not data:
+            raise EOFError(f"{self._name} NETCONF session closed")
+        return data
+
+    def _read_message(self) -> bytes:
+        if not self._chunked:
+            while NETCONF_END_OF_MESSAGE not in self._buffer:
+                self._buffer += self._recv()
+            message, self._buffer = self._buffer.split(NETCONF_END_OF_MESSAGE, 1)
+            return message
+
+        message = b""
+        while True:
+            while b"\n" not in self._buffer[2:] or len(self._buffer) < 4:
+                self._buffer += self._recv()
+            if self._buffer.startswith(b"\n##\n"):
+                self._buffer = self._buffer[4:]
+                return message
+            header, self._buffer = self._buffer[2:].split(b"\n", 1)
+            size = int(header)
+            while len(self._buffer) < size:
+                self._buffer += self._recv()
+            message += self._buffer[:size]
+            self._buffer = self._buffer[size:]
+
+    def _send(self, message: Text) -> None:
+        data = message.encode("utf-8")
+        if not self._chunked:
+            self._channel.sendall(data + NETCONF_END_OF_MESSAGE)
+            return
+        for i in range(0, len(data), SEND_CHUNK_SIZE):
+            chunk = data[i:i + SEND_CHUNK_SIZE]
+            self._channel.sendall(b"\n#%d\n" % len(chunk) + chunk)
+        self._channel.sendall(b"\n##\n")
+
+    def run(self) -> None:
+        capabilities = ["urn:ietf:params:netconf:base:1.0"]
+        if self._config.netconf_framing == "1.1":
+            capabilities.append(NETCONF_BASE_1_1)
+        self._send(f'<?xml version="1.0" encoding="UTF-8"?><hello xmlns="{NETCONF_NS}"><capabilities>'
+                   + "".join(f"<capability>{capability}</capability>" for capability in capabilities)
+                   + "</capabilities><session-id>1</session-id></hello>")
+        client_hello = self._read_message()
+        self._chunked = NETCONF_BASE_1_1 in capabilities and NETCONF_BASE_1_1.encode("utf-8") in client_hello
+
+        while True:
+            rpc = ElementTree.fromstring(self._read_message())
+            operation = rpc[0]
+            name = operation.tag.split("}")[-1]
+            if self._rng.random() < self._config.drop_rate:
+                self._channel.get_transport().close()
+                raise EOFError(f"Dropped {self._name} on {name}")
+
+            time.sleep(self._config.latency)
+            if name == "get-configuration" and operation.get("format") == "set":
+                output = device_output(self._platform, self._name, "show configuration | display set", self._config)
+                body = f"<configuration-set>\n{escape(output)}\n</configuration-set>"
+            elif name == "command" and "|" not in (operation.text or ""):
+                output = device_output(self._platform, self._name, operation.text.strip(), self._config)
+                body = f"<output>\n{escape(output)}\n</output>"
+            elif name == "close-session":
+                body = "<ok/>"
+            else:
+                body = ("<rpc-error><error-type>protocol</error-type><error-tag>operation-not-supported</error-tag>"
+                        "<error-severity>error</error-severity>"
+                        f"<error-message>syntax error: {escape(operation.text or name)}</error-message>"
+                        "</rpc-error>")
+            self._send(f'<rpc-reply xmlns="{NETCONF_NS}" message-id="{rpc.get("message-id")}">{body}</rpc-reply>')
+            if name == "close-session":
+                return
+
+
+def nxapi_summary(platform: Text, name: Text, config: FarmConfig) -> Dict:
+    """
+    NX-API JSON output of "show bgp vrf all all summary", with the neighbors of the text output
+    """
+    text = device_output(platform, name, "show bgp vrf all all summary", config)
+    vrf_rows = []
+    for vrf, neighbors in extract_nxos_summary_neighbors(text).items():
+        neighbor_rows = [{"neighborid": neighbor, "neighborversion": 4, "state": "Established"}
+                         for neighbor in neighbors]
+        vrf_rows.append({"vrf-name-out": vrf, "TABLE_af": {"ROW_af": {"af-id": 1, "TABLE_saf": {"ROW_saf": {
+            "safi": 1, "TABLE_neighbor": {"ROW_neighbor": neighbor_rows}}}}}})
+    return {"TABLE_vrf": {"ROW_vrf": vrf_rows}}
+
+
+class HttpApiDevice(BaseHTTPRequestHandler):
+    """
+    eAPI or NX-API of one device, answering batched JSON-RPC requests with text outputs. The farm sets platform,
+    name, config and rng on a subclass per device.
+    """
+    protocol_version = "HTTP/1.1"
+    platform = None
+    name = None
+    config = None
+    rng = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if self.path != HTTPAPI_PLATFORMS[self.platform]:
+            self._reply(404, {"error": f"no API at {self.path}"})
+            return
+        if self.headers.get("Authorization") is None or self.rng.random() < self.config.auth_fail_rate:
+            self._reply(401, {"error": "Unauthorized"})
+            return
+        if self.rng.random() < self.config.drop_rate:
+            # no reply, the client sees the connection closed
+            self.close_connection = True
+            return
+
+        # one round trip for the whole request
+        time.sleep(self.config.latency)
+        if self.platform == "arista_eos":
+            self._reply(200, self._eapi(request))
+        else:
+            self._reply(200, self._nxapi(request))
+
+    def _eapi(self, request: Dict) -> Dict:
+        params = request["params"]
+        results = []
+        for cmd in params["cmds"]:
+            if cmd == "enable":
+                results.append({"output": ""} if params["format"] == "text" else {})
+            elif params["format"] == "text" and "|" not in cmd:
+                results.append({"output": device_output(self.platform, self.name, cmd, self.config) + "\n"})
+            else:
+                # the request stops at the first command that fails
+                error = f"CLI command {len(results) + 1} of {len(params['cmds'])} '{cmd}' failed: invalid command"
+                results.append({"errors": [f"Invalid input (at token 1: '{cmd}')"]})
+                return {"jsonrpc": "2.0", "id": request["id"],
+                        "error": {"code": 1002, "message": error, "data": results}}
+        return {"jsonrpc": "2.0", "id": request["id"], "result": results}
+
+    def _nxapi(self, requests: List[Dict]):
+        replies = []
+        for request in requests:
+            cmd = request["params"]["cmd"]
+            if request["method"] == "cli_ascii" and "|" not in cmd:
+                result = {"msg": device_output(self.platform, self.name, cmd, self.config) + "\n"}
+            elif request["method"] == "cli" and cmd == "show bgp vrf all all summary":
+                result = {"body": nxapi_summary(self.platform, self.name, self.config)}
+            else:
+                replies.append({"jsonrpc": "2.0", "id": request["id"],
+                                "error": {"code": -32602, "message": "Invalid params",
+                                          "data": {"msg": "% Invalid command\n"}}})
+                continue
+            replies.append({"jsonrpc": "2.0", "id": request["id"], "result": result})
+        return replies if len(replies) != 1 else replies[0]
+
+
+class SshFarm(object):
+    """
+    Emulated devices on consecutive ports of 127.0.0.1
+    """
+
+    def __init__(self, devices: List[Tuple[Text, Text]], config: FarmConfig, host: Text = "127.0.0.1"):
+        self._devices = devices
+        self._config = config
+        self._host = host
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._selector = selectors.DefaultSelector()
+        self._ports = {}
+        self._http_ports = {}
+        self._http_servers = []
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        for name, platform in self._devices:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self._host, 0))
+            listener.listen(16)
+            listener.setblocking(False)
+            self._ports[name] = listener.getsockname()[1]
+            self._selector.register(listener, selectors.EVENT_READ, (name, platform))
+            if platform in HTTPAPI_PLATFORMS:
+                self._start_http_server(name, platform)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _start_http_server(self, name: Text, platform: Text) -> None:
+        handler = type(f"HttpApiDevice_{name}", (HttpApiDevice,),
+                       {"platform": platform, "name": name, "config": self._config,
+                        "rng": random.Random(f"{self._config.seed}-{name}-http")})
+        server = ThreadingHTTPServer((self._host, 0), handler)
+        server.daemon_threads = True
+        self._http_ports[name] = server.server_address[1]
+        self._http_servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        for server in self._http_servers:
+            server.shutdown()
+        self._http_servers = []
+
+    def serve(self, duration: Optional[float] = None) -> None:
+        """
+        Blocks until stop is called or for duration seconds
+        """
+        self._stopped.wait(duration)
+        self.stop()
+
+    def _accept_loop(self) -> None:
+        while not self._stopped.is_set():
+            for key, _ in self._selector.select(timeout=0.5):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                sock.setblocking(True)
+                name, platform = key.data
+                threading.Thread(target=self._serve, args=(sock, name, platform), daemon=True).start()
+
+    def _serve(self, sock: socket.socket, name: Text, platform: Text) -> None:
+        rng = random.Random(f"{self._config.seed}-{name}-{time.time()}")
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self._host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, DeviceSftp, platform, name, self._config)
+        server = DeviceServer(self._config, rng, platform, name)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(30)
+            if channel is None or not server.session_requested.wait(10):
+                return
+            if server.subsystem == "netconf":
+                # like exec requests, the hello must not overtake the reply to the subsystem request
+                time.sleep(REQUEST_REPLY_DELAY)
+                NetconfDevice(channel, platform, name, self._config, rng).run()
+            else:
+                DeviceShell(channel, platform, name, server.username, self._config, rng).run()
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def inventory(self, netconf: bool = False, httpapi: bool = False) -> Dict:
+        """
+        Inventory of the devices, with ansible_connection netconf for the platforms that serve NETCONF if netconf is
+        set and ansible_connection httpapi for the platforms that serve an HTTP API if httpapi is set
+        """
+        children = {}
+        for name, platform in self._devices:
+            group = PLATFORMS[platform][0]
+            group_vars = {"ansible_network_os": NETMIKO_TO_ANSIBLE_OS[platform]}
+            if netconf and platform in NETCONF_PLATFORMS:
+                group_vars["ansible_connection"] = "netconf"
+            if httpapi and platform in HTTPAPI_PLATFORMS:
+                group_vars["ansible_connection"] = "httpapi"
+                group_vars["ansible_httpapi_use_ssl"] = False
+            group_data = children.setdefault(group, {"vars": group_vars, "hosts": {}})
+            group_data["hosts"][name] = {"ansible_host": self._host, "ansible_port": self._ports[name]}
+            if platform in HTTPAPI_PLATFORMS:
+                group_data["hosts"][name]["ansible_httpapi_port"] = self._http_ports[name]
+        return {"all": {"children": children}}
+
+
+def farm_devices(count: int, platforms: List[Text]) -> List[Tuple[Text, Text]]:
+    """
+    count device names spread round robin over platforms
+    """
+    return [(f"{platforms[i % len(platforms)].replace('_', '')}{i:04d}", platforms[i % len(platforms)])
+            for i in range(count)]
+
+
+def main(devices: int, platforms: List[Text], config: FarmConfig, inventory_file: Text,
+         duration: Optional[float] = None, netconf: bool = False, httpapi: bool = False) -> None:
+    # clients closing their sockets without a disconnect message are expected, don't log them
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    farm = SshFarm(farm_devices(devices, platforms), config)
+    farm.start()
+    with open(f"{inventory_file}.tmp", "w") as f:
+        yaml.safe_dump(farm.inventory(netconf, httpapi), f)
+    # the inventory appearing means the farm is ready
+    os.replace(f"{inventory_file}.tmp", inventory_file)
+    print(f"Serving {devices} devices, inventory in {inventory_file}", flush=True)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: farm.stop())
+    try:
+        farm.serve(duration)
+    except KeyboardInterrupt:
+        farm.stop()
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--devices", help="Number of devices", type=int, default=100)
+    parser.add_argument("--platforms", help="Comma separated netmiko OSes to emulate. Default is all",
+                        default=",".join(PLATFORMS.keys()))
+    parser.add_argument("--inventory", help="Inventory file to write for the collectors", required=True)
+    parser.add_argument("--latency", help="Seconds before each command responds", type=float, default=0)
+    parser.add_argument("--output-lines", help="Lines of configuration output", type=int, default=2000)
+    parser.add_argument("--route-lines", help="Lines of route and BGP RIB output", type=int, default=20000)
+    parser.add_argument("--bgp-neighbors", help="BGP neighbors per device", type=int, default=4)
+    parser.add_argument("--stall-rate", help="Fraction of commands that stall mid output", type=float, default=0)
+    parser.add_argument("--stall-seconds", help="Length of a stall", type=float, default=30)
+    parser.add_argument("--drop-rate", help="Fraction of commands that drop the connection", type=float, default=0)
+    parser.add_argument("--auth-fail-rate", help="Fraction of logins that are rejected", type=float, default=0)
+    parser.add_argument("--exec-channels", help="Exec channels each device runs at once, 0 refuses exec requests",
+                        type=int, default=8)
+    parser.add_argument("--netconf", help="Collect the devices that serve NETCONF over NETCONF instead of the CLI",
+                        action="store_true", default=False)
+    parser.add_argument("--netconf-framing", help="NETCONF base version the devices offer, 1.0 or 1.1",
+                        choices=["1.0", "1.1"], default="1.1")
+    parser.add_argument("--httpapi", help="Collect the devices that serve eAPI or NX-API over HTTP instead of the CLI",
+                        action="store_true", default=False)
+    parser.add_argument("--seed", help="Seed for the faults and the configuration revision", type=int, default=0)
+    parser.add_argument("--duration", help="Seconds to serve. Default is until interrupted", type=float, default=None)
+
+    args = parser.parse_args()
+
+    platforms = args.platforms.split(",")
+    for platform in platforms:
+        if platform not in PLATFORMS:
+            raise Exception(f"Unknown platform {platform}, expected one of {list(PLATFORMS.keys())}")
+
+    farm_config = FarmConfig(args.latency, args.output_lines, args.route_lines, args.bgp_neighbors, 24,
+                             args.stall_rate, args.stall_seconds, args.drop_rate, args.auth_fail_rate, args.seed,
+                             args.exec_channels, args.netconf_framing)
+    main(args.devices, platforms, farm_config, args.inventory, args.duration, args.netconf, args.httpapi)
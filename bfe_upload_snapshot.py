@@ -1,3 +1,9 @@
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
 import configargparse
 
 from dotenv import dotenv_values
@@ -5,10 +11,93 @@ from pathlib import Path
 from pybfe.client.session import Session as BfeSession
 from pybatfish.client.session import Session as BfSession
 
+from snapshot_packager import package_snapshot
+
+# snapshot parts that can be uploaded on their own, see --part
+UPLOAD_PARTS = ["all", "configs", "show"]
+# folder of the show data, uploaded after the rest of the snapshot with --part show
+SHOW_DIR = "show"
+# suffix of the snapshot the show data is attached to, Batfish snapshots can not be changed once initialized
+SHOW_SNAPSHOT_SUFFIX = "_show"
+
+
+def stage_snapshot(snapshot_dir: str, stage_dir: str, include_show: bool, only_show: bool) -> str:
+    """
+    Hardlinks the files of the snapshot, with or without the show data, into a folder with the snapshot name under
+    stage_dir and returns it, so the snapshot folder can be uploaded in parts while it is still being written to
+    """
+    snapshot_path = Path(snapshot_dir)
+    staged = Path(stage_dir).joinpath(snapshot_path.name)
+    for root, _, files in os.walk(snapshot_path):
+        relative = Path(root).relative_to(snapshot_path)
+        is_show = len(relative.parts) != 0 and relative.parts[0] == SHOW_DIR
+        if (is_show and not include_show) or (only_show and not is_show):
+            continue
+        os.makedirs(staged.joinpath(relative), exist_ok=True)
+        for file_name in files:
+            src = Path(root).joinpath(file_name)
+            dst = staged.joinpath(relative, file_name)
+            try:
+                os.link(src, dst)
+            except OSError:
+                # hardlinks need the stage folder on the same filesystem
+                shutil.copy2(src, dst)
+    return str(staged)
+
+
+@contextmanager
+def upload_source(snapshot_dir: str, package_workers: int, package_cache: str = None):
+    """
+    Yields what to upload for the snapshot folder: a zip file of it built by snapshot_packager, or with
+    package_workers 0 the folder itself, which pybatfish zips in memory
+    """
+    if package_workers == 0:
+        yield snapshot_dir
+        return
+    with tempfile.TemporaryDirectory(dir=Path(snapshot_dir).parent) as package_dir:
+        archive_path = f"{package_dir}/{Path(snapshot_dir).name}.zip"
+        stats = package_snapshot(snapshot_dir, archive_path, package_workers, package_cache)
+        print(f"### Packaged {stats}")
+        yield archive_path
+
+
+def upload_configs(bf, snapshot_dir: str, package_workers: int = None, package_cache: str = None) -> None:
+    """
+    Initializes the snapshot without its show data, as soon as the configurations are collected
+    """
+    with tempfile.TemporaryDirectory(dir=Path(snapshot_dir).parent) as stage_dir, \
+            upload_source(stage_snapshot(snapshot_dir, stage_dir, include_show=False, only_show=False),
+                          package_workers, package_cache) as source:
+        bf.init_snapshot(source, name=Path(snapshot_dir).name)
+
+
+def upload_show(bf, snapshot_dir: str, package_workers: int = None, package_cache: str = None) -> str:
+    """
+    Attaches the show data to the snapshot uploaded with upload_configs, as a fork of it with the show data added.
+    Returns the name of the fork.
+    """
+    snapshot_name = Path(snapshot_dir).name
+    fork_name = f"{snapshot_name}{SHOW_SNAPSHOT_SUFFIX}"
+    with tempfile.TemporaryDirectory(dir=Path(snapshot_dir).parent) as stage_dir, \
+            upload_source(stage_snapshot(snapshot_dir, stage_dir, include_show=True, only_show=True),
+                          package_workers, package_cache) as source:
+        bf.fork_snapshot(snapshot_name, fork_name, add_files=source)
+    return fork_name
+
 
-def main(bf, bf_network: str, snapshot_dir: str) -> None:
+def main(bf, bf_network: str, snapshot_dir: str, part: str = "all", package_workers: int = None,
+         package_cache: str = None) -> None:
+    start_time = time.time()
     bf.set_network(bf_network)
-    bf.init_snapshot(snapshot_dir, name=Path(snapshot_dir).name)
+    if part == "configs":
+        upload_configs(bf, snapshot_dir, package_workers, package_cache)
+        print(f"### Uploaded configurations of {Path(snapshot_dir).name} in {time.time() - start_time:.0f} seconds")
+    elif part == "show":
+        fork_name = upload_show(bf, snapshot_dir, package_workers, package_cache)
+        print(f"### Uploaded show data as {fork_name} in {time.time() - start_time:.0f} seconds")
+    else:
+        with upload_source(snapshot_dir, package_workers, package_cache) as source:
+            bf.init_snapshot(source, name=Path(snapshot_dir).name)
 
 
 if __name__ == "__main__":
@@ -18,6 +107,15 @@ if __name__ == "__main__":
                         help="Absolute path to snapshot directory or zip file", required=True)
     parser.add_argument("--settings", help="Batfish settings file", required=True)
     parser.add_argument("--access-token", help="Batfish Enterprise access token", env_var="BFE_ACCESS_TOKEN")
+    parser.add_argument("--part", help="all uploads the whole snapshot. configs uploads it without the show data, "
+                                       f"which show then attaches as the snapshot <name>{SHOW_SNAPSHOT_SUFFIX}. "
+                                       "Default = all", choices=UPLOAD_PARTS, default="all")
+    parser.add_argument("--package-workers", help="Number of threads compressing the snapshot files into the zip "
+                                                  "file that is uploaded. 0 uploads the folder, zipped in memory by "
+                                                  "pybatfish. Default is one per CPU", type=int, default=None)
+    parser.add_argument("--package-cache", help="Directory to keep compressed snapshot files in, so files that did "
+                                                "not change since an earlier snapshot are not compressed again. "
+                                                "Default is no cache", default=None)
 
     args = parser.parse_args()
     snapshot_path = Path(args.snapshot)
@@ -27,6 +125,8 @@ if __name__ == "__main__":
         raise Exception(f"{snapshot_path} is not a directory")
     elif not Path.joinpath(snapshot_path, "configs").exists():
         raise Exception(f"configs folder not found in {snapshot_path}")
+    elif args.part == "show" and not Path.joinpath(snapshot_path, SHOW_DIR).exists():
+        raise Exception(f"{SHOW_DIR} folder not found in {snapshot_path}")
 
     # Read BF related ENV vars from the env file
     if not Path(args.settings).exists():
@@ -46,4 +146,4 @@ if __name__ == "__main__":
     bf = BfeSession(host=bf_host, port=bfe_port, access_token=args.access_token) if bf_enterprise else BfSession(
         host=bf_host)
 
-    main(bf, bf_network, args.snapshot)
+    main(bf, bf_network, args.snapshot, args.part, args.package_workers, args.package_cache)
@@ -0,0 +1,153 @@
+import re
+from typing import Dict, List, Optional, Text
+
+from collection_helper import parse_genie, LogPayload
+from instrumentation import span
+
+# "BGP neighbor is 10.1.1.1" or "BGP neighbor is 10.1.1.1, vrf CUST-A"
+XR_NEIGHBOR_REGEX = re.compile(r"^BGP neighbor is (?P<neighbor>[^\s,]+)(?:,\s+vrf\s+(?P<vrf>\S+))?\s*$", re.MULTILINE)
+# IOS-XR prints the current time before the output of every show command, "Wed Oct 16 10:00:00.123 UTC"
+XR_TIMESTAMP_REGEX = re.compile(r"^\w{3} \w{3} +\d+ \d+:\d+:\d+(\.\d+)? \S+$")
+
+# "BGP summary information for VRF default, address family IPv4 Unicast"
+NXOS_SUMMARY_VRF_REGEX = re.compile(r"^BGP summary information for VRF (?P<vrf>[^\s,]+), address family", re.MULTILINE)
+# "Neighbor        V    AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd"
+NXOS_SUMMARY_TABLE_REGEX = re.compile(r"^Neighbor\s+V\s+AS\s", re.MULTILINE)
+# "10.0.0.2        4 65001    1234    1234       10    0    0 1d02h    5"
+NXOS_SUMMARY_NEIGHBOR_REGEX = re.compile(r"^(?P<neighbor>\S+)\s+4\s+[\d.]+\s+\d+\s+\d+\s", re.MULTILINE)
+
+
+def _add_neighbor(neighbors: Dict[Text, List[Text]], vrf: Text, neighbor: Text) -> None:
+    vrf_neighbors = neighbors.setdefault(vrf, [])
+    # neighbors show up once per address family
+    if neighbor not in vrf_neighbors:
+        vrf_neighbors.append(neighbor)
+
+
+def extract_xr_neighbors(output: Text) -> Optional[Dict[Text, List[Text]]]:
+    """
+    Extracts the {vrf: [neighbor]} map from IOS-XR "show bgp all all neighbors" or "show bgp vrf all neighbors".
+
+    Returns {"default": []} for an output without neighbors, which has nothing but the timestamp, and None if the
+    output is not recognized.
+    """
+    neighbors = {}
+    for m in XR_NEIGHBOR_REGEX.finditer(output):
+        _add_neighbor(neighbors, m.group("vrf") or "default", m.group("neighbor"))
+    if len(neighbors) != 0:
+        return neighbors
+    if all(line.strip() == "" or XR_TIMESTAMP_REGEX.match(line.strip()) for line in output.splitlines()):
+        return {"default": []}
+    return None
+
+
+def extract_nxos_summary_neighbors(output: Text) -> Optional[Dict[Text, List[Text]]]:
+    """
+    Extracts the {vrf: [neighbor]} map from NX-OS "show bgp vrf all all summary".
+
+    VRFs without a neighbor table map to an empty list. Returns None if the output is not recognized, which
+    includes a neighbor table whose rows do not match.
+    """
+    neighbors = {}
+    vrf_headers = list(NXOS_SUMMARY_VRF_REGEX.finditer(output))
+    if len(vrf_headers) == 0:
+        return None
+    for i, header in enumerate(vrf_headers):
+        section_end = vrf_headers[i + 1].start() if i + 1 < len(vrf_headers) else len(output)
+        neighbors.setdefault(header.group("vrf"), [])
+        rows = list(NXOS_SUMMARY_NEIGHBOR_REGEX.finditer(output, header.end(), section_end))
+        if len(rows) == 0 and NXOS_SUMMARY_TABLE_REGEX.search(output, header.end(), section_end) is not None:
+            return None
+        for m in rows:
+            _add_neighbor(neighbors, header.group("vrf"), m.group("neighbor"))
+    return neighbors
+
+
+def genie_xr_neighbors(parsed_output: Dict) -> Dict[Text, List[Text]]:
+    """
+    Converts the genie parse of the IOS-XR neighbor commands to the {vrf: [neighbor]} map
+    """
+    return {vrf: list(vrf_details.get('neighbor', {}).keys())
+            for vrf, vrf_details in parsed_output['instance']['all']['vrf'].items()}
+
+
+def genie_nxos_summary_neighbors(parsed_output: Dict) -> Dict[Text, List[Text]]:
+    """
+    Converts the genie parse of NX-OS "show bgp vrf all all summary" to the {vrf: [neighbor]} map
+    """
+    return {vrf: list(vrf_details.get('neighbor', {}).keys())
+            for vrf, vrf_details in parsed_output['vrf'].items()}
+
+
+def _nxapi_rows(table: Optional[Dict], row_name: Text) -> List[Dict]:
+    # NX-API JSON has a ROW_ object instead of a list when a table has one row
+    rows = (table or {}).get(row_name, [])
+    return rows if isinstance(rows, list) else [rows]
+
+
+def nxapi_summary_neighbors(output: Dict) -> Dict[Text, List[Text]]:
+    """
+    Extracts the {vrf: [neighbor]} map from the NX-API JSON output of "show bgp vrf all all summary"
+    """
+    neighbors = {}
+    for vrf_row in _nxapi_rows(output.get("TABLE_vrf"), "ROW_vrf"):
+        vrf = vrf_row["vrf-name-out"]
+        neighbors.setdefault(vrf, [])
+        for af_row in _nxapi_rows(vrf_row.get("TABLE_af"), "ROW_af"):
+            for saf_row in _nxapi_rows(af_row.get("TABLE_saf"), "ROW_saf"):
+                for neighbor_row in _nxapi_rows(saf_row.get("TABLE_neighbor"), "ROW_neighbor"):
+                    _add_neighbor(neighbors, vrf, neighbor_row["neighborid"])
+    return neighbors
+
+
+OS_NEIGHBOR_EXTRACTOR = {
+    "iosxr": (extract_xr_neighbors, genie_xr_neighbors),
+    "nxos": (extract_nxos_summary_neighbors, genie_nxos_summary_neighbors),
+}
+# extractors for the JSON output of the discovery commands, from the HTTP API transports
+OS_STRUCTURED_NEIGHBOR_EXTRACTOR = {
+    "nxos": nxapi_summary_neighbors,
+}
+
+
+def get_bgp_neighbors(device_name: Text, output: Text, cmd: Text, device_os: Text, logger) -> Dict[Text, List[Text]]:
+    """
+    Returns the {vrf: [neighbor]} map from BGP neighbor or summary output, using the regex extractor for the OS
+    and falling back to the genie parser if the extractor does not recognize the output.
+    """
+    if output is None:
+        logger.error(f"No CLI output for {cmd} on {device_name}")
+        return {}
+
+    extractor, genie_converter = OS_NEIGHBOR_EXTRACTOR[device_os]
+    with span("parse", parser="regex", command=cmd):
+        neighbors = extractor(output)
+    if neighbors is not None:
+        return neighbors
+
+    logger.info(f"Could not extract BGP neighbors from {cmd} on {device_name}, falling back to genie parser")
+    parsed_output = parse_genie(device_name, output, cmd, device_os, logger)
+    logger.debug("Parsed Command output: %s", LogPayload(parsed_output))
+    if parsed_output is None:
+        return {}
+    try:
+        return genie_converter(parsed_output)
+    except KeyError as e:
+        logger.error(f"Unexpected genie output for {cmd} on {device_name}, missing {e}")
+        return {}
+
+
+def get_structured_bgp_neighbors(device_name: Text, output: Optional[Dict], cmd: Text, device_os: Text,
+                                 logger) -> Dict[Text, List[Text]]:
+    """
+    Returns the {vrf: [neighbor]} map from the JSON output of a BGP neighbor or summary command
+    """
+    if output is None:
+        logger.error(f"No JSON output for {cmd} on {device_name}")
+        return {}
+    try:
+        with span("parse", parser="json", command=cmd):
+            return OS_STRUCTURED_NEIGHBOR_EXTRACTOR[device_os](output)
+    except (KeyError, TypeError, AttributeError) as e:
+        logger.error(f"Unexpected JSON output for {cmd} on {device_name}, {type(e).__name__} {e}")
+        return {}
@@ -0,0 +1,334 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from netmiko.exceptions import NetmikoTimeoutException, NetmikoAuthenticationException, ReadTimeout
+
+from collection_helper import (CollectionStatus, CollectionFailureReason, CollectionRetry, set_retry_deferral,
+                               set_login_gate, release_logger)
+from instrumentation import span, span_context
+
+# login failures that mean the devices or the AAA servers behind them are overloaded
+CONGESTION_EXCEPTIONS = (NetmikoTimeoutException, NetmikoAuthenticationException, ReadTimeout)
+# a login this many times slower than the moving average login time also counts as congestion
+CONGESTION_LATENCY_FACTOR = 4
+LOGIN_TIME_SMOOTHING = 0.2
+# the session limit is cut at most once per this many seconds, so a burst of failures only halves it once
+DECREASE_INTERVAL = 10
+
+# the task a worker thread is running, set in _call_task
+_worker = threading.local()
+
+
+class CollectionTask(object):
+    """
+    One collector function call for one device, as scheduled by the collection engine
+    """
+
+    def __init__(self, name: str, func: Callable, kwargs: Dict, info: tuple = None, group: str = None):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs
+        # information printed about the task if it is still running near the end of the collection
+        self.info = info if info is not None else (name,)
+        # inventory group, for per group session limits
+        self.group = group
+        self.start_time = None
+        self.end_time = None
+        self.retries = 0
+        # set by the scheduler from previous runs, in seconds
+        self.expected_duration = None
+        # set while the task waits to be retried
+        self.retry_time = None
+
+    @property
+    def done(self) -> bool:
+        return self.end_time is not None
+
+
+class LoginRateLimiter(object):
+    """
+    Token bucket that lets at most rate logins per second through, with bursts of up to burst logins
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        if rate <= 0:
+            raise Exception(f"Invalid login rate: {rate}")
+        self._rate = rate
+        self._burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = self._burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+
+
+class ConcurrencyController(object):
+    """
+    Decides when a device may start collection.
+
+    At most max_sessions devices are in flight, and at most group_limits[group] devices of an inventory group.
+    If adaptive, the session limit starts lower and is adjusted like a TCP congestion window from the logins:
+    every successful login raises it, by one in slow start and by 1/limit afterwards, and a login that fails
+    with an auth failure or timeout, or is much slower than the average login, halves it.
+
+    The controller is also the login gate for RetryingNetConnect, which is where the login rate limit is applied,
+    and reserves the additional sessions a collector opens to a device next to its main one.
+    """
+
+    def __init__(self, max_sessions: int, adaptive: bool = False, login_rate: float = 0,
+                 group_limits: Dict[str, int] = None, min_sessions: int = 1):
+        if max_sessions < 1:
+            raise Exception(f"Invalid number of concurrent sessions: {max_sessions}")
+        self.max_sessions = max_sessions
+        self._adaptive = adaptive
+        self._min_sessions = min(min_sessions, max_sessions)
+        self._limit = float(max(self._min_sessions, max_sessions // 4) if adaptive else max_sessions)
+        self._slow_start_threshold = float(max_sessions)
+        self._last_decrease = 0.0
+        self._login_time = None
+        self._group_limits = group_limits if group_limits is not None else {}
+        self._rate_limiter = LoginRateLimiter(login_rate) if login_rate else None
+        self._in_flight = 0
+        self._group_in_flight = {}
+        self._loop = None
+        self._condition = None
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._condition = asyncio.Condition()
+
+    def _can_start(self, group: Optional[str]) -> bool:
+        if self._in_flight >= self.limit:
+            return False
+        group_limit = self._group_limits.get(group)
+        return group_limit is None or self._group_in_flight.get(group, 0) < group_limit
+
+    async def acquire(self, group: Optional[str]) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._can_start(group))
+            self._in_flight += 1
+            self._group_in_flight[group] = self._group_in_flight.get(group, 0) + 1
+
+    async def release(self, group: Optional[str], count: int = 1) -> None:
+        async with self._condition:
+            self._in_flight -= count
+            self._group_in_flight[group] -= count
+            self._condition.notify_all()
+
+    async def _try_acquire(self, group: Optional[str], count: int) -> int:
+        async with self._condition:
+            acquired = 0
+            while acquired < count and self._can_start(group):
+                self._in_flight += 1
+                self._group_in_flight[group] = self._group_in_flight.get(group, 0) + 1
+                acquired += 1
+            return acquired
+
+    def acquire_sessions(self, count: int) -> int:
+        """
+        Called on the worker thread to reserve up to count additional sessions to its device, within the session
+        limit and the limit of the device's inventory group. Returns the number reserved.
+
+        Does not wait for sessions to be released, devices that hold a session while they wait for more could all
+        end up waiting for each other.
+        """
+        if self._loop is None:
+            return count
+        task = getattr(_worker, "task", None)
+        group = task.group if task is not None else None
+        return asyncio.run_coroutine_threadsafe(self._try_acquire(group, count), self._loop).result()
+
+    def release_sessions(self, count: int) -> None:
+        """
+        Called on the worker thread to release sessions reserved with acquire_sessions
+        """
+        if self._loop is None or count == 0:
+            return
+        task = getattr(_worker, "task", None)
+        group = task.group if task is not None else None
+        asyncio.run_coroutine_threadsafe(self.release(group, count), self._loop).result()
+
+    def wait(self) -> None:
+        """
+        Called on the worker thread before every login
+        """
+        if self._rate_limiter is not None:
+            self._rate_limiter.wait()
+
+    def report(self, seconds: float, exc: Optional[Exception]) -> None:
+        """
+        Called on the worker thread after every login
+        """
+        if self._adaptive and self._loop is not None:
+            self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._on_login(seconds, exc)))
+
+    async def _on_login(self, seconds: float, exc: Optional[Exception]) -> None:
+        congested = isinstance(exc, CONGESTION_EXCEPTIONS)
+        if exc is None:
+            if self._login_time is None:
+                self._login_time = seconds
+            congested = seconds > self._login_time * CONGESTION_LATENCY_FACTOR
+            self._login_time += LOGIN_TIME_SMOOTHING * (seconds - self._login_time)
+
+        if congested:
+            if time.time() - self._last_decrease < DECREASE_INTERVAL:
+                return
+            self._last_decrease = time.time()
+            self._limit = max(self._min_sessions, self._limit / 2)
+            self._slow_start_threshold = self._limit
+            print(f"Login congestion ({exc or f'{seconds:.1f} second login'}), "
+                  f"reducing concurrent sessions to {self.limit}")
+        elif exc is None:
+            self._limit += 1 if self._limit < self._slow_start_threshold else 1 / self._limit
+            self._limit = min(self._limit, self.max_sessions)
+            async with self._condition:
+                self._condition.notify_all()
+
+
+def parse_group_limits(group_limits: List[str]) -> Dict[str, int]:
+    """
+    Parses per group session limits given as group:limit
+    """
+    limits = {}
+    for group_limit in group_limits or []:
+        group, sep, limit = group_limit.rpartition(":")
+        if sep == "" or not limit.isdigit() or int(limit) < 1:
+            raise Exception(f"Invalid group limit {group_limit}, expected group:limit")
+        limits[group] = int(limit)
+    return limits
+
+
+def _exception_status(task: CollectionTask, exc: Exception) -> Dict:
+    """
+    Status dict for a collector function that raised instead of returning a status
+    """
+    return {
+        "name": task.name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "failed_commands": ["All"],
+        "message": f"Collection failed. Exception {exc}",
+    }
+
+
+def _call_task(task: CollectionTask, defer_retries: bool) -> Dict:
+    set_retry_deferral(defer_retries)
+    _worker.task = task
+    try:
+        with span_context(device=task.name, inventory_group=task.group), span("device", attempt=task.retries + 1):
+            return task.func(**task.kwargs)
+    finally:
+        _worker.task = None
+        set_retry_deferral(False)
+
+
+async def _run_task(task: CollectionTask, controller: ConcurrencyController, executor: ThreadPoolExecutor,
+                    max_retries: int, retry_backoff: float) -> Dict:
+    loop = asyncio.get_running_loop()
+    while True:
+        # the last attempt waits on the worker thread before retrying, like collector functions called directly
+        defer_retries = task.retries < max_retries
+        await controller.acquire(task.group)
+        try:
+            if task.start_time is None:
+                task.start_time = time.time()
+            task.retry_time = None
+            # netmiko is blocking, so the collector function itself runs on an executor thread. The event loop
+            # only decides when a device gets to start, which is what keeps the number of sessions bounded.
+            result = await loop.run_in_executor(executor, functools.partial(_call_task, task, defer_retries))
+        except CollectionRetry as e:
+            delay = e.delay * retry_backoff ** task.retries
+            task.retries += 1
+            task.retry_time = time.time() + delay
+            print(f"Retrying {task.name} in {delay:.0f} seconds, attempt {task.retries + 1}")
+        except Exception as e:
+            result = _exception_status(task, e)
+            break
+        else:
+            break
+        finally:
+            # the session is released while the task waits, so other devices can use it
+            await controller.release(task.group)
+        await asyncio.sleep(delay)
+    task.end_time = time.time()
+    if task.kwargs.get("logger") is not None:
+        # the device is done, close its log file
+        release_logger(task.kwargs["logger"].name)
+    return result
+
+
+async def _report_progress(tasks: List[CollectionTask], controller: ConcurrencyController, interval: int,
+                           stuck_threshold: int) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        remaining = [task for task in tasks if not task.done]
+        if len(remaining) == 0:
+            return
+        elif len(remaining) < stuck_threshold:
+            # only a few devices left, some might be stuck, print information about them
+            for task in remaining:
+                if task.retry_time is not None:
+                    print(f"{task.info} waiting to retry in {task.retry_time - time.time():.0f} seconds")
+                else:
+                    print(f"{task.info}")
+        elif controller.limit != controller.max_sessions:
+            print(f"{len(remaining)} devices remaining, {controller.limit} concurrent sessions")
+
+
+async def _run_collection(tasks: List[CollectionTask], controller: ConcurrencyController, progress_interval: int,
+                          stuck_threshold: int, max_retries: int, retry_backoff: float) -> List[Dict]:
+    controller.start(asyncio.get_running_loop())
+    with ThreadPoolExecutor(controller.max_sessions) as executor:
+        monitor = None
+        if progress_interval:
+            monitor = asyncio.ensure_future(_report_progress(tasks, controller, progress_interval, stuck_threshold))
+        try:
+            results = await asyncio.gather(*[_run_task(task, controller, executor, max_retries, retry_backoff)
+                                             for task in tasks])
+        finally:
+            if monitor is not None:
+                monitor.cancel()
+    return list(results)
+
+
+def run_collection(tasks: List[CollectionTask], max_sessions: int, progress_interval: int = 0,
+                   stuck_threshold: int = 10, max_retries: int = 2, retry_backoff: float = 2,
+                   controller: ConcurrencyController = None) -> List[Dict]:
+    """
+    Run all collection tasks with at most max_sessions devices in flight. An asyncio event loop decides when each
+    task starts, and the collector functions run on a pool of max_sessions worker threads.
+
+    A collector that needs to wait before retrying a device raises CollectionRetry, and the task is started again
+    after the delay, multiplied by retry_backoff for every previous retry, without holding a session slot.
+    After max_retries the collector waits on its worker thread instead.
+
+    If a controller is passed in, it decides when devices start instead of the fixed max_sessions limit.
+
+    Returns the status dicts from the collector functions in the same order as tasks.
+    """
+    if controller is None:
+        controller = ConcurrencyController(max_sessions)
+    set_login_gate(controller)
+    try:
+        return asyncio.run(_run_collection(tasks, controller, progress_interval, stuck_threshold, max_retries,
+                                           retry_backoff))
+    finally:
+        set_login_gate(None)
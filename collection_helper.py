@@ -1,9 +1,23 @@
 import os
+import codecs
+import functools
+import gzip
+import io
+import multiprocessing
 import socket
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from time import sleep
 from typing import Text, Dict, List
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import paramiko
+import scp
 import yaml
 from netmiko import ConnectHandler
 from netmiko.exceptions import NetmikoTimeoutException, NetmikoAuthenticationException, ReadTimeout
@@ -15,11 +29,46 @@ from genie.conf.base import Device
 from genie.libs.parser.utils import get_parser
 from attrdict import AttrDict
 
+from instrumentation import span, set_span_tags, spans_enabled, get_span_tags, span_context
+
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 A10_PARTITION_TTP_TEMPLATE = f"{SCRIPT_DIR}/ttp_templates/acos_show_partition.ttp"
 A10_VERSION_TTP_TEMPLATE = f"{SCRIPT_DIR}/ttp_templates/acos_show_version.ttp"
 
+# streaming capture reads the channel in chunks and keeps only this much of the tail in memory,
+# which has to be large enough to hold the device prompt
+STREAM_HOLDBACK_CHARS = 4096
+STREAM_READ_INTERVAL = 0.1  # seconds to wait when the channel has no data
+LINEFEED_REGEX = re.compile("(\r\r\r\n|\r\r\n|\r\n|\n\r|\r)")
+EXEC_CHANNEL_OPEN_TIMEOUT = 30  # seconds to wait for the device to open an exec channel
+EXEC_READ_SIZE = 65536
+# files fetched at once over SFTP or SCP channels of a device's SSH transport
+FILE_TRANSFER_CHANNELS = 4
+
+# set with set_object_store to deduplicate collected files across snapshots
+_OBJECT_STORE = None
+
+# set with start_genie_parse_pool to move genie parsing off the SSH worker threads
+_GENIE_PARSE_POOL = None
+# worker processes for genie parsing unless the collectors are told otherwise
+DEFAULT_GENIE_WORKERS = 2
+_genie_devices = threading.local()
+
+# set with set_retry_deferral on the threads the collection engine runs collector functions on
+_retry_deferral = threading.local()
+
+# set with set_login_gate to pace logins and observe how they go
+_LOGIN_GATE = None
+
+# per device log files are written by one thread, started by the first custom_logger call
+_LOG_WRITER = None
+_log_writer_lock = threading.Lock()
+# at most this much of a command output goes into a debug log message
+LOG_PAYLOAD_CHARS = 4096
+# bytes of each session log kept by the truncated session log policy
+SESSION_LOG_MAX_BYTES = 1024 * 1024
+
 
 class CollectionStatus(Enum):
     PASS = 1
@@ -34,6 +83,17 @@ class CollectionFailureReason(Enum):
     READ_TIMEOUT = 4
     OTHER = 5
 
+
+class SessionLogPolicy(Enum):
+    FULL = "full"
+    TRUNCATED = "truncated"
+    COMPRESSED = "compressed"
+    OFF = "off"
+
+
+# set with set_session_log_policy
+_SESSION_LOG_POLICY = SessionLogPolicy.FULL
+
 AnsibleOsToNetmikoOs = {
     "arista.eos.eos": "arista_eos",
     "acos": "a10",
@@ -47,20 +107,140 @@ AnsibleOsToNetmikoOs = {
 }
 
 
+# ansible_connection of devices that do not set one, SSH CLI sessions
+DEFAULT_ANSIBLE_CONNECTION = "network_cli"
+# ports of the ansible_connection transports that do not use the SSH port
+CONNECTION_DEFAULT_PORT = {
+    "netconf": 830,
+    "httpapi": 443,
+}
+# port of httpapi devices with ansible_httpapi_use_ssl: false
+HTTPAPI_PLAIN_PORT = 80
+
+
+class CollectionRetry(Exception):
+    """
+    Raised instead of sleeping before a retry when retry deferral is enabled, so the collection engine can
+    reschedule the device after delay seconds and use the worker for other devices in the meantime
+    """
+
+    def __init__(self, device_name: str, delay: int, message: str = ""):
+        super().__init__(f"Retry {device_name} in {delay} seconds. {message}")
+        self.device_name = device_name
+        self.delay = delay
+
+
+class ExecChannelUnavailable(Exception):
+    """
+    Raised when a device does not open an exec channel next to the interactive session
+    """
+
+
+class FileTransferUnavailable(Exception):
+    """
+    Raised when a device serves neither SFTP nor SCP next to the interactive session
+    """
+
+
+def set_retry_deferral(enabled: bool) -> None:
+    _retry_deferral.enabled = enabled
+
+
+def wait_before_retry(device_name: str, delay: int, message: str = "") -> None:
+    """
+    Waits delay seconds before a retry, or raises CollectionRetry if retry deferral is enabled on this thread
+    """
+    if getattr(_retry_deferral, "enabled", False):
+        raise CollectionRetry(device_name, delay, message)
+    sleep(delay)
+
+
+def close_connection(net_connect, logger) -> None:
+    """
+    Closes a device session, logging the exception if closing it fails
+    """
+    try:
+        net_connect.close()
+    except Exception as e:
+        logger.exception(f"Exception when closing connection: {str(e)}")
+
+
+def set_login_gate(login_gate) -> None:
+    """
+    Sets the object every SSH login goes through. login_gate.wait() is called before the login and
+    login_gate.report(seconds, exception) after it, with exception None if the login succeeded.
+
+    Additional sessions to a device are reserved with login_gate.acquire_sessions(count), which returns the number
+    reserved, and released with login_gate.release_sessions(count).
+    """
+    global _LOGIN_GATE
+    _LOGIN_GATE = login_gate
+
+
+def acquire_sessions(count: int) -> int:
+    """
+    Reserves up to count sessions to the device of this worker thread, next to its main session, with the login
+    gate if one is set. Returns the number of sessions that may be opened, which is released with
+    release_sessions.
+    """
+    login_gate = _LOGIN_GATE
+    if login_gate is None:
+        return count
+    return login_gate.acquire_sessions(count)
+
+
+def release_sessions(count: int) -> None:
+    login_gate = _LOGIN_GATE
+    if login_gate is not None:
+        login_gate.release_sessions(count)
+
+
+def gated_login(open_connection):
+    """
+    Logs in to a device with open_connection() through the login gate, if one is set, and returns the connection
+    """
+    login_gate = _LOGIN_GATE
+    if login_gate is None:
+        return open_connection()
+
+    login_gate.wait()
+    start_time = time.time()
+    try:
+        connection = open_connection()
+    except Exception as exc:
+        login_gate.report(time.time() - start_time, exc)
+        raise
+    login_gate.report(time.time() - start_time, None)
+    return connection
+
+
 class RetryingNetConnect(object):
 
     def __init__(self, device_name: str, device_session: Dict, logger_name: str):
         self._device_name = device_name
         self._device_session = device_session
         self._logger = logging.getLogger(logger_name)
+        # opened on the first connection and kept across reconnects
+        self._session_log = None
+        set_span_tags(device=device_name, os=device_session.get("device_type"))
+        try:
+            self._login()
+        except Exception:
+            # close() is never called without a connection, a deferred retry would leave the session log open
+            self._close_session_log()
+            raise
+        self._base_prompt = self._net_connect.base_prompt
+        self._logger.info(f"Netmiko prompt: {self._net_connect.base_prompt}")
+
+    def _login(self) -> None:
         try:
-            self._net_connect = ConnectHandler(**self._device_session, encoding='utf-8')
+            self._net_connect = self._connect()
         except NetmikoTimeoutException as exc:
             if "Pattern not detected" in str(exc):
                 self._logger.error(f"Device {self._device_name} didn't return prompt in 20 seconds, re-trying connection in 60 seconds")
-                sleep(60)  # wait 60 seconds before retrying
+                wait_before_retry(self._device_name, 60, str(exc))  # wait 60 seconds before retrying
                 try:
-                    self._net_connect = ConnectHandler(**self._device_session, encoding='utf-8')
+                    self._net_connect = self._connect()
                 except Exception as exc:
                     self._logger.exception(f"2nd attempt at connecting failed, skipping device {self._device_name}.")
                     raise
@@ -70,9 +250,9 @@ class RetryingNetConnect(object):
         except ReadTimeout as exc:
             if "Pattern not detected" in str(exc):
                 self._logger.error(f"Device {self._device_name} didn't return prompt in 20 seconds, re-trying connection in 60 seconds")
-                sleep(60)  # wait 60 seconds before retrying
+                wait_before_retry(self._device_name, 60, str(exc))  # wait 60 seconds before retrying
                 try:
-                    self._net_connect = ConnectHandler(**self._device_session, encoding='utf-8')
+                    self._net_connect = self._connect()
                 except Exception as exc:
                     self._logger.exception(f"2nd attempt at connecting failed, skipping device {self._device_name}.")
                     raise
@@ -80,40 +260,64 @@ class RetryingNetConnect(object):
                 self._logger.exception(f"Skipped data collection for {self._device_name}, could not connect")
                 raise
         except socket.error:
-            self._logger.exception(f"Socket error for {cmd} to {self._device_name}")
+            self._logger.exception(f"Socket error connecting to {self._device_name}")
             # wait 60 seconds and then try to re-establish a new SSH session
-            sleep(60)
+            wait_before_retry(self._device_name, 60, "Socket error")
             try:
-                self._net_connect = ConnectHandler(**self._device_session, encoding='utf-8')
+                self._net_connect = self._connect()
             except Exception:
                 self._logger.exception(f"Could not reconnect to {self._device_name}")
                 raise
         except Exception:
             self._logger.exception(f"Connection to {self._device_name} failed")
             raise
-        else:
-            self._base_prompt = self._net_connect.base_prompt
-            self._logger.info(f"Netmiko prompt: {self._net_connect.base_prompt}")
+
+    def _connect(self):
+        return gated_login(self._open_connection)
+
+    def _connection_params(self) -> Dict:
+        params = dict(self._device_session)
+        session_log_file = params.pop("session_log", None)
+        if self._session_log is None and session_log_file is not None:
+            self._session_log = open_session_log(session_log_file)
+        params["session_log"] = self._session_log
+        return params
+
+    def _open_connection(self):
+        if not spans_enabled():
+            return ConnectHandler(**self._connection_params(), encoding='utf-8')
+
+        # the same steps as netmiko's BaseConnection._open, timed separately. The SSH handshake and authentication
+        # both happen in establish_connection, prompt detection in session preparation.
+        net_connect = ConnectHandler(**self._connection_params(), encoding='utf-8', auto_connect=False)
+        with span("connect"):
+            net_connect._modify_connection_params()
+            net_connect.establish_connection()
+        with span("session_preparation"):
+            net_connect._try_session_preparation()
+        return net_connect
 
     def run_command(self, cmd: str, cmd_timer: int, pattern=None):
         try:
             self._logger.info(f"Using {pattern} as expect_string")
-            _output = self._net_connect.send_command(cmd, read_timeout=cmd_timer, strip_command=True,
-                                                     expect_string=pattern)
+            with span("run_command", command=cmd):
+                _output = self._net_connect.send_command(cmd, read_timeout=cmd_timer, strip_command=True,
+                                                         expect_string=pattern)
         except socket.error:
             self._logger.exception(f"Socket error for {cmd} to {self._device_name}")
             # wait 60 seconds and then try to re-establish a new SSH session
-            sleep(60)
+            wait_before_retry(self._device_name, 60, f"Socket error for {cmd}")
             try:
-                self._net_connect = ConnectHandler(**self._device_session, encoding='utf-8')
+                self._net_connect = self._connect()
             except Exception:
                 self._logger.exception(f"Could not reconnect to {self._device_name}")
                 raise
             else:
                 try:
                     self._logger.info("Connection re-established, re-trying previous command")
-                    _output = self._net_connect.send_command(cmd, read_timeout=cmd_timer, strip_command=True,
-                                                             expect_string=pattern)
+                    with span("run_command", command=cmd):
+                        _output = self._net_connect.send_command(cmd, read_timeout=cmd_timer, strip_command=True,
+                                                                 expect_string=pattern)
                 except Exception as exc:
                     self._logger.exception(f"Command {cmd} to {self._device_name} failed")
                     return None
@@ -124,9 +328,211 @@ class RetryingNetConnect(object):
             #todo: determine if we should return None instead of the pass statement
             pass
         else:
-            self._logger.debug(f"Output of {cmd} to {self._device_name}: {_output}")
+            self._logger.debug("Output of %s to %s: %s", cmd, self._device_name, LogPayload(_output))
             return _output
 
+    def _stream_command(self, cmd: str, cmd_timer: int, out_file, pattern=None) -> None:
+        """
+        Send a command and write its output to out_file as it arrives, until the prompt is seen
+        """
+        if pattern is None:
+            # same default as netmiko send_command, the current prompt, but it must end the output
+            search_pattern = re.compile(re.escape(self._net_connect.find_prompt()) + r"\s*$")
+        else:
+            search_pattern = re.compile(pattern)
+
+        self._net_connect.clear_buffer()
+        self._net_connect.write_channel(self._net_connect.normalize_cmd(cmd))
+
+        pending = ""
+        command_stripped = False
+        deadline = time.time() + cmd_timer
+        while True:
+            chunk = self._net_connect.read_channel()
+            if not chunk:
+                if time.time() > deadline:
+                    raise ReadTimeout(f"Pattern not detected: {search_pattern.pattern} in output of {cmd}")
+                sleep(STREAM_READ_INTERVAL)
+                continue
+
+            pending += chunk
+            # a trailing carriage return could be the first half of a \r\n split across chunks
+            trailer = "\r" if pending.endswith("\r") else ""
+            pending = LINEFEED_REGEX.sub("\n", pending[:len(pending) - len(trailer)]) + trailer
+            if not command_stripped:
+                # drop the echoed command, like strip_command does for send_command
+                if "\n" not in pending:
+                    continue
+                first_line, pending = pending.split("\n", 1)
+                if cmd.strip() not in first_line:
+                    pending = f"{first_line}\n{pending}"
+                command_stripped = True
+
+            match = search_pattern.search(pending)
+            if match is not None:
+                # drop the prompt line, like strip_prompt does for send_command
+                out_file.write(pending[:match.start()].rsplit("\n", 1)[0])
+                return
+
+            # keep the tail in memory since the prompt could be split across chunks
+            if len(pending) > STREAM_HOLDBACK_CHARS:
+                out_file.write(pending[:-STREAM_HOLDBACK_CHARS])
+                pending = pending[-STREAM_HOLDBACK_CHARS:]
+
+    def stream_command(self, cmd: str, cmd_timer: int, file_path: str, pattern=None, prepend_text=None) -> bool:
+        """
+        Run a command and stream its output to file_path, so memory use does not depend on the size of the output.
+
+        Returns False if the command failed, in which case the file content is not the command output.
+        """
+        def _stream():
+            with span("stream_command", command=cmd), open(file_path, "w") as f:
+                if prepend_text is not None:
+                    f.write(prepend_text)
+                    f.write("\n")
+                self._stream_command(cmd, cmd_timer, f, pattern)
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            self._logger.info(f"Streaming output of {cmd} to {file_path}")
+            _stream()
+        except socket.error:
+            self._logger.exception(f"Socket error for {cmd} to {self._device_name}")
+            # wait 60 seconds and then try to re-establish a new SSH session
+            wait_before_retry(self._device_name, 60, f"Socket error for {cmd}")
+            try:
+                self._net_connect = self._connect()
+            except Exception:
+                self._logger.exception(f"Could not reconnect to {self._device_name}")
+                raise
+            else:
+                try:
+                    self._logger.info("Connection re-established, re-trying previous command")
+                    _stream()
+                except Exception:
+                    self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+                    return False
+        except Exception:
+            self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+            return False
+        return True
+
+    def _exec_command(self, cmd: str, cmd_timer: int, out_file) -> None:
+        """
+        Run a command on a new exec channel of the SSH transport and write its output to out_file as it arrives
+        """
+        remote_conn_pre = getattr(self._net_connect, "remote_conn_pre", None)
+        if not isinstance(remote_conn_pre, paramiko.SSHClient) or remote_conn_pre.get_transport() is None:
+            raise ExecChannelUnavailable(f"No SSH transport for {self._device_name}")
+        try:
+            channel = remote_conn_pre.get_transport().open_session(timeout=EXEC_CHANNEL_OPEN_TIMEOUT)
+        except (paramiko.SSHException, EOFError) as e:
+            raise ExecChannelUnavailable(f"{self._device_name} did not open an exec channel: {e}")
+
+        try:
+            try:
+                channel.exec_command(cmd)
+            except paramiko.SSHException as e:
+                raise ExecChannelUnavailable(f"{self._device_name} refused exec request: {e}")
+            channel.settimeout(cmd_timer)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            pending = ""
+            while True:
+                data = channel.recv(EXEC_READ_SIZE)
+                pending += decoder.decode(data, final=not data)
+                # a trailing carriage return could be the first half of a \r\n split across chunks
+                trailer = "\r" if pending.endswith("\r") and data else ""
+                out_file.write(LINEFEED_REGEX.sub("\n", pending[:len(pending) - len(trailer)]))
+                pending = trailer
+                if not data:
+                    break
+            exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if exit_status != 0:
+            raise Exception(f"{cmd} exited with status {exit_status}")
+
+    def exec_command(self, cmd: str, cmd_timer: int) -> str:
+        """
+        Run a command on its own exec channel, so several commands can run at once next to the interactive
+        session. There is no retry, the caller can run a command that failed with run_command.
+
+        Raises ExecChannelUnavailable if the device does not allow exec channels.
+        """
+        self._logger.info(f"Running {cmd} on an exec channel")
+        output = io.StringIO()
+        with span("run_command", command=cmd, channel="exec"):
+            self._exec_command(cmd, cmd_timer, output)
+        return output.getvalue()
+
+    def stream_exec_command(self, cmd: str, cmd_timer: int, file_path: str) -> None:
+        """
+        Like exec_command, but the output is streamed to file_path
+        """
+        self._logger.info(f"Streaming output of {cmd} on an exec channel to {file_path}")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with span("stream_command", command=cmd, channel="exec"), open(file_path, "w") as f:
+            self._exec_command(cmd, cmd_timer, f)
+
+    def _sftp_fetch(self, transport: paramiko.Transport, path: Text, cmd_timer: int) -> bytes:
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except (paramiko.SSHException, EOFError) as e:
+            raise FileTransferUnavailable(f"{self._device_name} did not open an SFTP channel: {e}")
+        try:
+            sftp.get_channel().settimeout(cmd_timer)
+            with sftp.open(path, "rb") as f:
+                # pipeline the read requests instead of waiting for each block
+                f.prefetch()
+                return f.read()
+        finally:
+            sftp.close()
+
+    def _scp_fetch(self, transport: paramiko.Transport, path: Text, cmd_timer: int) -> bytes:
+        # the paths are not from user input, and some SCP servers, like IOS, do not unquote them
+        scp_client = scp.SCPClient(transport, socket_timeout=cmd_timer, sanitize=lambda remote_path: remote_path)
+        with tempfile.TemporaryDirectory() as local_dir:
+            local_path = os.path.join(local_dir, "file")
+            try:
+                scp_client.get(path, local_path)
+            finally:
+                scp_client.close()
+            with open(local_path, "rb") as f:
+                return f.read()
+
+    def _fetch_file(self, transport: paramiko.Transport, path: Text, cmd_timer: int) -> bytes:
+        with span("transfer_file", file=path):
+            try:
+                return self._sftp_fetch(transport, path, cmd_timer)
+            except FileTransferUnavailable as e:
+                self._logger.info(f"{e}, trying SCP")
+            try:
+                return self._scp_fetch(transport, path, cmd_timer)
+            except paramiko.SSHException as e:
+                raise FileTransferUnavailable(f"{self._device_name} did not open an SCP channel: {e}")
+
+    def fetch_files(self, paths: List[Text], cmd_timer: int) -> List[bytes]:
+        """
+        Fetch files from the device over SFTP, or SCP if the device has no SFTP server, on channels of the SSH
+        transport of the interactive session. Up to FILE_TRANSFER_CHANNELS files are fetched at once.
+
+        Returns the file contents in the order of paths. Raises FileTransferUnavailable if the device serves neither
+        protocol.
+        """
+        remote_conn_pre = getattr(self._net_connect, "remote_conn_pre", None)
+        if not isinstance(remote_conn_pre, paramiko.SSHClient) or remote_conn_pre.get_transport() is None:
+            raise FileTransferUnavailable(f"No SSH transport for {self._device_name}")
+        transport = remote_conn_pre.get_transport()
+        self._logger.info(f"Fetching {paths} from {self._device_name}")
+        span_tags = get_span_tags()
+
+        def _fetch(path: Text) -> bytes:
+            with span_context(**span_tags):
+                return self._fetch_file(transport, path, cmd_timer)
+
+        with ThreadPoolExecutor(min(len(paths), FILE_TRANSFER_CHANNELS)) as pool:
+            return list(pool.map(_fetch, paths))
+
     def enable(self):
         try:
             self._net_connect.enable()
@@ -134,39 +540,202 @@ class RetryingNetConnect(object):
             self._logger.exception(f"Failed to enter enable mode at {self._device_name}")
             pass  # still want to try to run commands outside of enable mode
 
+    def _close_session_log(self) -> None:
+        # netmiko only closes session logs it opened itself
+        if isinstance(self._session_log, io.IOBase):
+            self._session_log.close()
+
     def close(self):
-        self._net_connect.disconnect()
+        try:
+            self._net_connect.disconnect()
+        finally:
+            self._close_session_log()
+
+
+class TruncatedSessionLog(io.BufferedIOBase):
+    """
+    Session log file that keeps the first max_bytes of the session, which has the login and the first commands
+    """
+
+    def __init__(self, file_name: Text, max_bytes: int):
+        super().__init__()
+        self._file = open(file_name, "wb")
+        self._remaining = max_bytes
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self._remaining > 0:
+            if len(data) > self._remaining:
+                self._file.write(data[:self._remaining])
+                self._file.write(b"\n... session log truncated ...\n")
+                self._remaining = 0
+            else:
+                self._file.write(data)
+                self._remaining -= len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def set_session_log_policy(policy: SessionLogPolicy) -> None:
+    global _SESSION_LOG_POLICY
+    _SESSION_LOG_POLICY = policy
+
+
+def open_session_log(file_name: Text):
+    """
+    Returns the session_log argument for netmiko for the session log policy: the file name for a full log, a file
+    object for a truncated or compressed log and None if session logs are off
+    """
+    if _SESSION_LOG_POLICY == SessionLogPolicy.OFF:
+        return None
+    if _SESSION_LOG_POLICY == SessionLogPolicy.TRUNCATED:
+        return TruncatedSessionLog(file_name, SESSION_LOG_MAX_BYTES)
+    if _SESSION_LOG_POLICY == SessionLogPolicy.COMPRESSED:
+        # fast compression, the session log is written as the output arrives
+        return gzip.open(f"{file_name}.gz", "wb", compresslevel=1)
+    return file_name
+
+
+class LogPayload(object):
+    """
+    Command output passed as a log message argument, so it is only formatted, and truncated to LOG_PAYLOAD_CHARS,
+    if the message is logged
+    """
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def __str__(self):
+        text = str(self._payload)
+        if len(text) <= LOG_PAYLOAD_CHARS:
+            return text
+        return f"{text[:LOG_PAYLOAD_CHARS]}... ({len(text) - LOG_PAYLOAD_CHARS} more characters)"
+
+
+class _LoggerRouter(logging.Handler):
+    """
+    Runs on the log writer thread and hands every record to the handlers of the logger it was logged to.
+
+    Handlers are added and closed through the queue as well, so everything logged before release_logger is written
+    before the log file is closed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._handlers = {}
+
+    def handle(self, record):
+        action = getattr(record, "router_action", None)
+        if action is not None:
+            for handler in self._handlers.pop(record.name, []):
+                handler.close()
+            if action == "add":
+                self._handlers[record.name] = record.router_handlers
+            return
+        for handler in self._handlers.get(record.name, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def emit(self, record):
+        pass
+
+    def logger_names(self) -> List[Text]:
+        return list(self._handlers.keys())
+
+    def close(self):
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler.close()
+        self._handlers = {}
+        super().close()
+
+
+def _get_log_writer() -> QueueListener:
+    global _LOG_WRITER
+    with _log_writer_lock:
+        if _LOG_WRITER is None:
+            _LOG_WRITER = QueueListener(queue.SimpleQueue(), _LoggerRouter())
+            _LOG_WRITER.start()
+        return _LOG_WRITER
+
+
+def _remove_queue_handlers(logger: logging.Logger) -> None:
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+
+
+def stop_log_writer() -> None:
+    """
+    Writes out the queued log records and closes all log files
+    """
+    global _LOG_WRITER
+    with _log_writer_lock:
+        if _LOG_WRITER is None:
+            return
+        _LOG_WRITER.stop()
+        router = _LOG_WRITER.handlers[0]
+        for logger_name in router.logger_names():
+            _remove_queue_handlers(logging.getLogger(logger_name))
+        router.close()
+        _LOG_WRITER = None
 
 
 def custom_logger(logger_name, log_file, console_log_level):
     """
-    Method to return a custom logger with the given name and level
+    Method to return a custom logger with the given name and level.
+
+    The logger only queues records, they are formatted and written to the console and log_file by the log writer
+    thread. Call release_logger when done with the logger to close log_file.
     """
     logger = logging.getLogger(logger_name)
 
-    # to use different levels per handler the logger's level should be lower than either
-    # we set it to DEBUG, the lowest value
-    logger.setLevel(logging.DEBUG)
+    # to use different levels per handler the logger's level should be lower than either, anything below both
+    # is dropped by the logger before the message is formatted
+    logger.setLevel(min(console_log_level, logging.INFO))
 
     format_string = '%(levelname)s:%(asctime)s %(message)s'
     datefmt_string = '%m/%d/%Y %I:%M:%S %p'
     log_format = logging.Formatter(fmt=format_string, datefmt=datefmt_string)
 
-    # Creating and adding the console handler
+    # Creating the console handler
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(log_format)
     console_handler.setLevel(console_log_level)
-    logger.addHandler(console_handler)
 
-    # Creating and adding the file handler
-    file_handler = logging.FileHandler(log_file, mode='a')
+    # Creating the file handler, the file is opened by the log writer thread when the first record is written
+    file_handler = logging.FileHandler(log_file, mode='a', delay=True)
     file_handler.setFormatter(log_format)
     file_handler.setLevel(logging.INFO)  # always want detail in log files
-    logger.addHandler(file_handler)
+
+    log_writer = _get_log_writer()
+    log_writer.queue.put_nowait(logging.makeLogRecord({"name": logger_name, "router_action": "add",
+                                                       "router_handlers": [console_handler, file_handler]}))
+    _remove_queue_handlers(logger)
+    logger.addHandler(QueueHandler(log_writer.queue))
 
     return logger
 
 
+def release_logger(logger_name: Text) -> None:
+    """
+    Closes the log file of a logger from custom_logger once the records already logged to it are written
+    """
+    _remove_queue_handlers(logging.getLogger(logger_name))
+    log_writer = _LOG_WRITER
+    if log_writer is not None:
+        log_writer.queue.put_nowait(logging.makeLogRecord({"name": logger_name, "router_action": "release"}))
+
+
 def get_inventory(inventory_file: Text) -> Dict:
     with open(inventory_file) as f:
         inventory = yaml.safe_load(f)
@@ -177,6 +746,69 @@ def get_inventory(inventory_file: Text) -> Dict:
     return inventory['all']['children']
 
 
+def get_host_var(group_vars: Dict, device_vars: Dict, name: Text, default=None):
+    """
+    An inventory variable of a device, host variables override group variables
+    """
+    if device_vars is not None and device_vars.get(name, None) is not None:
+        return device_vars.get(name)
+    return (group_vars or {}).get(name, default)
+
+
+def get_ansible_connection(group_vars: Dict, device_vars: Dict) -> Text:
+    """
+    The ansible_connection of a device, host variables override group variables
+    """
+    return get_host_var(group_vars, device_vars, "ansible_connection", DEFAULT_ANSIBLE_CONNECTION)
+
+
+def _inventory_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ["true", "yes", "on", "1"]
+    return bool(value)
+
+
+def get_device_session(device_os: Text, device_name: Text, device_vars: Dict, username: Text, password: Text,
+                       session_log: Text, logger, connection: Text = DEFAULT_ANSIBLE_CONNECTION,
+                       group_vars: Dict = None) -> Dict:
+    """
+    Build the netmiko connection handler arguments for a device from its inventory variables.
+
+    httpapi devices get the use_ssl and validate_certs settings of their ansible_httpapi_* variables instead of
+    the SSH port.
+    """
+    # by default use the device name specified in inventory
+    _host = device_name
+    # override it with the IP address if specified in the inventory
+    if device_vars is not None and device_vars.get("ansible_host", None) is not None:
+        _host = device_vars.get("ansible_host")
+        logger.info(f"Using IP {_host} to connect to {device_name}")
+
+    device_session = {
+        "device_type": device_os,
+        "host": _host,
+        "username": username,
+        "password": password,
+        "session_log": session_log,
+        "fast_cli": False
+    }
+    if connection == "httpapi":
+        # the Ansible defaults, except for use_ssl since eAPI and NX-API are usually only served over HTTPS
+        device_session["use_ssl"] = _inventory_bool(get_host_var(group_vars, device_vars,
+                                                                 "ansible_httpapi_use_ssl", True))
+        device_session["validate_certs"] = _inventory_bool(get_host_var(group_vars, device_vars,
+                                                                        "ansible_httpapi_validate_certs", True))
+        port = get_host_var(group_vars, device_vars, "ansible_httpapi_port")
+        if port is None:
+            port = CONNECTION_DEFAULT_PORT["httpapi"] if device_session["use_ssl"] else HTTPAPI_PLAIN_PORT
+        device_session["port"] = int(port)
+    elif device_vars is not None and device_vars.get("ansible_port", None) is not None:
+        device_session["port"] = int(device_vars.get("ansible_port"))
+    elif connection in CONNECTION_DEFAULT_PORT:
+        device_session["port"] = CONNECTION_DEFAULT_PORT[connection]
+    return device_session
+
+
 def get_show_commands(commands_file: Text) -> Dict:
     with open(commands_file) as f:
         commands = yaml.safe_load(f)
@@ -187,14 +819,44 @@ def get_show_commands(commands_file: Text) -> Dict:
     return commands['all']
 
 
+def get_output_file_path(device_name: Text, output_path: Text, cmd: Text) -> Text:
+    file_name = cmd.replace(" ", "_")
+    return f"{output_path}/{device_name}/{file_name}.txt"
+
+
+def set_object_store(object_store) -> None:
+    """
+    Write collected files through a snapshot_store.ObjectStore, or directly if object_store is None
+    """
+    global _OBJECT_STORE
+    _OBJECT_STORE = object_store
+
+
 def write_output_to_file(device_name: Text, output_path: Text, cmd: Text, cmd_output: Text, prepend_text=None):
     """
     Save show commands output to it's file
     """
-    file_name = cmd.replace(" ", "_")
-    file_path = f"{output_path}/{device_name}/{file_name}.txt"
+    file_path = get_output_file_path(device_name, output_path, cmd)
+
+    with span("write_file", command=cmd):
+        _write_file(file_path, cmd_output, prepend_text)
+
+
+def _write_file(file_path: Text, cmd_output: Text, prepend_text=None):
+    if _OBJECT_STORE is not None:
+        if cmd_output is None:
+            content = "Command output was None"
+        elif prepend_text is not None:
+            content = f"{prepend_text}\n{cmd_output}"
+        else:
+            content = cmd_output
+        _OBJECT_STORE.write(file_path, content.encode("utf-8"))
+        return
 
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # the existing file may be a hardlink shared with another snapshot, never write through it
+    if os.path.lexists(file_path):
+        os.remove(file_path)
     with open(file_path, "w") as f:
         if cmd_output is None:
             f.write("Command output was None")
@@ -207,31 +869,123 @@ def write_output_to_file(device_name: Text, output_path: Text, cmd: Text, cmd_ou
         f.write(cmd_output)
 
 
-def a10_parse_version(input: Text) -> str:
+def carry_forward_file(src_path: Text, file_path: Text) -> None:
+    """
+    Puts the file src_path of an earlier snapshot at file_path, through the object store if one is set
+    """
+    if _OBJECT_STORE is not None:
+        _OBJECT_STORE.copy(src_path, file_path)
+        return
 
-    template = A10_VERSION_TTP_TEMPLATE
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+    try:
+        os.link(src_path, file_path)
+    except OSError:
+        # hardlinks need both snapshots on the same filesystem
+        shutil.copy2(src_path, file_path)
 
-    parser = ttp()
-    # Note:
-    #   - must add macros first, then vars and then you can add the template
-    #   - if you add templates individually, you will get multiple entries in
-    #       parser.result(). That is why it is easier to concatenate the
-    #       individual template files and then just add them as a single template
-    #       this way you get a results object for the entire input
-    #       as opposed to one object per template file
-    #
-    # to get additional debug information from ttp
-    # import logging
-    # logging.basicConfig(level=logging.DEBUG)
-    #
 
-    if template is None:
-        return []
+def exec_output_to_file(net_connect: RetryingNetConnect, device_name: Text, output_path: Text, cmd: Text,
+                        cmd_timer: int, stream: bool = False) -> None:
+    """
+    Run a show command on an exec channel and save its output to it's file, streaming it to disk if stream is set.
+
+    Raises if the command could not be run, the file is then left for the caller to rewrite.
+    """
+    if not stream:
+        write_output_to_file(device_name, output_path, cmd, net_connect.exec_command(cmd, cmd_timer))
+        return
+
+    stream_to_output_file(device_name, output_path, cmd,
+                          lambda file_path: net_connect.stream_exec_command(cmd, cmd_timer, file_path))
+
+
+def stream_to_output_file(device_name: Text, output_path: Text, cmd: Text, stream) -> None:
+    """
+    Save the output of cmd to it's file with stream(file_path), which writes the output to the file as it arrives.
+
+    Raises if stream does, the file is then left for the caller to rewrite.
+    """
+    file_path = get_output_file_path(device_name, output_path, cmd)
+    # the existing file may be a hardlink shared with another snapshot, never write through it
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    stream(file_path)
+    if _OBJECT_STORE is not None:
+        _OBJECT_STORE.ingest(file_path)
+
+
+def stream_output_to_file(net_connect: RetryingNetConnect, device_name: Text, output_path: Text, cmd: Text,
+                          cmd_timer: int, pattern=None, prepend_text=None) -> None:
+    """
+    Stream show command output straight to it's file instead of holding it in memory
+    """
+    file_path = get_output_file_path(device_name, output_path, cmd)
+    # the existing file may be a hardlink shared with another snapshot, never write through it
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+    if not net_connect.stream_command(cmd, cmd_timer, file_path, pattern=pattern, prepend_text=prepend_text):
+        # same file content as write_output_to_file for a failed command
+        write_output_to_file(device_name, output_path, cmd, None)
+    elif _OBJECT_STORE is not None:
+        _OBJECT_STORE.ingest(file_path)
+
+
+class TtpTemplateCache(object):
+    """
+    Process wide cache of TTP parsers, so each template file is loaded and compiled once.
+
+    A TTP parser is not safe to use from several threads at once, so parsing with the same template is serialized.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._parsers = {}
+
+    def _get_parser(self, template_file: Text):
+        with self._lock:
+            if template_file not in self._parsers:
+                # Note:
+                #   - must add macros first, then vars and then you can add the template
+                #   - if you add templates individually, you will get multiple entries in
+                #       parser.result(). That is why it is easier to concatenate the
+                #       individual template files and then just add them as a single template
+                #       this way you get a results object for the entire input
+                #       as opposed to one object per template file
+                #
+                # to get additional debug information from ttp
+                # import logging
+                # logging.basicConfig(level=logging.DEBUG)
+                #
+                parser = ttp()
+                parser.add_template(template_file)
+                self._parsers[template_file] = (parser, threading.Lock())
+            return self._parsers[template_file]
+
+    def parse(self, template_file: Text, input: Text) -> List:
+        """
+        Parses input with the template and returns the results for it, one entry per template
+        """
+        parser, parser_lock = self._get_parser(template_file)
+        with parser_lock, span("parse", parser="ttp", template=os.path.basename(template_file)):
+            parser.clear_input()
+            parser.add_input(input)
+            parser.parse()
+            # clear_result empties the result lists in place, keep copies of them
+            result = [list(template_result) for template_result in parser.result()]
+            parser.clear_result()
+        return result
+
+
+TTP_TEMPLATES = TtpTemplateCache()
+
+
+def a10_parse_version(input: Text) -> str:
 
-    parser.add_template(template)
-    parser.add_input(input)
-    parser.parse()
-    res = parser.result()[0][0]
+    res = TTP_TEMPLATES.parse(A10_VERSION_TTP_TEMPLATE, input)[0][0]
 
     if len(res) == 0:
         return "unknown"
@@ -247,29 +1001,7 @@ def a10_parse_version(input: Text) -> str:
 
 def a10_parse_partition(input: Text) -> List:
 
-    template = A10_PARTITION_TTP_TEMPLATE
-
-    parser = ttp()
-    # Note:
-    #   - must add macros first, then vars and then you can add the template
-    #   - if you add templates individually, you will get multiple entries in
-    #       parser.result(). That is why it is easier to concatenate the
-    #       individual template files and then just add them as a single template
-    #       this way you get a results object for the entire input
-    #       as opposed to one object per template file
-    #
-    # to get additional debug information from ttp
-    # import logging
-    # logging.basicConfig(level=logging.DEBUG)
-    #
-
-    if template is None:
-        return []
-
-    parser.add_template(template)
-    parser.add_input(input)
-    parser.parse()
-    res = parser.result()[0][0]
+    res = TTP_TEMPLATES.parse(A10_PARTITION_TTP_TEMPLATE, input)[0][0]
     if len(res) == 0:
         return []
     else:
@@ -318,31 +1050,15 @@ def parse_genie(device_name, cli_output, command=None, os=None, logger=None):
         )
 
     def _parse(device_name, raw_cli_output, cmd, nos, logger):
-        # Boilerplate code to get the parser functional
-        # tb = Testbed()
-        device = Device(device_name, os=nos)
-
-        device.custom.setdefault("abstraction", {})["order"] = ["os"]
-        device.cli = AttrDict({"execute": None})
-
-        # User input checking of the command provided. Does the command have a Genie parser?
-        try:
-            get_parser(cmd, device)
-        except Exception as e:
-            logger.error(
-                "genie_parse: {0} - Available parsers: {1}".format(e,
-                                                                   "https://pubhub.devnetcloud.com/media/pyats-packages/docs/genie/genie_libs/#/parsers")
-            )
-
-        try:
-            parsed_output = device.parse(cmd, output=raw_cli_output)
-            return parsed_output
-        except Exception as e:
-            logger.error(
-                f"genie_parse: Failed to parse command {cmd} output. {str(e)}"
-            )
-        # what is returned if the try fails?
-        # shouldn't there be a default value returned that you can check for?
+        with span("parse", parser="genie", command=cmd):
+            if _GENIE_PARSE_POOL is not None:
+                # parse in another process, waiting on the result releases the GIL for the SSH threads
+                parsed_output, errors = _GENIE_PARSE_POOL.submit(_genie_parse, raw_cli_output, cmd, nos).result()
+            else:
+                parsed_output, errors = _genie_parse(raw_cli_output, cmd, nos)
+        for error in errors:
+            logger.error(error)
+        return parsed_output
 
     # Try to parse the output
     # If OS is IOS, ansible could have passed in IOS, but the Genie device-type is actually IOS-XE,
@@ -360,6 +1076,71 @@ def parse_genie(device_name, cli_output, command=None, os=None, logger=None):
         return _parse(device_name, cli_output, command, os, logger)
 
 
+def _get_genie_device(nos: Text) -> Device:
+    """
+    Returns this thread's genie Device for an OS, genie devices are not shared between threads
+    """
+    devices = getattr(_genie_devices, "devices", None)
+    if devices is None:
+        devices = _genie_devices.devices = {}
+    if nos not in devices:
+        # Boilerplate code to get the parser functional
+        device = Device(f"genie_{nos}", os=nos)
+        device.custom.setdefault("abstraction", {})["order"] = ["os"]
+        device.cli = AttrDict({"execute": None})
+        devices[nos] = device
+    return devices[nos]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_genie_parser(cmd: Text, nos: Text):
+    """
+    Returns the genie parser class and its arguments for a command, the lookup only depends on the command and OS
+    """
+    return get_parser(cmd, _get_genie_device(nos))
+
+
+def _genie_parse(raw_cli_output: Text, cmd: Text, nos: Text):
+    """
+    Parses cli output with genie, runs either inline or in the genie parse pool.
+
+    Returns the parsed output, or None, and a list of error messages since the caller's logger is not available
+    in the pool processes.
+    """
+    errors = []
+    # User input checking of the command provided. Does the command have a Genie parser?
+    try:
+        parser_class, parser_kwargs = _get_genie_parser(cmd, nos)
+    except Exception as e:
+        errors.append("genie_parse: {0} - Available parsers: {1}".format(
+            e, "https://pubhub.devnetcloud.com/media/pyats-packages/docs/genie/genie_libs/#/parsers"))
+        return None, errors
+
+    try:
+        return parser_class(device=_get_genie_device(nos)).parse(output=raw_cli_output, **parser_kwargs), errors
+    except Exception as e:
+        errors.append(f"genie_parse: Failed to parse command {cmd} output. {str(e)}")
+        return None, errors
+
+
+def start_genie_parse_pool(max_workers: int) -> None:
+    """
+    Run genie parsing in a pool of worker processes instead of on the calling thread
+    """
+    global _GENIE_PARSE_POOL
+    if max_workers < 1 or _GENIE_PARSE_POOL is not None:
+        return
+    # spawn rather than fork, forking a process with running SSH threads can deadlock the children
+    _GENIE_PARSE_POOL = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def stop_genie_parse_pool() -> None:
+    global _GENIE_PARSE_POOL
+    if _GENIE_PARSE_POOL is not None:
+        _GENIE_PARSE_POOL.shutdown()
+        _GENIE_PARSE_POOL = None
+
+
 def get_device_credentials_ansible_vault(vault_file: Text, vault_pass_file: Text) -> Dict:
 
     loader = DataLoader()
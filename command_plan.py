@@ -0,0 +1,151 @@
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_TIMEOUT = 240  # seconds, for most show commands
+BGP_NEIGHBOR_TIMEOUT = 300  # for the commands run to find BGP neighbors
+RIB_TIMEOUT = 1200  # for route and BGP RIB commands
+
+# command groups with scoped commands, {scope: [command]} for routes_v4 and {scope: {subscope: [command]}} for bgp_v4
+SCOPED_CMD_GROUPS = ["routes_v4", "bgp_v4"]
+CMD_GROUP_TIMEOUTS = {
+    "routes_v4": RIB_TIMEOUT,
+    "bgp_v4": RIB_TIMEOUT,
+}
+# the bgp_v4 subscope with per neighbor commands, _neigh_ and _vrf_ are replaced by each neighbor and its VRF
+NEIGHBOR_RIBS = "neighbor_ribs"
+# VRFs whose neighbors are not expanded in the vrf scope, the default VRF is the global scope
+NON_VRF_SCOPE_VRFS = ["default", "mgmt", "management"]
+
+# commands run at the start of bgp_v4 to find the BGP neighbors, per netmiko OS: the scope the neighbors are
+# expanded in (None for both), the command, and the OS of the BGP neighbor extractor for the output
+BGP_DISCOVERY_COMMANDS = {
+    "cisco_nxos": [(None, "show bgp vrf all all summary", "nxos")],
+    "cisco_xr": [("global", "show bgp all all neighbors", "iosxr"),
+                 ("vrf", "show bgp vrf all neighbors", "iosxr")],
+}
+
+
+class PlannedCommand(object):
+    """
+    One show command of a command plan
+    """
+
+    def __init__(self, cmd: str, cmd_group: str, timeout: int):
+        self.cmd = cmd
+        self.cmd_group = cmd_group
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"PlannedCommand({self.cmd!r}, {self.cmd_group!r}, {self.timeout})"
+
+
+class CommandPlan(object):
+    """
+    The show commands of an inventory group in the order they run, compiled once from the command file.
+
+    Each command is in the plan once, in the first group that lists it. Per neighbor commands are templates until
+    expanded with the neighbors found on a device.
+    """
+
+    def __init__(self, device_os: str, groups: Dict[str, List[PlannedCommand]],
+                 neighbor_templates: Dict[str, List[str]], discovery: List[Tuple[Optional[str], PlannedCommand, str]]):
+        self.device_os = device_os
+        self.groups = groups
+        # {scope: [template]} of the bgp_v4 group
+        self.neighbor_templates = neighbor_templates
+        self.discovery = discovery
+
+    @property
+    def cmd_groups(self) -> List[str]:
+        return list(self.groups.keys())
+
+    def needs_bgp_neighbors(self, cmd_group: str) -> bool:
+        return cmd_group == "bgp_v4" and len(self.discovery) != 0 and len(self.neighbor_templates) != 0
+
+    def expand_neighbor_commands(self, bgp_neighbors: Dict[str, Dict[str, List[str]]]) -> List[PlannedCommand]:
+        """
+        Per neighbor commands for the {scope: {vrf: [neighbor]}} found on a device, IPv6 neighbors are skipped
+        """
+        commands = []
+        seen = set()
+        for scope, templates in self.neighbor_templates.items():
+            for vrf, neighbors in bgp_neighbors.get(scope, {}).items():
+                if scope == "vrf" and vrf.lower() in NON_VRF_SCOPE_VRFS:
+                    continue
+                for neighbor in neighbors:
+                    if ":" in neighbor:
+                        continue
+                    for template in templates:
+                        cmd = template.replace("_neigh_", neighbor).replace("_vrf_", vrf)
+                        if cmd not in seen:
+                            seen.add(cmd)
+                            commands.append(PlannedCommand(cmd, "bgp_v4", CMD_GROUP_TIMEOUTS["bgp_v4"]))
+        return commands
+
+
+def scope_bgp_neighbors(scope: Optional[str], neighbors: Dict[str, List[str]]) -> Dict[str, Dict[str, List[str]]]:
+    """
+    {scope: {vrf: [neighbor]}} for the {vrf: [neighbor]} found by a discovery command of scope, the default VRF
+    is the global scope of a discovery command for both scopes
+    """
+    if scope is not None:
+        return {scope: neighbors}
+    return {"global": {vrf: vrf_neighbors for vrf, vrf_neighbors in neighbors.items() if vrf == "default"},
+            "vrf": neighbors}
+
+
+def _group_commands(cmd_group: str, group_cmds, neighbor_templates: Dict[str, List[str]],
+                    warnings: List[str]) -> List[str]:
+    if cmd_group not in SCOPED_CMD_GROUPS:
+        return list(group_cmds or [])
+
+    cmds = []
+    for scope, scope_cmds in (group_cmds or {}).items():
+        if cmd_group == "routes_v4":
+            cmds.extend(scope_cmds or [])
+            continue
+        if scope not in ["global", "vrf"]:
+            warnings.append(f"Unknown {scope} with commands {scope_cmds} under bgp_v4 command dict")
+            continue
+        for subscope, subscope_cmds in (scope_cmds or {}).items():
+            if subscope == NEIGHBOR_RIBS:
+                neighbor_templates.setdefault(scope, []).extend(subscope_cmds or [])
+            else:
+                cmds.extend(subscope_cmds or [])
+    return cmds
+
+
+def compile_command_plan(cmd_dict: Dict, device_os: str) -> Tuple[CommandPlan, List[str]]:
+    """
+    Compiles the command dictionary of an inventory group from the command file for devices running device_os.
+
+    Returns the plan and the problems found in the command dictionary.
+    """
+    warnings = []
+    groups = {}
+    neighbor_templates = {}
+    seen = set()
+
+    discovery = []
+    if "bgp_v4" in cmd_dict:
+        for scope, cmd, parser_os in BGP_DISCOVERY_COMMANDS.get(device_os, []):
+            discovery.append((scope, PlannedCommand(cmd, "bgp_v4", BGP_NEIGHBOR_TIMEOUT), parser_os))
+            seen.add(cmd)
+
+    for cmd_group, group_cmds in cmd_dict.items():
+        timeout = CMD_GROUP_TIMEOUTS.get(cmd_group, DEFAULT_TIMEOUT)
+        planned = []
+        for cmd in _group_commands(cmd_group, group_cmds, neighbor_templates, warnings):
+            if cmd in seen:
+                # listed twice, or one of the BGP neighbor discovery commands
+                continue
+            seen.add(cmd)
+            planned.append(PlannedCommand(cmd, cmd_group, timeout))
+        groups[cmd_group] = planned
+
+    if len(neighbor_templates) != 0 and len(discovery) == 0:
+        warnings.append(f"BGP neighbor RIB collection not supported for {device_os}")
+        neighbor_templates = {}
+    for scope in neighbor_templates:
+        neighbor_templates[scope] = list(dict.fromkeys(neighbor_templates[scope]))
+
+    return CommandPlan(device_os, groups, neighbor_templates, discovery), warnings
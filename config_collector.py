@@ -1,21 +1,36 @@
 import os
+import functools
+import json
 import time
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import re
 
 import configargparse
 import logging
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import netmiko.exceptions
 
-from collection_helper import (get_inventory, write_output_to_file, custom_logger, RetryingNetConnect,
-                               CollectionStatus, CollectionFailureReason, AnsibleOsToNetmikoOs, a10_parse_version)
+from collection_helper import (get_inventory, get_device_session, write_output_to_file, custom_logger,
+                               RetryingNetConnect, CollectionStatus, CollectionFailureReason, AnsibleOsToNetmikoOs,
+                               a10_parse_version, a10_parse_partition, set_object_store, CollectionRetry,
+                               wait_before_retry, LogPayload, SessionLogPolicy, set_session_log_policy,
+                               stop_log_writer, get_ansible_connection, stream_to_output_file,
+                               DEFAULT_ANSIBLE_CONNECTION, close_connection, acquire_sessions, release_sessions,
+                               carry_forward_file)
+from collection_engine import CollectionTask, ConcurrencyController, run_collection, parse_group_limits
+from duration_history import DurationHistory
+from preflight import preflight_tasks
+from instrumentation import start_timing_export, stop_timing_export, get_span_tags, span_context
+from netconf_transport import NetconfSession
+from httpapi_transport import HttpApiSession
+from snapshot_store import ObjectStore, LINK_MODES
 
 
-def get_config(device_session: dict, device_name: str, device_command: str, output_path: str, logger) -> Dict:
+def get_config(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: RetryingNetConnect = None) -> Dict:
     """
     Default config collector. Works for Cisco and Juniper devices.
     """
@@ -27,10 +42,13 @@ def get_config(device_session: dict, device_name: str, device_command: str, outp
         "reason": CollectionFailureReason.OTHER,
         "message": "",
     }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
     except netmiko.exceptions.NetmikoTimeoutException as e:
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
@@ -43,6 +61,8 @@ def get_config(device_session: dict, device_name: str, device_command: str, outp
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.READ_TIMEOUT
         return status
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {e}"
         return status
@@ -52,6 +72,11 @@ def get_config(device_session: dict, device_name: str, device_command: str, outp
         logger.info(f"Running {device_command} on {device_name}")
         output = net_connect.run_command(device_command, cmd_timer)
         write_output_to_file(device_name, output_path, device_command, output)
+    except CollectionRetry:
+        # the device is collected again on a new connection
+        if own_connection:
+            close_connection(net_connect, logger)
+        raise
     except Exception as e:
         status['message'] = f"Config retrieval failed. Exception {e}"
         return status
@@ -59,16 +84,18 @@ def get_config(device_session: dict, device_name: str, device_command: str, outp
     logger.info(f"Completed configuration collection for {device_name}")
     status['status'] = CollectionStatus.PASS
     status['message'] = "Collection successful"
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
+    if own_connection:
+        try:
+            net_connect.close()
+        except Exception as e:
+            logger.exception(f"Exception when closing netmiko connection: {str(e)}")
+            pass
 
     return status
 
 
-def get_config_eos(device_session: dict, device_name: str, device_command: str, output_path: str, logger) -> Dict:
+def get_config_eos(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: RetryingNetConnect = None) -> Dict:
     cmd_timer = 240
     logger.info(f"Trying to connect to {device_name}")
     status = {
@@ -77,10 +104,13 @@ def get_config_eos(device_session: dict, device_name: str, device_command: str,
         "reason": CollectionFailureReason.OTHER,
         "message": "",
     }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
         net_connect.enable()
     except netmiko.exceptions.NetmikoTimeoutException as e:
         status['message'] = f"Connection failed. Exception {e}"
@@ -94,6 +124,8 @@ def get_config_eos(device_session: dict, device_name: str, device_command: str,
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.READ_TIMEOUT
         return status
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {e}"
         return status
@@ -103,6 +135,11 @@ def get_config_eos(device_session: dict, device_name: str, device_command: str,
         logger.info(f"Running {device_command} on {device_name}")
         output = net_connect.run_command(device_command, cmd_timer)
         write_output_to_file(device_name, output_path, device_command, output)
+    except CollectionRetry:
+        # the device is collected again on a new connection
+        if own_connection:
+            close_connection(net_connect, logger)
+        raise
     except Exception as e:
         status['message'] = f"Config retrieval failed. Exception {e}"
         return status
@@ -110,15 +147,40 @@ def get_config_eos(device_session: dict, device_name: str, device_command: str,
     logger.info(f"Completed configuration collection for {device_name}")
     status['status'] = CollectionStatus.PASS
     status['message'] = "Collection successful"
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
+    if own_connection:
+        try:
+            net_connect.close()
+        except Exception as e:
+            logger.exception(f"Exception when closing netmiko connection: {str(e)}")
+            pass
     return status
 
 
-def get_config_cumulus(device_session: dict, device_name: str, device_command: str, output_path: str, logger) -> Dict:
+# the files of a Cumulus configuration, each after its header line if it has one, in cumulus_concatenated.txt
+CUMULUS_CONFIG_FILES = [
+    ("/etc/hostname", None),
+    ("/etc/network/interfaces", "# This file describes the network interfaces"),
+    ("/etc/cumulus/ports.conf", "# ports.conf --"),
+    ("/etc/frr/frr.conf", "frr version"),
+]
+CUMULUS_CONFIG_NAME = "cumulus_concatenated.txt"
+
+
+def assemble_config_files(contents: List[Tuple[Optional[str], str]]) -> str:
+    """
+    Concatenates (header, content) pairs of configuration files, each followed by a newline, in one pass
+    """
+    parts = []
+    for header, content in contents:
+        if header is not None:
+            parts.append(f"{header}\n")
+        parts.append(content)
+        parts.append("\n")
+    return "".join(parts)
+
+
+def get_config_cumulus(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: RetryingNetConnect = None) -> Dict:
     cmd_timer = 240
     logger.info(f"Trying to connect to {device_name}")
     status = {
@@ -127,10 +189,13 @@ def get_config_cumulus(device_session: dict, device_name: str, device_command: s
         "reason": CollectionFailureReason.OTHER,
         "message": "",
     }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
     except netmiko.exceptions.NetmikoTimeoutException as e:
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
@@ -143,51 +208,256 @@ def get_config_cumulus(device_session: dict, device_name: str, device_command: s
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.READ_TIMEOUT
         return status
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {e}"
         return status
 
-    output = ""
+    contents = []
     try:
-        logger.info(f"Running 'cat /etc/hostname' on {device_name}")
-        output += net_connect.run_command("cat /etc/hostname", cmd_timer)
-        output += "\n"
-
-        logger.info(f"Running 'cat /etc/network/interfaces' on {device_name}")
-        output += "# This file describes the network interfaces\n"
-        output += net_connect.run_command("cat /etc/network/interfaces", cmd_timer)
-        output += "\n"
-
-        logger.info(f"Running 'cat /etc/cumulus/ports.conf' on {device_name}")
-        output += "# ports.conf --\n"
-        output += net_connect.run_command("cat /etc/cumulus/ports.conf", cmd_timer)
-        output += "\n"
-
-        logger.info(f"Running 'cat /etc/frr/frr.conf' on {device_name}")
-        output += "frr version\n"
-        output += net_connect.run_command("cat /etc/frr/frr.conf", cmd_timer)
-        output += "\n"
+        for file_path, header in CUMULUS_CONFIG_FILES:
+            logger.info(f"Running 'cat {file_path}' on {device_name}")
+            contents.append((header, net_connect.run_command(f"cat {file_path}", cmd_timer)))
+        output = assemble_config_files(contents)
+    except CollectionRetry:
+        # the device is collected again on a new connection
+        if own_connection:
+            close_connection(net_connect, logger)
+        raise
     except Exception as e:
         status['message'] = f"Config retrieval failed. Exception {e}"
         return status
 
-    write_output_to_file(device_name, output_path, "cumulus_concatenated.txt", output)
+    write_output_to_file(device_name, output_path, CUMULUS_CONFIG_NAME, output)
 
     logger.info(f"Completed configuration collection for {device_name}")
     status['status'] = CollectionStatus.PASS
     status['message'] = "Collection successful"
+    if own_connection:
+        try:
+            net_connect.close()
+        except Exception as e:
+            logger.exception(f"Exception when closing netmiko connection: {str(e)}")
+            pass
+    return status
+
+
+# configurations that can be fetched as files: the name they are saved under, None for the name of the config
+# command output, and the (file, header) pairs to concatenate
+OS_CONFIG_FILES = {
+    "cisco_ios": (None, [("system:running-config", None)]),
+    "linux": (CUMULUS_CONFIG_NAME, CUMULUS_CONFIG_FILES),
+}
+
+
+def get_config_file_transfer(device_session: dict, device_name: str, device_command: str, output_path: str,
+                             logger, net_connect: RetryingNetConnect = None) -> Dict:
+    """
+    Config collector that fetches the configuration files of the device in parallel over SFTP or SCP, on the SSH
+    transport of the CLI session, and concatenates them in one pass. Falls back to the CLI collector of the OS if
+    the files can not be fetched.
+    """
+    cmd_timer = 240
+    device_os = device_session['device_type']
+    logger.info(f"Trying to connect to {device_name}")
+    status = {
+        "name": device_name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "message": "",
+    }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     try:
-        net_connect.close()
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
+    except netmiko.exceptions.NetmikoTimeoutException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
+        return status
+    except netmiko.exceptions.NetmikoAuthenticationException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.AUTH
+        return status
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
+    except CollectionRetry:
+        raise
     except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
+        status['message'] = f"Connection failed. Exception {e}"
+        return status
+
+    config_name, config_files = OS_CONFIG_FILES[device_os]
+    # closed in any case, the CLI collector fallback can raise CollectionRetry too
+    try:
+        try:
+            contents = net_connect.fetch_files([file_path for file_path, _ in config_files], cmd_timer)
+        except CollectionRetry:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not fetch configuration files from {device_name}, collecting over the CLI. "
+                           f"Exception {e}")
+            status = OS_COLLECTOR_FUNCTION[device_os](device_session=device_session, device_name=device_name,
+                                                      device_command=device_command, output_path=output_path,
+                                                      logger=logger, net_connect=net_connect)
+        else:
+            # like the output of cat, without the newline at the end of the file
+            texts = [content.decode("utf-8", errors="replace") for content in contents]
+            output = assemble_config_files([(header, text[:-1] if text.endswith("\n") else text)
+                                            for (_, header), text in zip(config_files, texts)])
+            write_output_to_file(device_name, output_path, config_name or device_command, output)
+            logger.info(f"Completed configuration collection for {device_name}")
+            status['status'] = CollectionStatus.PASS
+            status['message'] = "Collection successful"
+    finally:
+        if own_connection:
+            close_connection(net_connect, logger)
     return status
 
 
+def a10_config_complete(output: str) -> bool:
+    """
+    Checks for the scenario in which netmiko doesn't return the complete A10 config
+    """
+    lines = output.strip().splitlines()
+    if len(lines) == 0:
+        return False
+    # certain versions have end as the 2nd to last line and the below line is the last line
+    return "end" in lines[-1] or \
+        "Current config commit point for partition 0 is 0 & config mode is classical-mode" in lines[-1]
+
+
+def a10_strip_config_trailer(output: str) -> str:
+    """
+    Removes the end (and commit point) lines from an A10 config so configs can be concatenated
+    """
+    lines = output.strip().splitlines()
+    while len(lines) != 0 and (lines[-1].strip() == "end" or lines[-1].startswith("Current config commit point")):
+        lines.pop()
+    return "\n".join(lines)
+
+
+def get_a10_partition_config(device_session: dict, device_name: str, partition: str, prompt_pattern: str,
+                             cmd_timer: int, logger) -> Optional[str]:
+    """
+    Retrieves the configuration of one A10 partition over its own session, retrying once if it is incomplete
+    """
+    cmd = f"show running-config partition {partition}"
+    if device_session.get("session_log") is not None:
+        # each partition session gets its own session log
+        log_file, extension = os.path.splitext(device_session["session_log"])
+        device_session = dict(device_session, session_log=f"{log_file}_{partition}{extension}")
+    for attempt in range(1, 3):
+        try:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        except Exception as e:
+            logger.error(f"Connection for partition {partition} failed, attempt {attempt}. Exception {e}")
+            continue
+
+        logger.info(f"Running {cmd} on {device_name}")
+        try:
+            output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+        finally:
+            close_connection(net_connect, logger)
+
+        if output is not None and a10_config_complete(output):
+            return output
+        logger.error(f"Didn't retrieve full config for partition {partition}, attempt {attempt}")
+    return None
+
+
+def get_a10_session_partition_config(net_connect: RetryingNetConnect, device_name: str, partition: str,
+                                     prompt_pattern: str, cmd_timer: int, logger) -> Optional[str]:
+    """
+    Retrieves the configuration of one A10 partition over an open session
+    """
+    cmd = f"show running-config partition {partition}"
+    logger.info(f"Running {cmd} on {device_name}")
+    output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+    if output is not None and a10_config_complete(output):
+        return output
+    logger.error(f"Didn't retrieve full config for partition {partition}")
+    return None
+
+
+def get_a10_partitioned_config(net_connect: RetryingNetConnect, device_session: dict, device_name: str,
+                               prompt_pattern: str, cmd_timer: int, partition_sessions: int,
+                               logger) -> Tuple[Optional[str], List[str]]:
+    """
+    Collects the shared partition over net_connect while the other partitions are collected concurrently over
+    up to partition_sessions additional sessions, and stitches them into a single config. If the session limits
+    leave no room for additional sessions, the partitions are collected over net_connect.
+
+    Returns the config, or None if the partitions could not be discovered, and the partitions that failed.
+    """
+    cmd = "show partition"
+    logger.info(f"Running {cmd} on {device_name}")
+    output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+    if output is None:
+        return None, []
+    partitions = [partition['partition_name'] for partition in a10_parse_partition(output)]
+    if len(partitions) == 0:
+        logger.info(f"No partitions found on {device_name}")
+        return None, []
+    logger.info(f"Collecting {len(partitions)} partitions on {device_name}: {partitions}")
+
+    # the additional sessions count against the session limits of the collection
+    sessions = acquire_sessions(min(partition_sessions, len(partitions)))
+    if sessions == 0:
+        logger.info(f"No sessions available next to the main session of {device_name}, collecting partitions "
+                    f"over it one by one")
+        cmd = "show running-config"
+        logger.info(f"Running {cmd} on {device_name}")
+        shared_config = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+        partition_configs = {partition: get_a10_session_partition_config(net_connect, device_name, partition,
+                                                                         prompt_pattern, cmd_timer, logger)
+                             for partition in partitions}
+    else:
+        span_tags = get_span_tags()
+
+        def _get_partition_config(partition: str) -> Optional[str]:
+            with span_context(**span_tags):
+                return get_a10_partition_config(device_session, device_name, partition, prompt_pattern, cmd_timer,
+                                                logger)
+
+        try:
+            with ThreadPoolExecutor(sessions) as pool:
+                futures = {partition: pool.submit(_get_partition_config, partition) for partition in partitions}
+                cmd = "show running-config"
+                logger.info(f"Running {cmd} on {device_name}")
+                shared_config = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+                partition_configs = {partition: future.result() for partition, future in futures.items()}
+        finally:
+            release_sessions(sessions)
+
+    if shared_config is None or not a10_config_complete(shared_config):
+        logger.error("Didn't retrieve full config for the shared partition")
+        return None, []
+
+    failed_partitions = [partition for partition, config in partition_configs.items() if config is None]
+    sections = [a10_strip_config_trailer(shared_config)]
+    for partition, config in partition_configs.items():
+        if config is None:
+            continue
+        section = a10_strip_config_trailer(config)
+        if re.search(fr"^active-partition\s+{re.escape(partition)}\s*$", section, re.MULTILINE) is None:
+            section = f"active-partition {partition}\n{section}"
+        sections.append(section)
+    sections.append("end")
+    return "\n!\n".join(sections), failed_partitions
+
+
 def get_config_a10(
-        device_session: dict, device_name: str, device_command: str, output_path: str, logger) -> Dict:
+        device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: RetryingNetConnect = None, partition_sessions: int = 0) -> Dict:
     """
     A10 Loadbalancer config collector.
+
+    If partition_sessions is set, ACOS 4.x and later partitions are collected concurrently over that many
+    additional sessions instead of with one show running-config partition-config all.
     """
     cmd_timer = 240
     logger.info(f"Trying to connect to {device_name}")
@@ -197,10 +467,13 @@ def get_config_a10(
         "reason": CollectionFailureReason.OTHER,
         "message": "",
     }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
     except netmiko.exceptions.NetmikoTimeoutException as e:
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
@@ -213,86 +486,114 @@ def get_config_a10(
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.READ_TIMEOUT
         return status
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {e}"
         return status
 
-    cmd_dict = {
-        "v2_config": ["show running-config all-partitions"],
-        "v4p_config": ["show running-config partition-config all"],
-        "unknown_config": ["show running-config with-default"],
-    }
+    # closed in any case, the device is collected again on a new connection if CollectionRetry is raised
+    try:
+        cmd_dict = {
+            "v2_config": ["show running-config all-partitions"],
+            "v4p_config": ["show running-config partition-config all"],
+            "unknown_config": ["show running-config with-default"],
+        }
 
-    A10_PROMPT_REGEX_TRAILER = r"(-\w+)?(.*[#>])\s*$"
+        A10_PROMPT_REGEX_TRAILER = r"(-\w+)?(.*[#>])\s*$"
 
-    # set default partition list to empty
-    partitions = []
+        # set default partition list to empty
+        partitions = []
 
-    # set the prompt pattern for Netmiko to use
-    prompt_pattern = fr"({device_name}){A10_PROMPT_REGEX_TRAILER}"
-    logger.info(f"Using {prompt_pattern} to find device prompt")
+        # set the prompt pattern for Netmiko to use
+        prompt_pattern = fr"({device_name}){A10_PROMPT_REGEX_TRAILER}"
+        logger.info(f"Using {prompt_pattern} to find device prompt")
 
-    # get the ACOS version to determine which command to run to get device configuration with partitions
-    cmd = "show version"
-    logger.info(f"Running {cmd} on {device_name}")
-    try:
-        output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
-    except Exception as e:
-        logger.exception(f"Failed to get output of {cmd}, going to sleep 10 minutes and retry")
-        time.sleep(600)
-        # reconnect to the device and run the command again
+        # get the ACOS version to determine which command to run to get device configuration with partitions
+        cmd = "show version"
+        logger.info(f"Running {cmd} on {device_name}")
         try:
-            net_connect = RetryingNetConnect(device_name, device_session, device_name)
             output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+        except CollectionRetry:
+            raise
         except Exception as e:
-            logger.exception(f"Retry for show version failed")
-            status['message'] = f"Connection failed. Exception {e}"
-            return status
+            logger.exception(f"Failed to get output of {cmd}, going to sleep 10 minutes and retry")
+            wait_before_retry(device_name, 600, f"Failed to get output of {cmd}")
+            # reconnect to the device and run the command again
+            if own_connection:
+                close_connection(net_connect, logger)
+                own_connection = False
+            try:
+                net_connect = RetryingNetConnect(device_name, device_session, device_name)
+                own_connection = True
+                output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+            except CollectionRetry:
+                raise
+            except Exception as e:
+                logger.exception("Retry for show version failed")
+                status['message'] = f"Connection failed. Exception {e}"
+                return status
+            else:
+                logger.debug("Command output: %s", LogPayload(output))
         else:
-            logger.debug(f"Command output: {output}")
-    else:
-        logger.debug(f"Command output: {output}")
+            logger.debug("Command output: %s", LogPayload(output))
 
-    if output is None:
-        logger.error(f"Failed to get output for {cmd}")
-        cfg_version = "unknown"
-    else:
-        cfg_version = a10_parse_version(output)
-
-    # get the configuration commands
-    logger.info(f"Getting configuration for {device_name}")
-    cmd_list = cmd_dict.get(f"{cfg_version}_config", None)
-    if cmd_list is None:
-        logger.error(f"No configuration command mapped for version {cfg_version}")
-        return status
-    for cmd in cmd_list:
-        logger.info(f"Running {cmd} on {device_name}")
-        output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
-        # trying to catch scenario in which netmiko doesn't return complete config
         if output is None:
-            logger.error(f"Didn't retrieve any part of the config")
+            logger.error(f"Failed to get output for {cmd}")
+            cfg_version = "unknown"
+        else:
+            cfg_version = a10_parse_version(output)
+
+        # get the configuration commands
+        logger.info(f"Getting configuration for {device_name}")
+        cmd_list = cmd_dict.get(f"{cfg_version}_config", None)
+        if cmd_list is None:
+            logger.error(f"No configuration command mapped for version {cfg_version}")
             return status
-        if "end" not in output.strip().splitlines()[-1]:
-            # certain versions have end as the 2nd to last line and the below line is the last line
-            if "Current config commit point for partition 0 is 0 & config mode is classical-mode" not in output.strip().splitlines()[-1]:
+
+        if cfg_version == "v4p" and partition_sessions > 0:
+            output, failed_partitions = get_a10_partitioned_config(net_connect, device_session, device_name,
+                                                                   prompt_pattern, cmd_timer, partition_sessions,
+                                                                   logger)
+            if output is not None:
+                # same file name as the single command collection
+                write_output_to_file(device_name, output_path, cmd_list[0], output, "!BATFISH_FORMAT: a10_acos")
+                logger.info(f"Completed configuration collection for {device_name}")
+                if len(failed_partitions) == 0:
+                    status['status'] = CollectionStatus.PASS
+                    status['message'] = "Collection successful"
+                else:
+                    status['status'] = CollectionStatus.PARTIAL
+                    status['message'] = f"Collection failed for partitions {failed_partitions}"
+                return status
+            logger.error("Per partition collection failed, collecting the whole configuration in one command")
+
+        for cmd in cmd_list:
+            logger.info(f"Running {cmd} on {device_name}")
+            output = net_connect.run_command(cmd, cmd_timer, pattern=prompt_pattern)
+            # trying to catch scenario in which netmiko doesn't return complete config
+            if output is None:
+                logger.error(f"Didn't retrieve any part of the config")
+                return status
+            if not a10_config_complete(output):
                 logger.error(f"Didn't retrieve full config file")
                 status['message'] = "Collection failed, only got partial A10 configuration"
                 return status
 
-        logger.debug(f"Command output: {output}")
-        write_output_to_file(device_name, output_path, cmd, output, "!BATFISH_FORMAT: a10_acos")
+            logger.debug("Command output: %s", LogPayload(output))
+            write_output_to_file(device_name, output_path, cmd, output, "!BATFISH_FORMAT: a10_acos")
 
-    logger.info(f"Completed configuration collection for {device_name}")
-    status['status'] = CollectionStatus.PASS
-    status['message'] = "Collection successful"
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
+        logger.info(f"Completed configuration collection for {device_name}")
+        status['status'] = CollectionStatus.PASS
+        status['message'] = "Collection successful"
+    finally:
+        if own_connection:
+            close_connection(net_connect, logger)
     return status
 
-def get_config_checkpoint(device_session: dict, device_name: str, device_command: str, output_path: str, logger) -> Dict:
+
+def get_config_checkpoint(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: RetryingNetConnect = None) -> Dict:
     """
     Checkpoint Gateway config collector.
     """
@@ -304,10 +605,13 @@ def get_config_checkpoint(device_session: dict, device_name: str, device_command
         "reason": CollectionFailureReason.OTHER,
         "message": "",
     }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = RetryingNetConnect(device_name, device_session, device_name)
     except netmiko.exceptions.NetmikoTimeoutException as e:
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
@@ -320,6 +624,8 @@ def get_config_checkpoint(device_session: dict, device_name: str, device_command
         status['message'] = f"Connection failed. Exception {e}"
         status['reason'] = CollectionFailureReason.READ_TIMEOUT
         return status
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {e}"
         return status
@@ -355,18 +661,154 @@ def get_config_checkpoint(device_session: dict, device_name: str, device_command
         output = net_connect.run_command(device_command, cmd_timer, pattern=prompt_pattern)
         write_output_to_file(device_name, output_path, device_command, output, "#BATFISH_FORMAT: check_point_gateway")
 
+    except CollectionRetry:
+        # the device is collected again on a new connection
+        if own_connection:
+            close_connection(net_connect, logger)
+        raise
+    except Exception as e:
+        status['message'] = f"Config retrieval failed. Exception {e}"
+        return status
+
+    logger.info(f"Completed configuration collection for {device_name}")
+    status['status'] = CollectionStatus.PASS
+    status['message'] = "Collection successful"
+    if own_connection:
+        try:
+            net_connect.close()
+        except Exception as e:
+            logger.exception(f"Exception when closing netmiko connection: {str(e)}")
+            pass
+    return status
+
+
+def get_config_netconf(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: NetconfSession = None) -> Dict:
+    """
+    Config collector for Juniper devices with ansible_connection netconf. The configuration is retrieved in set
+    format with get-configuration and streamed to the file device_command's output would be saved to.
+    """
+    cmd_timer = 240
+    logger.info(f"Trying to connect to {device_name} over NETCONF")
+    status = {
+        "name": device_name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "message": "",
+    }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
+    try:
+        if own_connection:
+            net_connect = NetconfSession(device_name, device_session, device_name)
+    except netmiko.exceptions.NetmikoTimeoutException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
+        return status
+    except netmiko.exceptions.NetmikoAuthenticationException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.AUTH
+        return status
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
+    except CollectionRetry:
+        raise
+    except Exception as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        return status
+
+    try:
+        logger.info(f"Retrieving the configuration of {device_name} with get-configuration")
+        stream_to_output_file(device_name, output_path, device_command,
+                              lambda file_path: net_connect.stream_configuration(cmd_timer, file_path))
+    except CollectionRetry:
+        raise
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Config retrieval failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
     except Exception as e:
         status['message'] = f"Config retrieval failed. Exception {e}"
         return status
+    finally:
+        if own_connection:
+            try:
+                net_connect.close()
+            except Exception as e:
+                logger.exception(f"Exception when closing NETCONF session: {str(e)}")
+                pass
 
     logger.info(f"Completed configuration collection for {device_name}")
     status['status'] = CollectionStatus.PASS
     status['message'] = "Collection successful"
+    return status
+
+
+def get_config_httpapi(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+        net_connect: HttpApiSession = None) -> Dict:
+    """
+    Config collector for Arista and NX-OS devices with ansible_connection httpapi. device_command is sent to eAPI
+    or NX-API and its text output saved like the CLI output.
+    """
+    cmd_timer = 240
+    logger.info(f"Trying to connect to {device_name} over its HTTP API")
+    status = {
+        "name": device_name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "message": "",
+    }
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
+    try:
+        if own_connection:
+            net_connect = HttpApiSession(device_name, device_session, device_name)
+    except netmiko.exceptions.NetmikoTimeoutException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
+        return status
+    except netmiko.exceptions.NetmikoAuthenticationException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.AUTH
+        return status
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
+    except CollectionRetry:
+        raise
+    except Exception as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        return status
+
     try:
-        net_connect.close()
+        logger.info(f"Running {device_command} on {device_name}")
+        output, error = net_connect.run_commands([device_command], cmd_timer)[0]
+        if error is not None:
+            raise Exception(error)
+        write_output_to_file(device_name, output_path, device_command, output)
+    except CollectionRetry:
+        raise
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Config retrieval failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
     except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
+        status['message'] = f"Config retrieval failed. Exception {e}"
+        return status
+    finally:
+        if own_connection:
+            try:
+                net_connect.close()
+            except Exception as e:
+                logger.exception(f"Exception when closing HTTP API session: {str(e)}")
+                pass
+
+    logger.info(f"Completed configuration collection for {device_name}")
+    status['status'] = CollectionStatus.PASS
+    status['message'] = "Collection successful"
     return status
 
 
@@ -382,6 +824,17 @@ OS_COLLECTOR_FUNCTION = {
     "linux": get_config_cumulus,
 }
 
+# collector functions for devices whose ansible_connection is not an SSH CLI session
+CONNECTION_COLLECTOR_FUNCTION = {
+    "netconf": {
+        "juniper_junos": get_config_netconf,
+    },
+    "httpapi": {
+        "arista_eos": get_config_httpapi,
+        "cisco_nxos": get_config_httpapi,
+    },
+}
+
 OS_CONFIG_COMMAND = {
     "arista_eos": "show running-config",
     "a10": "ignore",
@@ -394,15 +847,177 @@ OS_CONFIG_COMMAND = {
     "linux": "ignore",
 }
 
+# cheap commands whose output changes whenever the device configuration changes. Platforms that are not
+# listed, and devices that are not collected over SSH CLI sessions, always get a full configuration collection in
+# incremental mode.
+OS_CHANGE_MARKER_COMMAND = {
+    "cisco_asa": "show checksum",
+    "cisco_ios": "show running-config | include ^! Last configuration change",
+    "cisco_nxos": "show running-config | include Running configuration last done at",
+    "cisco_xr": "show configuration commit list 1",
+    "juniper_junos": "show system commit | match \"^0 \"",
+    "linux": "md5sum /etc/hostname /etc/network/interfaces /etc/cumulus/ports.conf /etc/frr/frr.conf",
+}
+
+# IOS-XR prints the current time before the output of every show command
+XR_TIMESTAMP_REGEX = re.compile(r"^\w{3} \w{3} +\d+ \d+:\d+:\d+(\.\d+)? \S+$")
+
+
+def get_collector_function(device_os: str, connection: str, file_transfer: bool = False):
+    """
+    The config collector function for devices running device_os with ansible_connection connection. With
+    file_transfer, the configuration of SSH CLI devices is fetched as files where the OS allows it.
+    """
+    if file_transfer and connection == DEFAULT_ANSIBLE_CONNECTION and device_os in OS_CONFIG_FILES:
+        return get_config_file_transfer
+    return CONNECTION_COLLECTOR_FUNCTION.get(connection, OS_COLLECTOR_FUNCTION).get(device_os)
+
+
+def get_manifest_path(collection_directory: str, snapshot_name: str) -> str:
+    return f"{collection_directory}/manifests/{snapshot_name}.json"
+
+
+def load_manifest(collection_directory: str, snapshot_name: str) -> Dict:
+    """
+    Returns the config change markers recorded for a snapshot, keyed by device name
+    """
+    manifest_file = get_manifest_path(collection_directory, snapshot_name)
+    if not Path(manifest_file).exists():
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f).get("devices", {})
+
+
+def save_manifest(collection_directory: str, snapshot_name: str, devices: Dict) -> None:
+    manifest_file = get_manifest_path(collection_directory, snapshot_name)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, "w") as f:
+        json.dump({"snapshot": snapshot_name, "devices": devices}, f, indent=2, sort_keys=True)
+
+
+def find_baseline_snapshot(collection_directory: str, snapshot_name: str) -> Optional[str]:
+    """
+    Returns the most recent snapshot with a manifest, other than snapshot_name
+    """
+    manifest_dir = Path(f"{collection_directory}/manifests")
+    if not manifest_dir.exists():
+        return None
+    # snapshot names are timestamps by default, so they sort in collection order
+    snapshots = sorted(p.stem for p in manifest_dir.glob("*.json") if p.stem != snapshot_name)
+    return snapshots[-1] if len(snapshots) != 0 else None
+
+
+def normalize_change_marker(output: Optional[str]) -> Optional[str]:
+    if output is None:
+        return None
+    lines = [line.strip() for line in output.strip().splitlines()
+             if line.strip() != "" and not XR_TIMESTAMP_REGEX.match(line.strip())]
+    if len(lines) == 0:
+        return None
+    return "\n".join(lines)
+
+
+def carry_forward_config(device_name: str, baseline_path: str, output_path: str, files: list) -> None:
+    """
+    Hardlink a device's configuration files from the baseline snapshot into the new snapshot, or add them to the
+    new snapshot in the object store if one is used
+    """
+    for file_name in files:
+        carry_forward_file(f"{baseline_path}/{device_name}/{file_name}", f"{output_path}/{device_name}/{file_name}")
+
+
+def get_config_incremental(device_session: dict, device_name: str, device_command: str, output_path: str, logger,
+                           cfg_func, marker_command: str, baseline: Optional[Dict], baseline_path: str) -> Dict:
+    """
+    Config collector that skips the configuration transfer if the device's change marker matches the baseline
+    snapshot. Otherwise, cfg_func collects the configuration over the same connection.
+    """
+    logger.info(f"Trying to connect to {device_name}")
+    status = {
+        "name": device_name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "message": "",
+    }
+    try:
+        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+    except netmiko.exceptions.NetmikoTimeoutException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
+        return status
+    except netmiko.exceptions.NetmikoAuthenticationException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.AUTH
+        return status
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        return status
+    except CollectionRetry:
+        raise
+    except Exception as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        return status
+
+    # closed in any case, the device is collected again on a new connection if CollectionRetry is raised
+    try:
+        logger.info(f"Running {marker_command} on {device_name}")
+        marker = normalize_change_marker(net_connect.run_command(marker_command, 60))
+        logger.info(f"Configuration change marker for {device_name} is {marker}")
+
+        if marker is not None and baseline is not None and baseline.get("marker") == marker:
+            try:
+                carry_forward_config(device_name, baseline_path, output_path, baseline.get("files", []))
+            except Exception as e:
+                logger.exception(f"Failed to carry forward configuration, collecting it instead. Exception {e}")
+            else:
+                logger.info(f"Configuration unchanged for {device_name}, carried forward from baseline snapshot")
+                status['status'] = CollectionStatus.PASS
+                status['message'] = "Configuration unchanged, carried forward"
+                status['unchanged'] = True
+                status['change_marker'] = marker
+                status['files'] = baseline.get("files", [])
+                return status
+
+        status = cfg_func(device_session=device_session, device_name=device_name, device_command=device_command,
+                          output_path=output_path, logger=logger, net_connect=net_connect)
+        if status['status'] == CollectionStatus.PASS:
+            status['change_marker'] = marker
+            device_dir = Path(f"{output_path}/{device_name}")
+            status['files'] = sorted(p.name for p in device_dir.iterdir()) if device_dir.exists() else []
+    finally:
+        close_connection(net_connect, logger)
+    return status
+
 
 def main(inventory: Dict, max_threads: int, username: str, password: str, snapshot_name: str,
-         collection_directory: str, log_level: int) -> None:
-    pool = ThreadPoolExecutor(max_threads)
-    future_list = []
+         collection_directory: str, log_level: int, incremental: bool = False,
+         baseline_snapshot: Optional[str] = None, object_store: bool = False,
+         a10_partition_sessions: int = 0, adaptive: bool = False, login_rate: float = 0,
+         group_limits: Dict = None, preflight: bool = False, timing_export: str = None,
+         session_log_policy: str = SessionLogPolicy.FULL.value, file_transfer: bool = False,
+         object_store_link_mode: str = "hardlink") -> None:
+    task_list = []
 
     start_time = time.time()
     print(f"Starting snapshot collection {time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(start_time))}")
 
+    if object_store:
+        set_object_store(ObjectStore(f"{collection_directory}/objects", snapshot_name, object_store_link_mode))
+    if timing_export is not None:
+        start_timing_export(timing_export, snapshot_name, "config")
+    set_session_log_policy(SessionLogPolicy(session_log_policy))
+
+    baseline_manifest = {}
+    if incremental:
+        if baseline_snapshot is None:
+            baseline_snapshot = find_baseline_snapshot(collection_directory, snapshot_name)
+        if baseline_snapshot is None:
+            print("No baseline snapshot found, collecting all configurations")
+        else:
+            print(f"Using {baseline_snapshot} as baseline for incremental collection")
+            baseline_manifest = load_manifest(collection_directory, baseline_snapshot)
+
     for grp, grp_data in inventory.items():
         device_os = AnsibleOsToNetmikoOs.get(grp_data['vars'].get('ansible_network_os'), None)
         if device_os is None:
@@ -418,34 +1033,59 @@ def main(inventory: Dict, max_threads: int, username: str, password: str, snapsh
             logger.info(f"Starting collection for {device_name}")
             logger.info(f"Device vars are {device_vars}")
 
-            # by default use the device name specified in inventory
-            _host = device_name
-            # override it with the IP address if specified in the inventory
-            if device_vars is not None and device_vars.get("ansible_host", None) is not None:
-                _host = device_vars.get("ansible_host")
-                logger.info(f"Using IP {_host} to connect to {device_name}")
-
             # create device_session for netmiko connection handler
-            device_session = {
-                "device_type": device_os,
-                "host": _host,
-                "username": username,
-                "password": password,
-                "session_log": f"{collection_directory}/logs/{snapshot_name}/{device_name}/netmiko_session.log",
-                "fast_cli": False
-            }
+            connection = get_ansible_connection(grp_data['vars'], device_vars)
+            session_log = f"{collection_directory}/logs/{snapshot_name}/{device_name}/netmiko_session.log"
+            device_session = get_device_session(device_os, device_name, device_vars, username, password,
+                                                session_log, logger, connection, grp_data['vars'])
 
             output_path = f"{collection_directory}/{snapshot_name}/configs/"
-            cfg_func = OS_COLLECTOR_FUNCTION.get(device_os)
+            baseline_path = f"{collection_directory}/{baseline_snapshot}/configs/"
+            cfg_func = get_collector_function(device_os, connection, file_transfer)
             cfg_cmd = OS_CONFIG_COMMAND.get(device_os)
+            if cfg_func is get_config_a10 and a10_partition_sessions > 0:
+                cfg_func = functools.partial(get_config_a10, partition_sessions=a10_partition_sessions)
             if cfg_func is None:
-                logger.error(f"No collection function for {device_name} running {device_os}")
+                logger.error(f"No collection function for {device_name} running {device_os} over {connection}")
             elif cfg_cmd is None:
                 logger.error(f"No command set for {device_name} running {device_os}")
+            elif (incremental and connection == DEFAULT_ANSIBLE_CONNECTION
+                  and OS_CHANGE_MARKER_COMMAND.get(device_os) is not None):
+                task_list.append(CollectionTask(device_name, get_config_incremental,
+                                                dict(device_session=device_session, device_name=device_name,
+                                                     device_command=cfg_cmd, output_path=output_path,
+                                                     logger=logger, cfg_func=cfg_func,
+                                                     marker_command=OS_CHANGE_MARKER_COMMAND.get(device_os),
+                                                     baseline=baseline_manifest.get(device_name),
+                                                     baseline_path=baseline_path),
+                                                group=grp))
             else:
-                future = pool.submit(cfg_func, device_session=device_session, device_name=device_name,
-                                     device_command=cfg_cmd, output_path=output_path, logger=logger)
-                future_list.append(future)
+                task_list.append(CollectionTask(device_name, cfg_func,
+                                                dict(device_session=device_session, device_name=device_name,
+                                                     device_command=cfg_cmd, output_path=output_path,
+                                                     logger=logger),
+                                                group=grp))
+
+    unreachable_results = []
+    if preflight:
+        task_list, unreachable_results = preflight_tasks(task_list)
+
+    # start the devices that took longest in previous runs first
+    history = DurationHistory(collection_directory, "config")
+    task_list = history.order_tasks(task_list)
+    predicted = history.predict_makespan(task_list, max_threads)
+    print(f"Predicted collection time {predicted:.0f} seconds for {len(task_list)} devices")
+
+    controller = ConcurrencyController(max_threads, adaptive, login_rate, group_limits)
+    try:
+        results = run_collection(task_list, max_threads, controller=controller)
+    finally:
+        stop_timing_export()
+        stop_log_writer()
+
+    history.record(task_list, results)
+    history.save()
+    results = results + unreachable_results
 
     # TODO: revisit exception handling
     failed_devices = {
@@ -456,12 +1096,22 @@ def main(inventory: Dict, max_threads: int, username: str, password: str, snapsh
         CollectionFailureReason.OTHER: []
     }
     any_failures = False
+    manifest = {}
+    unchanged_devices = []
 
-    for future in as_completed(future_list):
-        if future.result()['status'] != CollectionStatus.PASS:
+    for result in results:
+        if result['status'] != CollectionStatus.PASS:
             any_failures = True
-            reason = future.result()['reason']
-            failed_devices[reason].append(future.result()['name'])
+            reason = result['reason']
+            failed_devices[reason].append(result['name'])
+        elif result.get('change_marker') is not None:
+            manifest[result['name']] = {"marker": result['change_marker'], "files": result['files']}
+            if result.get('unchanged', False):
+                unchanged_devices.append(result['name'])
+
+    if incremental:
+        save_manifest(collection_directory, snapshot_name, manifest)
+        print(f"Configuration unchanged for {len(unchanged_devices)} devices: {unchanged_devices}")
 
     # failed_devices = [future.result()['name'] for future in as_completed(future_list) if
     #                   future.result()['status'] != CollectionStatus.PASS]
@@ -482,12 +1132,44 @@ if __name__ == "__main__":
     parser.add_argument("--inventory", help="Absolute path to inventory file to use", required=True)
     parser.add_argument("--username", help="Username to access devices", required=True, env_var="BF_COLLECTOR_USER")
     parser.add_argument("--password", help="Password to access devices", required=True, env_var="BF_COLLECTOR_PASSWORD")
-    parser.add_argument("--max-threads", help="Max threads for parallel collection. Default = 10, Maximum is 100",
+    parser.add_argument("--max-threads", help="Max devices collected in parallel. Default = 10",
                         type=int, default=10)
     parser.add_argument("--collection-dir", help="Directory for data collection", required=True)
     parser.add_argument("--snapshot-name", help="Name for the snapshot directory",
                         default=datetime.now().strftime("%Y%m%d_%H:%M:%S"))
     parser.add_argument("--log-level", help="Log level", default="warn")
+    parser.add_argument("--incremental", help="Carry forward configurations that did not change since the baseline "
+                                              "snapshot instead of collecting them", action="store_true",
+                        default=False)
+    parser.add_argument("--baseline-snapshot", help="Snapshot to compare against in incremental mode. Default is "
+                                                    "the most recent snapshot with a manifest", default=None)
+    parser.add_argument("--a10-partition-sessions", help="Collect A10 partitions concurrently over this many "
+                                                         "sessions per device. Default = 0, one command for all "
+                                                         "partitions", type=int, default=0)
+    parser.add_argument("--adaptive", help="Adjust the number of concurrent sessions, up to --max-threads, to how "
+                                           "logins are going", action="store_true", default=False)
+    parser.add_argument("--login-rate", help="Max SSH logins per second. Default = 0, no limit", type=float,
+                        default=0)
+    parser.add_argument("--group-limit", help="Max concurrent sessions for an inventory group, as group:limit. Can "
+                                              "be repeated", action="append", default=[])
+    parser.add_argument("--preflight", help="Check that devices accept TCP connections on their SSH port before "
+                                            "collection, and skip the ones that do not", action="store_true",
+                        default=False)
+    parser.add_argument("--timing-export", help="Directory to write per device and per command timing spans "
+                                                "(JSON lines) and a Prometheus textfile summary to", default=None)
+    parser.add_argument("--session-log", help="Netmiko session logs: full, truncated to the first MB, compressed "
+                                              "or off. Default = full", choices=[policy.value for policy in
+                                                                                 SessionLogPolicy],
+                        default=SessionLogPolicy.FULL.value)
+    parser.add_argument("--object-store", help="Deduplicate collected files across snapshots through the object "
+                                               "store in the collection directory", action="store_true",
+                        default=False)
+    parser.add_argument("--object-store-link-mode", help="How snapshot files are linked to the object store: "
+                                                         "hardlinks, or reflinks (copy on write) on filesystems "
+                                                         "that support them. Default = hardlink",
+                        choices=LINK_MODES, default="hardlink")
+    parser.add_argument("--file-transfer", help="Fetch Cumulus and IOS configurations as files over SFTP or SCP "
+                                                "instead of the CLI", action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -504,4 +1186,6 @@ if __name__ == "__main__":
         raise Exception(f"{args.collection_dir} does not exist. Please create the directory and re-run the script")
 
     main(inventory, args.max_threads, args.username, args.password, args.snapshot_name, args.collection_dir,
-         log_level)
+         log_level, args.incremental, args.baseline_snapshot, args.object_store,
+         args.a10_partition_sessions, args.adaptive, args.login_rate, parse_group_limits(args.group_limit),
+         args.preflight, args.timing_export, args.session_log, args.file_transfer, args.object_store_link_mode)
@@ -0,0 +1,102 @@
+import heapq
+import json
+import os
+import statistics
+from typing import Dict, Iterable, List, Optional
+
+from collection_engine import CollectionTask
+
+# weight of the latest run in the moving average of device durations
+HISTORY_SMOOTHING = 0.3
+
+
+class DurationHistory(object):
+    """
+    Moving averages of how long each device took in previous runs, per collection phase and per show command group.
+
+    Used to start the slowest devices first, so a few large devices started near the end of the inventory do not set
+    the total run time.
+    """
+
+    def __init__(self, collection_directory: str, phase: str):
+        self._path = f"{collection_directory}/history/durations.json"
+        self._phase = phase
+        self._devices = self._load().get(phase, {})
+
+    def _load(self) -> Dict:
+        if not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except ValueError:
+            print(f"Ignoring unreadable duration history {self._path}")
+            return {}
+
+    def estimate(self, device_name: str, cmd_groups: Iterable[str] = None) -> Optional[float]:
+        """
+        Expected duration of the device in seconds, None if it has no history.
+
+        If cmd_groups is given and all groups have history, the estimate is the sum of the group durations, so it
+        follows changes to the command file.
+        """
+        device = self._devices.get(device_name)
+        if device is None:
+            return None
+        if cmd_groups is not None:
+            group_times = [device.get("groups", {}).get(cmd_group) for cmd_group in cmd_groups]
+            if len(group_times) != 0 and None not in group_times:
+                return sum(group_times)
+        return device.get("duration")
+
+    def order_tasks(self, tasks: List[CollectionTask], cmd_groups: Dict[str, Iterable[str]] = None) \
+            -> List[CollectionTask]:
+        """
+        Returns the tasks longest expected duration first, devices without history are expected to take the median
+        """
+        cmd_groups = cmd_groups if cmd_groups is not None else {}
+        estimates = {task.name: self.estimate(task.name, cmd_groups.get(task.name)) for task in tasks}
+        known = [estimate for estimate in estimates.values() if estimate is not None]
+        default = statistics.median(known) if len(known) != 0 else 0
+        for task in tasks:
+            task.expected_duration = estimates[task.name] if estimates[task.name] is not None else default
+        # sorted is stable, so devices without history stay in inventory order
+        return sorted(tasks, key=lambda task: task.expected_duration, reverse=True)
+
+    @staticmethod
+    def predict_makespan(tasks: List[CollectionTask], sessions: int) -> float:
+        """
+        Total run time if tasks are started in order on sessions sessions and take their expected duration
+        """
+        finish_times = [0.0] * min(sessions, max(len(tasks), 1))
+        for task in tasks:
+            heapq.heappush(finish_times, heapq.heappop(finish_times) + task.expected_duration)
+        return max(finish_times)
+
+    def record(self, tasks: List[CollectionTask], results: List[Dict]) -> None:
+        for task, result in zip(tasks, results):
+            # durations of retried tasks include the retry delays
+            if task.start_time is None or task.end_time is None or task.retries != 0:
+                continue
+            device = self._devices.setdefault(task.name, {})
+            _update_average(device, "duration", task.end_time - task.start_time)
+            groups = device.setdefault("groups", {})
+            for cmd_group, seconds in result.get("group_times", {}).items():
+                _update_average(groups, cmd_group, seconds)
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        # other phases may have been saved since this one was loaded
+        history = self._load()
+        history[self._phase] = self._devices
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(history, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
+
+
+def _update_average(averages: Dict, key: str, seconds: float) -> None:
+    if key not in averages:
+        averages[key] = seconds
+    else:
+        averages[key] += HISTORY_SMOOTHING * (seconds - averages[key])
@@ -0,0 +1,305 @@
+"""
+JSON-RPC sessions over HTTP(S) with Arista eAPI and Cisco NX-API, used instead of CLI sessions for devices with
+ansible_connection: httpapi.
+
+The commands of a device are sent in a few batched requests over one keep-alive connection, and the outputs come
+back as text, to be saved like the CLI outputs, or as JSON, for BGP neighbor discovery without parsing.
+"""
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Text, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from netmiko.exceptions import NetmikoTimeoutException, NetmikoAuthenticationException, ReadTimeout
+
+from collection_helper import CollectionRetry, LogPayload, gated_login, open_session_log, wait_before_retry
+from instrumentation import span, set_span_tags
+
+HTTP_CONNECT_TIMEOUT = 20  # seconds for the TCP connection and the TLS handshake
+LOGIN_TIMEOUT = 60  # seconds for the first request, which authenticates the session
+# commands per request, a device runs the commands of a request one after the other before it replies
+MAX_BATCH_COMMANDS = 50
+# cheap command sent when the session is opened, to check the credentials
+LOGIN_COMMAND = "show hostname"
+# errors after which the request is sent again
+CONNECTION_ERRORS = (requests.ConnectionError,)
+
+
+class HttpApiError(Exception):
+    pass
+
+
+class EapiProtocol(object):
+    """
+    Arista eAPI runCmds requests. A request stops at the first command that fails, the commands after it are not run.
+    """
+    path = "/command-api"
+    headers = {"Content-Type": "application/json"}
+
+    @staticmethod
+    def request(cmds: List[str], output_format: Text, request_id: int):
+        # commands run unprivileged unless the batch starts with enable
+        return {"jsonrpc": "2.0", "method": "runCmds", "id": str(request_id),
+                "params": {"version": 1, "cmds": ["enable"] + cmds, "format": output_format}}
+
+    @staticmethod
+    def results(reply, cmds: List[str], output_format: Text) -> List[Tuple[Optional[object], Optional[str]]]:
+        """
+        (output, None) for the commands that ran and (None, error) for the one that failed. Commands after a failed
+        one are not in the list.
+        """
+        if "error" not in reply:
+            outputs = reply["result"][1:]
+        else:
+            # data has the results of the commands up to and including the failed one
+            outputs = (reply["error"].get("data") or [])[1:]
+            if len(outputs) == 0:
+                return [(None, reply["error"].get("message", "request failed"))]
+
+        results = []
+        for output in outputs[:len(cmds)]:
+            if isinstance(output, dict) and "errors" in output:
+                results.append((None, "; ".join(output["errors"])))
+                break
+            results.append((output["output"] if output_format == "text" else output, None))
+        return results
+
+
+class NxapiProtocol(object):
+    """
+    Cisco NX-API JSON-RPC requests. Every command of a request is run, whether the ones before it failed or not.
+    """
+    path = "/ins"
+    headers = {"Content-Type": "application/json-rpc"}
+
+    @staticmethod
+    def request(cmds: List[str], output_format: Text, request_id: int):
+        method = "cli_ascii" if output_format == "text" else "cli"
+        return [{"jsonrpc": "2.0", "method": method, "params": {"cmd": cmd, "version": 1},
+                 "id": request_id * MAX_BATCH_COMMANDS + i} for i, cmd in enumerate(cmds)]
+
+    @staticmethod
+    def results(reply, cmds: List[str], output_format: Text) -> List[Tuple[Optional[object], Optional[str]]]:
+        # the reply to a single command is not a list
+        replies = sorted(reply, key=lambda command_reply: command_reply.get("id", 0)) if isinstance(reply, list) \
+            else [reply]
+        results = []
+        for command_reply in replies[:len(cmds)]:
+            if "error" in command_reply:
+                error = command_reply["error"]
+                message = ((error.get("data") or {}).get("msg") or error.get("message", "command failed")).strip()
+                results.append((None, message))
+                continue
+            # commands without output have a null result
+            result = command_reply.get("result") or {}
+            if output_format == "text":
+                results.append((result.get("msg", ""), None))
+            else:
+                results.append((result.get("body", {}), None))
+        return results
+
+
+OS_HTTPAPI_PROTOCOL = {
+    "arista_eos": EapiProtocol,
+    "cisco_nxos": NxapiProtocol,
+}
+
+
+def strip_trailing_newline(output: Text) -> Text:
+    # text outputs end with a newline, CLI outputs saved by netmiko do not
+    return output[:-1] if output.endswith("\n") else output
+
+
+class HttpApiSession(object):
+    """
+    eAPI or NX-API session with a device, with the run_command, stream_command and close methods of
+    RetryingNetConnect so the show data collectors can use it the same way. run_commands sends many commands in one
+    request.
+
+    Login failures raise the same netmiko exceptions as RetryingNetConnect.
+    """
+
+    def __init__(self, device_name: str, device_session: Dict, logger_name: str):
+        self._device_name = device_name
+        self._device_session = device_session
+        self._logger = logging.getLogger(logger_name)
+        self._protocol = OS_HTTPAPI_PROTOCOL[device_session["device_type"]]
+        scheme = "https" if device_session.get("use_ssl", True) else "http"
+        self._url = f"{scheme}://{device_session['host']}:{device_session['port']}{self._protocol.path}"
+        self._session = None
+        self._request_id = 0
+        self._session_log = None
+        session_log = device_session.get("session_log")
+        if session_log is not None:
+            self._session_log = open_session_log(session_log)
+            if isinstance(self._session_log, str):
+                self._session_log = open(self._session_log, "wb")
+        set_span_tags(device=device_name, os=device_session.get("device_type"))
+        try:
+            self._connect()
+        except Exception:
+            self._logger.exception(f"HTTP API connection to {self._device_name} failed")
+            self._close_session_log()
+            raise
+        else:
+            self._logger.info(f"HTTP API session to {self._url}")
+
+    def _connect(self) -> None:
+        gated_login(self._open_connection)
+
+    def _open_connection(self) -> None:
+        self._disconnect()
+        session = requests.Session()
+        # one connection per device, kept alive between the requests
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.auth = (self._device_session["username"], self._device_session["password"])
+        session.verify = self._device_session.get("validate_certs", True)
+        session.headers.update(self._protocol.headers)
+        self._session = session
+        try:
+            with span("connect"):
+                self._post([LOGIN_COMMAND], "text", LOGIN_TIMEOUT)
+        except requests.ConnectionError as e:
+            # like netmiko, refused and timed out connections are timeouts
+            self._disconnect()
+            raise NetmikoTimeoutException(f"HTTP API connection to {self._device_name} failed: {e}")
+        except Exception:
+            self._disconnect()
+            raise
+
+    def _disconnect(self) -> None:
+        if self._session is not None:
+            self._session.close()
+        self._session = None
+
+    def _log_session(self, data: bytes) -> None:
+        if self._session_log is not None:
+            self._session_log.write(data)
+            self._session_log.write(b"\n")
+
+    def _close_session_log(self) -> None:
+        if self._session_log is not None:
+            self._session_log.close()
+            self._session_log = None
+
+    def _post(self, cmds: List[str], output_format: Text, cmd_timer: int) -> List[Tuple[Optional[object],
+                                                                                        Optional[str]]]:
+        self._request_id += 1
+        body = json.dumps(self._protocol.request(cmds, output_format, self._request_id)).encode("utf-8")
+        self._log_session(body)
+        try:
+            response = self._session.post(self._url, data=body, timeout=(HTTP_CONNECT_TIMEOUT, cmd_timer))
+        except requests.ConnectTimeout:
+            raise
+        except requests.Timeout as e:
+            raise ReadTimeout(f"HTTP API reply from {self._device_name} not complete in time: {e}")
+        self._log_session(response.content)
+        if response.status_code == 401:
+            raise NetmikoAuthenticationException(f"Authentication to {self._device_name} failed")
+        # NX-API answers commands that failed with 500 and the JSON-RPC errors in the body
+        try:
+            reply = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise HttpApiError(f"Reply from {self._device_name} is not JSON")
+        return self._protocol.results(reply, cmds, output_format)
+
+    def _post_with_retry(self, cmds: List[str], output_format: Text, cmd_timer: int):
+        try:
+            return self._post(cmds, output_format, cmd_timer)
+        except CONNECTION_ERRORS:
+            self._logger.exception(f"Connection error for a request of {len(cmds)} commands to {self._device_name}")
+            # wait 60 seconds and then try to connect again
+            wait_before_retry(self._device_name, 60, "Connection error")
+            try:
+                self._connect()
+            except Exception:
+                self._logger.exception(f"Could not reconnect to {self._device_name}")
+                raise
+            self._logger.info("Connection re-established, re-trying previous request")
+            return self._post(cmds, output_format, cmd_timer)
+
+    def run_commands(self, cmds: List[str], cmd_timer: int,
+                     output_format: Text = "text") -> List[Tuple[Optional[object], Optional[str]]]:
+        """
+        Runs the commands in requests of up to MAX_BATCH_COMMANDS commands, each with cmd_timer seconds for the reply.
+
+        Returns (output, None) for each command that succeeded and (None, error) for each that failed, in the order
+        of cmds. Text outputs are strings, JSON outputs dicts. Raises if a request failed as a whole.
+        """
+        results = []
+        pending = list(cmds)
+        while len(pending) != 0:
+            batch = pending[:MAX_BATCH_COMMANDS]
+            self._logger.info(f"Sending {len(batch)} commands to {self._device_name} in one request")
+            with span("run_batch", commands=len(batch), channel="httpapi"):
+                batch_results = self._post_with_retry(batch, output_format, cmd_timer)
+            if len(batch_results) == 0:
+                raise HttpApiError(f"No results in the reply from {self._device_name}")
+            if output_format == "text":
+                batch_results = [(strip_trailing_newline(output) if output is not None else None, error)
+                                 for output, error in batch_results]
+            results.extend(batch_results)
+            # eAPI does not run the commands after a failed one, send them again in the next request
+            pending = pending[len(batch_results):]
+        for cmd, (output, error) in zip(cmds, results):
+            if error is not None:
+                self._logger.error(f"Command {cmd} to {self._device_name} failed: {error}")
+        return results
+
+    def run_command(self, cmd: str, cmd_timer: int, pattern=None) -> Optional[str]:
+        """
+        Runs a command in its own request and returns its text output, or None if it failed. There is no prompt,
+        pattern is ignored.
+        """
+        try:
+            output, error = self.run_commands([cmd], cmd_timer)[0]
+        except CollectionRetry:
+            raise
+        except Exception:
+            self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+            return None
+        if output is not None:
+            self._logger.debug("Output of %s to %s: %s", cmd, self._device_name, LogPayload(output))
+        return output
+
+    def run_structured_command(self, cmd: str, cmd_timer: int) -> Optional[Dict]:
+        """
+        Runs a command with JSON output and returns it, or None if it failed
+        """
+        try:
+            output, error = self.run_commands([cmd], cmd_timer, "json")[0]
+        except CollectionRetry:
+            raise
+        except Exception:
+            self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+            return None
+        return output
+
+    def stream_command(self, cmd: str, cmd_timer: int, file_path: str, pattern=None, prepend_text=None) -> bool:
+        """
+        Like run_command, but the output is written to file_path. The output arrives in a JSON reply, so unlike
+        with RetryingNetConnect it is in memory once before it is written.
+
+        Returns False if the command failed, in which case the file content is not the command output.
+        """
+        output = self.run_command(cmd, cmd_timer)
+        if output is None:
+            return False
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with span("write_file", command=cmd), open(file_path, "w") as f:
+            if prepend_text is not None:
+                f.write(prepend_text)
+                f.write("\n")
+            f.write(output)
+        return True
+
+    def close(self) -> None:
+        try:
+            self._disconnect()
+        finally:
+            self._close_session_log()
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Text
+
+# set with set_span_recorder, spans are not recorded without one
+_RECORDER = None
+# tags added to every span recorded on the thread, like the device being collected
+_span_tags = threading.local()
+
+
+def _label_value(value) -> Text:
+    """
+    Escapes a Prometheus label value, a missing value is an empty string
+    """
+    if value is None:
+        return ""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class SpanRecorder(object):
+    """
+    Writes every span as a JSON line and keeps per span totals for the Prometheus textfile summary
+    """
+
+    def __init__(self, spans_file: Text, prom_file: Text, phase: Text):
+        self._prom_file = prom_file
+        self._phase = phase
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(spans_file)), exist_ok=True)
+        self._spans_file = open(spans_file, "a")
+        # (span, os) -> [count, total seconds, max seconds]
+        self._totals = {}
+        # device -> (os, seconds) of the device spans
+        self._devices = {}
+
+    def record(self, name: Text, start_time: float, seconds: float, tags: Dict, error: Optional[Text]) -> None:
+        span = {"span": name, "phase": self._phase, "start": round(start_time, 3), "seconds": round(seconds, 6)}
+        span.update(tags)
+        if error is not None:
+            span["error"] = error
+        line = json.dumps(span)
+        with self._lock:
+            self._spans_file.write(f"{line}\n")
+            # devices without a device_type have an os tag of None
+            device_os = tags.get("os") or ""
+            totals = self._totals.setdefault((name, device_os), [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            if name == "device":
+                self._devices[tags.get("device") or ""] = (device_os, seconds)
+
+    def close(self) -> None:
+        with self._lock:
+            self._spans_file.close()
+
+    def write_prometheus(self) -> None:
+        """
+        Writes the summary in the Prometheus text format, replacing the file atomically for the textfile collector
+        """
+        lines = [
+            "# HELP snapshot_collector_span_seconds_total Time spent in collection spans",
+            "# TYPE snapshot_collector_span_seconds_total counter",
+        ]
+        phase = _label_value(self._phase)
+        with self._lock:
+            totals = [((_label_value(name), _label_value(device_os)), values)
+                      for (name, device_os), values in sorted(self._totals.items())]
+            devices = [(_label_value(device), (_label_value(device_os), seconds))
+                       for device, (device_os, seconds) in sorted(self._devices.items())]
+        for (name, device_os), (count, seconds, _) in totals:
+            lines.append(f'snapshot_collector_span_seconds_total{{phase="{phase}",span="{name}",'
+                         f'os="{device_os}"}} {seconds:.6f}')
+        lines.extend(["# HELP snapshot_collector_spans_total Number of collection spans",
+                      "# TYPE snapshot_collector_spans_total counter"])
+        for (name, device_os), (count, seconds, _) in totals:
+            lines.append(f'snapshot_collector_spans_total{{phase="{phase}",span="{name}",'
+                         f'os="{device_os}"}} {count}')
+        lines.extend(["# HELP snapshot_collector_span_max_seconds Longest collection span",
+                      "# TYPE snapshot_collector_span_max_seconds gauge"])
+        for (name, device_os), (_, _, max_seconds) in totals:
+            lines.append(f'snapshot_collector_span_max_seconds{{phase="{phase}",span="{name}",'
+                         f'os="{device_os}"}} {max_seconds:.6f}')
+        lines.extend(["# HELP snapshot_collector_device_seconds Time to collect a device",
+                      "# TYPE snapshot_collector_device_seconds gauge"])
+        for device, (device_os, seconds) in devices:
+            lines.append(f'snapshot_collector_device_seconds{{phase="{phase}",device="{device}",'
+                         f'os="{device_os}"}} {seconds:.6f}')
+        lines.extend(["# HELP snapshot_collector_last_run_timestamp_seconds When the collection finished",
+                      "# TYPE snapshot_collector_last_run_timestamp_seconds gauge",
+                      f'snapshot_collector_last_run_timestamp_seconds{{phase="{phase}"}} {time.time():.0f}'])
+
+        tmp_file = f"{self._prom_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines))
+            f.write("\n")
+        os.replace(tmp_file, self._prom_file)
+
+
+def set_span_recorder(recorder: Optional[SpanRecorder]) -> None:
+    global _RECORDER
+    _RECORDER = recorder
+
+
+def start_timing_export(export_dir: Text, snapshot_name: Text, phase: Text) -> None:
+    """
+    Records spans to <export_dir>/<snapshot_name>_<phase>_spans.jsonl until stop_timing_export is called, which
+    writes the summary to <export_dir>/snapshot_collector_<phase>.prom
+    """
+    set_span_recorder(SpanRecorder(f"{export_dir}/{snapshot_name}_{phase}_spans.jsonl",
+                                   f"{export_dir}/snapshot_collector_{phase}.prom", phase))
+
+
+def stop_timing_export() -> None:
+    """
+    Stops recording spans and writes the Prometheus textfile summary next to the spans
+    """
+    recorder = _RECORDER
+    if recorder is None:
+        return
+    set_span_recorder(None)
+    recorder.close()
+    recorder.write_prometheus()
+
+
+def spans_enabled() -> bool:
+    return _RECORDER is not None
+
+
+def set_span_tags(**tags) -> None:
+    """
+    Adds tags to the spans recorded on this thread until the enclosing span_context exits, a tag set to None
+    is removed
+    """
+    if not hasattr(_span_tags, "tags"):
+        _span_tags.tags = {}
+    for key, value in tags.items():
+        if value is None:
+            _span_tags.tags.pop(key, None)
+        else:
+            _span_tags.tags[key] = value
+
+
+def get_span_tags() -> Dict:
+    """
+    Copy of this thread's tags, to tag spans recorded on other threads for the same work with span_context
+    """
+    return dict(getattr(_span_tags, "tags", {}))
+
+
+@contextmanager
+def span_context(**tags):
+    """
+    Tags the spans recorded on this thread inside the context, on top of the tags already set
+    """
+    previous = getattr(_span_tags, "tags", {})
+    _span_tags.tags = dict(previous)
+    set_span_tags(**tags)
+    try:
+        yield
+    finally:
+        _span_tags.tags = previous
+
+
+@contextmanager
+def span(name: Text, **tags):
+    """
+    Times the code inside the context and records it with the thread's tags and tags
+    """
+    recorder = _RECORDER
+    if recorder is None:
+        yield
+        return
+
+    start_time = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        span_tags = dict(getattr(_span_tags, "tags", {}))
+        span_tags.update({key: value for key, value in tags.items() if value is not None})
+        recorder.record(name, start_time, time.perf_counter() - start, span_tags, error)
@@ -0,0 +1,412 @@
+"""
+NETCONF sessions over SSH (RFC 6241 and RFC 6242), used instead of CLI sessions for devices with
+ansible_connection: netconf.
+
+Replies are parsed as they arrive and the text of their output elements is written straight to the output file, so
+memory use does not depend on the size of the configuration or routing table.
+"""
+import io
+import logging
+import os
+import socket
+import time
+import xml.etree.ElementTree as ElementTree
+from typing import Dict, Optional, Text
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+import paramiko
+from netmiko.exceptions import NetmikoTimeoutException, NetmikoAuthenticationException, ReadTimeout
+
+from collection_helper import (CollectionRetry, CONNECTION_DEFAULT_PORT, LogPayload, gated_login, open_session_log,
+                               wait_before_retry)
+from instrumentation import span, set_span_tags
+
+NETCONF_NS = "urn:ietf:params:xml:ns:netconf:base:1.0"
+BASE_1_0 = "urn:ietf:params:netconf:base:1.0"
+BASE_1_1 = "urn:ietf:params:netconf:base:1.1"
+# base:1.0 messages end with this marker, base:1.1 messages are sent in chunks
+END_OF_MESSAGE = b"]]>]]>"
+MAX_CHUNK_HEADER = 16  # bytes, a chunk size is at most 10 digits
+NETCONF_CONNECT_TIMEOUT = 20  # seconds for the TCP connection, the SSH banner and authentication
+HELLO_TIMEOUT = 60  # seconds to wait for the device's hello
+NETCONF_READ_SIZE = 65536
+# elements of Junos rpc-replies with the CLI output, of <command format="text"> and of <get-configuration>
+TEXT_OUTPUT_ELEMENTS = ["output", "configuration-output", "configuration-set", "configuration-text"]
+CLIENT_HELLO = (f'<?xml version="1.0" encoding="UTF-8"?><hello xmlns="{NETCONF_NS}"><capabilities>'
+                f'<capability>{BASE_1_0}</capability><capability>{BASE_1_1}</capability>'
+                f'</capabilities></hello>').encode("utf-8")
+# errors after which the session is reopened and the RPC sent again
+CONNECTION_ERRORS = (socket.error, EOFError, paramiko.SSHException)
+
+
+class NetconfError(Exception):
+    pass
+
+
+class NetconfRpcError(NetconfError):
+    """
+    The device answered an RPC with rpc-errors of severity error
+    """
+
+
+class _ReplyWriter(object):
+    """
+    Incremental parser of one rpc-reply that writes the text of its output elements to out_file as it is fed
+    """
+
+    def __init__(self, out_file):
+        self._out_file = out_file
+        self._parser = expat.ParserCreate(namespace_separator=" ")
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+        self._path = []
+        self._output_depth = 0
+        # the text of an output element starts and ends with a newline that is not part of the output, so files
+        # are the same as the ones saved from CLI sessions
+        self._output_start = False
+        self._newline_pending = False
+        self._error = None
+        # [{"error-severity": ..., "error-message": ...}]
+        self.errors = []
+
+    def _start(self, name: Text, attrs: Dict) -> None:
+        local_name = name.rsplit(" ", 1)[-1]
+        self._path.append(local_name)
+        if local_name in TEXT_OUTPUT_ELEMENTS:
+            self._output_depth += 1
+            self._output_start = True
+        elif local_name == "rpc-error":
+            self._error = {}
+
+    def _end(self, name: Text) -> None:
+        local_name = self._path.pop()
+        if local_name in TEXT_OUTPUT_ELEMENTS:
+            self._output_depth -= 1
+            self._newline_pending = False
+        elif local_name == "rpc-error":
+            self.errors.append(self._error)
+            self._error = None
+
+    def _data(self, data: Text) -> None:
+        if self._error is not None:
+            self._error[self._path[-1]] = self._error.get(self._path[-1], "") + data
+        elif self._output_depth > 0:
+            if self._output_start and data.startswith("\n"):
+                data = data[1:]
+            self._output_start = False
+            if len(data) == 0:
+                return
+            if self._newline_pending:
+                self._out_file.write("\n")
+            self._newline_pending = data.endswith("\n")
+            self._out_file.write(data[:-1] if self._newline_pending else data)
+
+    def feed(self, data: bytes) -> None:
+        try:
+            self._parser.Parse(data, False)
+        except expat.ExpatError as e:
+            raise NetconfError(f"Malformed rpc-reply: {e}")
+
+    def close(self) -> None:
+        try:
+            self._parser.Parse(b"", True)
+        except expat.ExpatError as e:
+            raise NetconfError(f"Malformed rpc-reply: {e}")
+
+
+class NetconfSession(object):
+    """
+    NETCONF session with a device, with the run_command, stream_command and close methods of RetryingNetConnect so
+    the show data collectors can use it the same way.
+
+    Login failures raise the same netmiko exceptions as RetryingNetConnect.
+    """
+
+    def __init__(self, device_name: str, device_session: Dict, logger_name: str):
+        self._device_name = device_name
+        self._device_session = device_session
+        self._logger = logging.getLogger(logger_name)
+        self._client = None
+        self._channel = None
+        self._buffer = b""
+        # base:1.1 chunked framing, if both ends support it
+        self._chunked = False
+        self._message_id = 0
+        # set when a reply was not read to the end, the session has to be reopened before the next RPC
+        self._broken = False
+        self._session_log = None
+        session_log = device_session.get("session_log")
+        if session_log is not None:
+            self._session_log = open_session_log(session_log)
+            if isinstance(self._session_log, str):
+                self._session_log = open(self._session_log, "wb")
+        set_span_tags(device=device_name, os=device_session.get("device_type"))
+        try:
+            self._connect()
+        except Exception:
+            self._logger.exception(f"NETCONF connection to {self._device_name} failed")
+            self._close_session_log()
+            raise
+        else:
+            self._logger.info(f"NETCONF session to {self._device_name}, "
+                              f"{'base:1.1' if self._chunked else 'base:1.0'} framing")
+
+    def _connect(self) -> None:
+        gated_login(self._open_connection)
+
+    def _open_connection(self) -> None:
+        self._disconnect()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            with span("connect"):
+                client.connect(self._device_session["host"],
+                               port=self._device_session.get("port", CONNECTION_DEFAULT_PORT["netconf"]),
+                               username=self._device_session["username"],
+                               password=self._device_session["password"], timeout=NETCONF_CONNECT_TIMEOUT,
+                               banner_timeout=NETCONF_CONNECT_TIMEOUT, auth_timeout=NETCONF_CONNECT_TIMEOUT,
+                               look_for_keys=False, allow_agent=False)
+                channel = client.get_transport().open_session(timeout=NETCONF_CONNECT_TIMEOUT)
+                channel.invoke_subsystem("netconf")
+        except paramiko.AuthenticationException as e:
+            client.close()
+            raise NetmikoAuthenticationException(f"Authentication to {self._device_name} failed: {e}")
+        except socket.error as e:
+            # like netmiko, refused and timed out connections are timeouts
+            client.close()
+            raise NetmikoTimeoutException(f"NETCONF connection to {self._device_name} failed: {e}")
+        except Exception:
+            client.close()
+            raise
+
+        self._client = client
+        self._channel = channel
+        self._buffer = b""
+        self._chunked = False
+        self._broken = False
+        with span("session_preparation"):
+            self._exchange_hello()
+
+    def _exchange_hello(self) -> None:
+        # hellos are always framed with the base:1.0 end of message marker
+        self._send(CLIENT_HELLO)
+        hello = b"".join(self._read_message(time.time() + HELLO_TIMEOUT)).strip()
+        try:
+            capabilities = [capability.text.strip() for capability in
+                            ElementTree.fromstring(hello).iter(f"{{{NETCONF_NS}}}capability")
+                            if capability.text is not None]
+        except ElementTree.ParseError as e:
+            raise NetconfError(f"Malformed hello from {self._device_name}: {e}")
+        self._chunked = BASE_1_1 in capabilities
+
+    def _disconnect(self) -> None:
+        if self._client is not None:
+            self._client.close()
+        self._client = None
+        self._channel = None
+
+    def _log_session(self, data: bytes) -> None:
+        if self._session_log is not None:
+            self._session_log.write(data)
+
+    def _close_session_log(self) -> None:
+        if self._session_log is not None:
+            self._session_log.close()
+            self._session_log = None
+
+    def _send(self, message: bytes) -> None:
+        if self._chunked:
+            data = b"\n#%d\n%s\n##\n" % (len(message), message)
+        else:
+            data = message + END_OF_MESSAGE
+        self._log_session(data)
+        self._channel.sendall(data)
+
+    def _recv(self, deadline: float) -> bytes:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ReadTimeout(f"NETCONF reply from {self._device_name} not complete in time")
+        self._channel.settimeout(remaining)
+        try:
+            data = self._channel.recv(NETCONF_READ_SIZE)
+        except socket.timeout:
+            raise ReadTimeout(f"NETCONF reply from {self._device_name} not complete in time")
+        if not data:
+            raise EOFError(f"{self._device_name} closed the NETCONF session")
+        self._log_session(data)
+        return data
+
+    def _fill(self, deadline: float, size: int) -> None:
+        while len(self._buffer) < size:
+            self._buffer += self._recv(deadline)
+
+    def _read_message(self, deadline: float):
+        """
+        Yields the bytes of the next message, without the framing, as they arrive
+        """
+        if not self._chunked:
+            while True:
+                end = self._buffer.find(END_OF_MESSAGE)
+                if end != -1:
+                    message, self._buffer = self._buffer[:end], self._buffer[end + len(END_OF_MESSAGE):]
+                    yield message
+                    return
+                # keep the bytes that could be the start of an end of message marker split across reads
+                keep = len(END_OF_MESSAGE) - 1
+                if len(self._buffer) > keep:
+                    yield self._buffer[:-keep]
+                    self._buffer = self._buffer[-keep:]
+                self._buffer += self._recv(deadline)
+
+        while True:
+            # a chunk starts with \n#<size>\n, the end of the chunks is \n##\n
+            self._fill(deadline, 3)
+            if not self._buffer.startswith(b"\n#"):
+                raise NetconfError(f"Bad chunk header from {self._device_name}: {self._buffer[:MAX_CHUNK_HEADER]}")
+            if self._buffer[2:3] == b"#":
+                self._fill(deadline, 4)
+                self._buffer = self._buffer[4:]
+                return
+            while self._buffer.find(b"\n", 2) == -1:
+                if len(self._buffer) > MAX_CHUNK_HEADER:
+                    raise NetconfError(f"Bad chunk header from {self._device_name}: "
+                                       f"{self._buffer[:MAX_CHUNK_HEADER]}")
+                self._buffer += self._recv(deadline)
+            header_end = self._buffer.index(b"\n", 2)
+            try:
+                size = int(self._buffer[2:header_end])
+            except ValueError:
+                raise NetconfError(f"Bad chunk header from {self._device_name}: {self._buffer[:header_end]}")
+            self._buffer = self._buffer[header_end + 1:]
+            while size > 0:
+                if len(self._buffer) == 0:
+                    self._buffer = self._recv(deadline)
+                data = self._buffer[:size]
+                self._buffer = self._buffer[size:]
+                size -= len(data)
+                yield data
+
+    def _rpc(self, operation: Text, cmd_timer: int, out_file) -> None:
+        """
+        Sends an RPC and writes the output text of the reply to out_file as it arrives
+        """
+        if self._broken:
+            self._logger.info(f"Reopening the NETCONF session to {self._device_name}")
+            self._connect()
+        self._message_id += 1
+        rpc = f'<rpc message-id="{self._message_id}" xmlns="{NETCONF_NS}">{operation}</rpc>'
+        reply = _ReplyWriter(out_file)
+        self._broken = True
+        self._send(rpc.encode("utf-8"))
+        for data in self._read_message(time.time() + cmd_timer):
+            reply.feed(data)
+        self._broken = False
+        reply.close()
+
+        errors = []
+        for error in reply.errors:
+            message = (error.get("error-message") or error.get("error-tag") or "").strip()
+            if error.get("error-severity", "error").strip() == "warning":
+                self._logger.warning(f"RPC warning from {self._device_name}: {message}")
+            else:
+                errors.append(message)
+        if len(errors) != 0:
+            raise NetconfRpcError(f"RPC {operation} failed on {self._device_name}: {'; '.join(errors)}")
+
+    def _rpc_with_retry(self, operation: Text, cmd_timer: int, run) -> None:
+        try:
+            run()
+        except CONNECTION_ERRORS:
+            self._logger.exception(f"Connection error for {operation} to {self._device_name}")
+            # wait 60 seconds and then try to establish a new NETCONF session
+            wait_before_retry(self._device_name, 60, f"Connection error for {operation}")
+            try:
+                self._connect()
+            except Exception:
+                self._logger.exception(f"Could not reconnect to {self._device_name}")
+                raise
+            self._logger.info("Connection re-established, re-trying previous RPC")
+            run()
+
+    def _stream_rpc(self, operation: Text, cmd_timer: int, file_path: str, prepend_text=None) -> None:
+        def _stream():
+            with open(file_path, "w") as f:
+                if prepend_text is not None:
+                    f.write(prepend_text)
+                    f.write("\n")
+                self._rpc(operation, cmd_timer, f)
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        self._rpc_with_retry(operation, cmd_timer, _stream)
+
+    @staticmethod
+    def _command_rpc(cmd: str) -> Text:
+        return f'<command format="text">{escape(cmd)}</command>'
+
+    def run_command(self, cmd: str, cmd_timer: int, pattern=None) -> Optional[str]:
+        """
+        Runs a CLI show command with the Junos <command> RPC and returns its text output, or None if it failed.
+        There is no prompt, pattern is ignored.
+        """
+        output = io.StringIO()
+
+        def _run():
+            output.seek(0)
+            output.truncate()
+            self._rpc(self._command_rpc(cmd), cmd_timer, output)
+
+        try:
+            with span("run_command", command=cmd, channel="netconf"):
+                self._rpc_with_retry(cmd, cmd_timer, _run)
+        except CollectionRetry:
+            raise
+        except Exception:
+            self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+            return None
+        self._logger.debug("Output of %s to %s: %s", cmd, self._device_name, LogPayload(output.getvalue()))
+        return output.getvalue()
+
+    def stream_command(self, cmd: str, cmd_timer: int, file_path: str, pattern=None, prepend_text=None) -> bool:
+        """
+        Like run_command, but the output is streamed to file_path.
+
+        Returns False if the command failed, in which case the file content is not the command output.
+        """
+        try:
+            self._logger.info(f"Streaming output of {cmd} to {file_path}")
+            with span("stream_command", command=cmd, channel="netconf"):
+                self._stream_rpc(self._command_rpc(cmd), cmd_timer, file_path, prepend_text)
+        except CollectionRetry:
+            raise
+        except Exception:
+            self._logger.exception(f"Command {cmd} to {self._device_name} failed")
+            return False
+        return True
+
+    def stream_configuration(self, cmd_timer: int, file_path: str, config_format: Text = "set") -> None:
+        """
+        Streams the committed configuration, in set format by default, to file_path with get-configuration.
+
+        Raises if the configuration could not be retrieved.
+        """
+        self._logger.info(f"Streaming {config_format} configuration to {file_path}")
+        with span("stream_command", command="get-configuration", channel="netconf"):
+            self._stream_rpc(f'<get-configuration format="{escape(config_format)}"/>', cmd_timer, file_path)
+
+    def close(self) -> None:
+        try:
+            if self._channel is not None and not self._broken:
+                self._message_id += 1
+                self._send(f'<rpc message-id="{self._message_id}" xmlns="{NETCONF_NS}">'
+                           f'<close-session/></rpc>'.encode("utf-8"))
+                # the reply does not matter, the session is closed either way
+                for _ in self._read_message(time.time() + NETCONF_CONNECT_TIMEOUT):
+                    pass
+        except Exception as e:
+            self._logger.info(f"No reply to close-session from {self._device_name}: {e}")
+        finally:
+            self._disconnect()
+            self._close_session_log()
@@ -0,0 +1,121 @@
+import asyncio
+import ipaddress
+import socket
+from typing import Dict, List, Optional, Text, Tuple
+
+from collection_engine import CollectionTask
+from collection_helper import CollectionStatus, CollectionFailureReason, release_logger
+
+PREFLIGHT_TIMEOUT = 3  # seconds to wait for the TCP handshake
+PREFLIGHT_CONCURRENCY = 256  # probes in flight
+
+# name lookups are done once per run, netmiko then connects to the address found here
+_DNS_CACHE = {}
+
+
+async def _resolve(host: Text, port: int) -> List[Text]:
+    if host not in _DNS_CACHE:
+        loop = asyncio.get_running_loop()
+        addr_info = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        # keep the resolver's order, without duplicates
+        _DNS_CACHE[host] = list(dict.fromkeys(sockaddr[0] for _, _, _, _, sockaddr in addr_info))
+    return _DNS_CACHE[host]
+
+
+async def _probe(host: Text, port: int, timeout: float, semaphore: asyncio.Semaphore) -> Tuple[Optional[Text],
+                                                                                               Optional[Text]]:
+    """
+    Returns the first address of host accepting connections on port, or the reason none did
+    """
+    async with semaphore:
+        try:
+            addresses = await _resolve(host, port)
+        except socket.gaierror as e:
+            return None, f"Name lookup for {host} failed: {e}"
+
+        error = None
+        for address in addresses:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+            except asyncio.TimeoutError:
+                error = f"no response in {timeout} seconds"
+                continue
+            except OSError as e:
+                error = str(e)
+                continue
+            writer.close()
+            return address, None
+        return None, f"TCP port {port} on {host} unreachable: {error}"
+
+
+async def _probe_dns(host: Text, port: int) -> None:
+    try:
+        await _resolve(host, port)
+    except socket.gaierror:
+        pass
+
+
+async def _probe_all(targets: Dict[Text, Tuple[Text, int]], timeout: float, concurrency: int) -> Dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    # resolve every name once, before devices sharing it start probing
+    hosts = {host: port for host, port in targets.values()}
+    await asyncio.gather(*[_probe_dns(host, port) for host, port in hosts.items()])
+    results = await asyncio.gather(*[_probe(host, port, timeout, semaphore) for host, port in targets.values()])
+    return dict(zip(targets.keys(), results))
+
+
+def check_reachability(targets: Dict[Text, Tuple[Text, int]], timeout: float = PREFLIGHT_TIMEOUT,
+                       concurrency: int = PREFLIGHT_CONCURRENCY) -> Dict[Text, Tuple[Optional[Text], Optional[Text]]]:
+    """
+    Probes {device_name: (host, port)} concurrently.
+
+    Returns {device_name: (address, None)} for reachable devices and {device_name: (None, reason)} otherwise.
+    """
+    return asyncio.run(_probe_all(targets, timeout, concurrency))
+
+
+def _is_ip_address(host: Text) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def preflight_tasks(tasks: List[CollectionTask], timeout: float = PREFLIGHT_TIMEOUT) -> Tuple[List[CollectionTask],
+                                                                                               List[Dict]]:
+    """
+    Splits collection tasks into the ones for reachable devices, which are pointed at the address that answered,
+    and CONNECT_TIMEOUT statuses for the devices that did not answer. httpapi devices keep their host name.
+    """
+    targets = {task.name: (task.kwargs['device_session']['host'], task.kwargs['device_session'].get('port', 22))
+               for task in tasks}
+    print(f"Checking reachability of {len(targets)} devices")
+    reachability = check_reachability(targets, timeout)
+
+    reachable = []
+    unreachable = []
+    for task in tasks:
+        device_session = task.kwargs['device_session']
+        logger = task.kwargs['logger']
+        address, reason = reachability[task.name]
+        if address is None:
+            logger.error(f"Skipping {task.name}, pre-flight check failed. {reason}")
+            release_logger(logger.name)
+            unreachable.append({
+                "name": task.name,
+                "status": CollectionStatus.FAIL,
+                "reason": CollectionFailureReason.CONNECT_TIMEOUT,
+                "failed_commands": ["All"],
+                "message": f"Pre-flight check failed. {reason}",
+            })
+            continue
+        # httpapi sessions keep the name, TLS verifies the certificate against it and sends it for SNI
+        if "use_ssl" not in device_session and not _is_ip_address(device_session['host']):
+            logger.info(f"Using {address}, resolved from {device_session['host']}, to connect to {task.name}")
+            device_session['host'] = address
+        reachable.append(task)
+
+    if len(unreachable) != 0:
+        print(f"{len(unreachable)} devices unreachable: {[result['name'] for result in unreachable]}")
+    return reachable, unreachable
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+from typing import Set
+
+# value of the status field of a device record, only devices whose collection passed are recorded
+DEVICE_COMPLETE = "complete"
+
+
+class ProgressJournal(object):
+    """
+    Record of the show commands and devices that completed in a snapshot, so an interrupted collection can be
+    resumed without running them again.
+
+    Records are JSON lines appended and flushed as each command and device completes, so the journal survives the
+    collector being killed. A line cut short by that is dropped when the journal is read back.
+
+    Commands are also kept in memory as they complete, so a device that is collected again after a deferred retry
+    does not run them again either.
+    """
+
+    def __init__(self, collection_directory: str, snapshot_name: str, phase: str, resume: bool = False):
+        self._path = f"{collection_directory}/logs/{snapshot_name}/{phase}_journal.jsonl"
+        self._lock = threading.Lock()
+        self._devices = set()
+        self._commands = {}
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        if resume:
+            self._load()
+        # a new collection under an existing snapshot name starts a new journal
+        self._file = open(self._path, "a" if resume else "w")
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, "rb+") as f:
+            content = f.read()
+            complete_length = content.rfind(b"\n") + 1
+            if complete_length != len(content):
+                # the last record was being written when the collector stopped
+                f.truncate(complete_length)
+        for line in content[:complete_length].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"Ignoring unreadable record in {self._path}: {line[:100]}")
+                continue
+            if record.get("status") == DEVICE_COMPLETE:
+                self._devices.add(record["device"])
+            elif "command" in record:
+                self._commands.setdefault(record["device"], set()).add(record["command"])
+
+    def _append(self, record: dict) -> None:
+        with self._lock:
+            self._file.write(f"{json.dumps(record)}\n")
+            self._file.flush()
+
+    @property
+    def completed_devices(self) -> Set[str]:
+        """
+        Devices whose collection passed before the collection was resumed
+        """
+        return set(self._devices)
+
+    def completed_commands(self, device_name: str) -> Set[str]:
+        """
+        Commands that succeeded on the device, in this run or before the collection was resumed
+        """
+        with self._lock:
+            return set(self._commands.get(device_name, set()))
+
+    def command_done(self, device_name: str, cmd: str) -> None:
+        with self._lock:
+            self._commands.setdefault(device_name, set()).add(cmd)
+        self._append({"device": device_name, "command": cmd})
+
+    def device_done(self, device_name: str) -> None:
+        self._append({"device": device_name, "status": DEVICE_COMPLETE})
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,379 @@
+"""
+Columnar store of the routes and BGP RIB entries in the collected show data.
+
+The routes_v4 and bgp_v4 outputs of each device are parsed once, after collection, into one compressed numpy file
+per device in routes/<snapshot name>/ in the collection directory. Prefixes are stored as integer and length arrays,
+and the output file, VRF, next hop and protocol of each route as codes into per device dictionaries, so the routes
+of a whole network load in seconds with load_route_table.
+"""
+import os
+import re
+import socket
+import struct
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Text, Tuple
+
+import configargparse
+import numpy as np
+import pandas as pd
+
+from collection_helper import get_inventory, AnsibleOsToNetmikoOs
+
+DEFAULT_VRF = "default"
+# route table codes, first letter of the code column, and their protocols
+ROUTE_CODE_PROTOCOLS = {
+    "A": "aggregate",
+    "B": "bgp",
+    "C": "connected",
+    "D": "eigrp",
+    "E": "egp",
+    "I": "isis",
+    "K": "kernel",
+    "L": "local",
+    "M": "mobile",
+    "O": "ospf",
+    "R": "rip",
+    "S": "static",
+    "U": "static",
+    "i": "isis",
+    "o": "odr",
+}
+# columns of a device file, and the columns that are codes into a dictionary named after the column with an s
+COLUMNS = ["table", "vrf", "prefix", "length", "next_hop", "protocol"]
+DICTIONARY_COLUMNS = ["table", "vrf", "next_hop", "protocol"]
+
+IPV4 = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
+# IOS style route tables: code, prefix with or without length, and the rest of the line
+ROUTE_LINE = re.compile(rf"^(?P<code>[A-Za-z][A-Za-z0-9*+%&> ]{{0,7}}?)\s+(?P<prefix>{IPV4})(?:/(?P<length>\d+))?"
+                        r"(?P<rest>.*)$")
+# ECMP paths of the route on the line before
+ROUTE_CONTINUATION_LINE = re.compile(r"^\s+(?:\[\d+/\d+\]\s+)?via\s+(?P<next_hop>[^\s,]+)")
+# IOS classful network headers, their length applies to the routes under them that are printed without one
+SUBNETTED_LINE = re.compile(rf"^\s+(?P<prefix>{IPV4})/(?P<length>\d+) is subnetted")
+ROUTE_VRF_LINE = re.compile(r"^\s*(?:VRF|Routing Table):\s*(?P<vrf>\S+)")
+# NX-OS route tables, a prefix line followed by its paths
+NXOS_VRF_LINE = re.compile(r'^IP Route Table for VRF "(?P<vrf>[^"]+)"')
+NXOS_PREFIX_LINE = re.compile(rf"^(?P<prefix>{IPV4})/(?P<length>\d+), ubest/mbest")
+NXOS_PATH_LINE = re.compile(r"^\s+\*?via (?P<next_hop>[^,\s]+),(?P<rest>.*)$")
+# BGP tables: status and path type codes, prefix unless it is the one of the row before, next hop
+BGP_STATUS = r"(?P<status>[*>=sdhrSmbfxacRielIE#%+~ ]{0,8}?)"
+BGP_ROW = re.compile(rf"^{BGP_STATUS}\s*(?:(?P<prefix>{IPV4})(?:/(?P<length>\d+))?\s+)?(?P<next_hop>{IPV4})(?:\s|$)")
+# prefix too long for its column, the next hop is on the next line
+BGP_PREFIX_ONLY_ROW = re.compile(rf"^{BGP_STATUS}\s*(?P<prefix>{IPV4})(?:/(?P<length>\d+))?\s*$")
+# route distinguishers that are not of a local VRF are kept as the VRF of their entries
+BGP_VRF_LINE = re.compile(r"^(?:VRF: (?P<vrf>\S+)|BGP routing table information for VRF (?P<nxos_vrf>[^,\s]+)|"
+                          r"Route Distinguisher: (?P<rd>\S+)(?: \(default for vrf (?P<rd_vrf>[^)\s]+)\))?)")
+
+Route = Tuple[Text, Text, int, Text, Text]
+
+
+def classful_length(prefix: Text) -> int:
+    first_octet = int(prefix.split(".", 1)[0])
+    if first_octet < 128:
+        return 8
+    if first_octet < 192:
+        return 16
+    return 24
+
+
+def classful_network(prefix: Text) -> Text:
+    octets = classful_length(prefix) // 8
+    return ".".join(prefix.split(".")[:octets] + ["0"] * (4 - octets))
+
+
+def parse_ios_routes(lines: Iterable[Text], vrf: Text = DEFAULT_VRF) -> Iterator[Route]:
+    """
+    Routes of IOS style route tables, from IOS, IOS-XR, EOS, ACOS and Gaia, as (vrf, prefix, length, next hop,
+    protocol). Routes with several paths are returned once per path.
+    """
+    subnetted = {}
+    prefix = None
+    length = None
+    protocol = None
+    for line in lines:
+        match = ROUTE_VRF_LINE.match(line)
+        if match is not None:
+            vrf = match.group("vrf")
+            subnetted = {}
+            prefix = None
+            continue
+        match = SUBNETTED_LINE.match(line)
+        if match is not None:
+            subnetted[match.group("prefix")] = int(match.group("length"))
+            continue
+        match = ROUTE_LINE.match(line)
+        if match is not None:
+            prefix = match.group("prefix")
+            length = match.group("length")
+            if length is None:
+                length = subnetted.get(classful_network(prefix), classful_length(prefix))
+            code = match.group("code").strip()
+            protocol = ROUTE_CODE_PROTOCOLS.get(code[0], code.lower())
+            rest = match.group("rest")
+            if "directly connected" in rest:
+                next_hop = rest.rsplit(",", 1)[-1].strip()
+            elif " via " in f" {rest}":
+                next_hop = rest.split("via", 1)[1].split()[0].rstrip(",")
+            else:
+                # the paths are on the lines below, or it is a summary
+                next_hop = rest.rsplit(",", 1)[-1].strip() if "," in rest else ""
+                if next_hop == "":
+                    continue
+            yield vrf, prefix, int(length), next_hop, protocol
+            continue
+        match = ROUTE_CONTINUATION_LINE.match(line)
+        if match is not None and prefix is not None:
+            yield vrf, prefix, int(length), match.group("next_hop").rstrip(","), protocol
+            continue
+        if line.strip() == "":
+            prefix = None
+
+
+def parse_nxos_routes(lines: Iterable[Text], vrf: Text = DEFAULT_VRF) -> Iterator[Route]:
+    """
+    Routes of NX-OS route tables, once per path
+    """
+    prefix = None
+    length = None
+    for line in lines:
+        match = NXOS_PATH_LINE.match(line)
+        if match is not None and prefix is not None:
+            # via next hop, [interface,] [distance/metric], age, protocol[-instance][, route type...]
+            fields = [field.strip() for field in match.group("rest").split(",")]
+            metric_index = next((i for i, field in enumerate(fields) if field.startswith("[")), None)
+            protocol = fields[metric_index + 2].split("-", 1)[0] \
+                if metric_index is not None and len(fields) > metric_index + 2 else ""
+            # next hops in another VRF are printed as address%vrf
+            yield vrf, prefix, length, match.group("next_hop").split("%", 1)[0], protocol
+            continue
+        match = NXOS_PREFIX_LINE.match(line)
+        if match is not None:
+            prefix = match.group("prefix")
+            length = int(match.group("length"))
+            continue
+        match = NXOS_VRF_LINE.match(line)
+        if match is not None:
+            vrf = match.group("vrf")
+            prefix = None
+
+
+def parse_bgp_table(lines: Iterable[Text], vrf: Text = DEFAULT_VRF) -> Iterator[Route]:
+    """
+    Entries of Cisco style BGP tables, from IOS-XR, NX-OS, IOS, EOS and ACOS, once per path
+    """
+    prefix = None
+    length = None
+    for line in lines:
+        match = BGP_ROW.match(line)
+        if match is not None:
+            if match.group("prefix") is not None:
+                prefix = match.group("prefix")
+                length = int(match.group("length")) if match.group("length") is not None \
+                    else classful_length(prefix)
+            if prefix is not None:
+                yield vrf, prefix, length, match.group("next_hop"), "bgp"
+            continue
+        match = BGP_PREFIX_ONLY_ROW.match(line)
+        if match is not None and match.group("status").strip() != "":
+            prefix = match.group("prefix")
+            length = int(match.group("length")) if match.group("length") is not None else classful_length(prefix)
+            continue
+        match = BGP_VRF_LINE.match(line)
+        if match is not None:
+            vrf = match.group("vrf") or match.group("nxos_vrf") or match.group("rd_vrf") or match.group("rd")
+            prefix = None
+
+
+# route and BGP RIB output files per netmiko OS, as patterns of the file names without .txt, and their parsers. The
+# vrf group of a pattern is the VRF of the output.
+OS_RIB_FILES = {
+    "a10": [
+        (r"show_ip_route_all", parse_ios_routes),
+        (r"show_ip_bgp", parse_bgp_table),
+    ],
+    "arista_eos": [
+        (r"show_ip_route", parse_ios_routes),
+    ],
+    "checkpoint_gaia": [
+        (r"show_route_all|show_route_bgp", parse_ios_routes),
+    ],
+    "cisco_ios": [
+        (r"show_ip_route", parse_ios_routes),
+    ],
+    "cisco_nxos": [
+        (r"show_ip_route_vrf_all", parse_nxos_routes),
+        (r"show_bgp_ipv4_unicast|show_bgp_vrf_all_ipv4_unicast", parse_bgp_table),
+        (r"show_ip_bgp_neighbors_[\d.]+_(routes|received-routes|advertised-routes)", parse_bgp_table),
+        (r"show_ip_bgp_vrf_(?P<vrf>.+)_neighbors_[\d.]+_(routes|received-routes|advertised-routes)",
+         parse_bgp_table),
+    ],
+    "cisco_xr": [
+        (r"show_route|show_route_vrf_all", parse_ios_routes),
+        (r"show_bgp_ipv4_unicast|show_bgp_vpnv4_unicast|show_bgp_vrf_all", parse_bgp_table),
+        (r"show_bgp_ipv4_all_neighbors_[\d.]+_(advertised-routes|routes|received_routes)", parse_bgp_table),
+        (r"show_bgp_vrf_(?P<vrf>.+)_ipv4_unicast_neighbors_[\d.]+_(advertised-routes|routes|received_routes)",
+         parse_bgp_table),
+    ],
+}
+
+
+class _Dictionary(object):
+    """
+    Codes of the distinct values of a dictionary encoded column, in order of first appearance
+    """
+
+    def __init__(self):
+        self._codes = {}
+
+    def code(self, value: Text) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._codes)
+        return code
+
+    @property
+    def values(self) -> List[Text]:
+        return list(self._codes.keys())
+
+
+def _code_dtype(size: int):
+    if size <= 1 << 8:
+        return np.uint8
+    if size <= 1 << 16:
+        return np.uint16
+    return np.uint32
+
+
+def get_rib_files(device_os: Text, device_dir: Text) -> List[Tuple[Text, Callable, Optional[Text]]]:
+    """
+    The route and BGP RIB outputs of a device as (file path, parser, VRF from the file name)
+    """
+    patterns = [(re.compile(pattern), parser) for pattern, parser in OS_RIB_FILES.get(device_os, [])]
+    rib_files = []
+    for file_path in sorted(Path(device_dir).glob("*.txt")):
+        for pattern, parser in patterns:
+            match = pattern.fullmatch(file_path.stem)
+            if match is not None:
+                rib_files.append((str(file_path), parser, match.groupdict().get("vrf")))
+                break
+    return rib_files
+
+
+def build_device_routes(device_os: Text, device_dir: Text, store_path: Text) -> int:
+    """
+    Parses the route and BGP RIB outputs of a device and writes them to store_path. Returns the number of routes.
+    """
+    dictionaries = {column: _Dictionary() for column in DICTIONARY_COLUMNS}
+    codes = {column: array("I") for column in DICTIONARY_COLUMNS}
+    prefixes = array("I")
+    lengths = array("B")
+    for file_path, parser, file_vrf in get_rib_files(device_os, device_dir):
+        table_code = dictionaries["table"].code(Path(file_path).stem)
+        with open(file_path, errors="replace") as f:
+            for vrf, prefix, length, next_hop, protocol in parser(f, file_vrf or DEFAULT_VRF):
+                try:
+                    prefixes.append(struct.unpack("!I", socket.inet_aton(prefix))[0])
+                except OSError:
+                    continue
+                lengths.append(length)
+                codes["table"].append(table_code)
+                codes["vrf"].append(dictionaries["vrf"].code(vrf))
+                codes["next_hop"].append(dictionaries["next_hop"].code(next_hop))
+                codes["protocol"].append(dictionaries["protocol"].code(protocol))
+
+    columns = {"prefix": np.frombuffer(prefixes, dtype=np.uint32), "length": np.frombuffer(lengths, dtype=np.uint8)}
+    for column in DICTIONARY_COLUMNS:
+        values = dictionaries[column].values
+        columns[column] = np.frombuffer(codes[column], dtype=np.uint32).astype(_code_dtype(len(values)))
+        # fixed width unicode, so the file loads without pickle
+        columns[f"{column}s"] = np.array(values, dtype=str)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    tmp_path = f"{store_path}.tmp.npz"
+    np.savez_compressed(tmp_path, **columns)
+    os.replace(tmp_path, store_path)
+    return len(prefixes)
+
+
+def get_store_directory(collection_directory: Text, snapshot_name: Text) -> Text:
+    return f"{collection_directory}/routes/{snapshot_name}"
+
+
+def build_route_store(inventory: Dict, collection_directory: Text, snapshot_name: Text,
+                      max_workers: int = None) -> Dict[str, int]:
+    """
+    Builds the route store of the snapshot, devices are parsed in parallel by up to max_workers processes. Returns
+    the number of routes per device.
+    """
+    show_dir = f"{collection_directory}/{snapshot_name}/show"
+    store_dir = get_store_directory(collection_directory, snapshot_name)
+    device_oses = {}
+    for grp_data in inventory.values():
+        device_os = AnsibleOsToNetmikoOs.get(grp_data['vars'].get('ansible_network_os'), None)
+        if device_os not in OS_RIB_FILES:
+            continue
+        for device_name in (grp_data.get('hosts') or {}).keys():
+            if Path(show_dir).joinpath(device_name).is_dir():
+                device_oses[device_name] = device_os
+
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = {device_name: pool.submit(build_device_routes, device_os, f"{show_dir}/{device_name}",
+                                            f"{store_dir}/{device_name}.npz")
+                   for device_name, device_os in device_oses.items()}
+        return {device_name: future.result() for device_name, future in futures.items()}
+
+
+def load_route_table(collection_directory: Text, snapshot_name: Text, devices: List[Text] = None) -> pd.DataFrame:
+    """
+    The routes of the snapshot, of all devices in the store or only of devices, as a DataFrame with the device,
+    table, vrf, prefix, length, next_hop and protocol columns. prefix is the address as an unsigned integer, the
+    text columns are categoricals.
+    """
+    store_dir = Path(get_store_directory(collection_directory, snapshot_name))
+    if devices is None:
+        devices = sorted(path.stem for path in store_dir.glob("*.npz"))
+
+    loaded = []
+    for device_name in devices:
+        with np.load(store_dir.joinpath(f"{device_name}.npz")) as data:
+            loaded.append({name: data[name] for name in data.files})
+
+    # the codes of each device are remapped to dictionaries shared by all devices
+    columns = {"device": pd.Categorical.from_codes(
+        np.repeat(np.arange(len(devices)), [len(device["prefix"]) for device in loaded]), categories=devices)}
+    for column in DICTIONARY_COLUMNS:
+        categories = pd.Index(np.unique(np.concatenate([device[f"{column}s"] for device in loaded]))) \
+            if len(loaded) != 0 else pd.Index([])
+        codes = [categories.get_indexer(device[f"{column}s"])[device[column]] for device in loaded]
+        columns[column] = pd.Categorical.from_codes(np.concatenate(codes) if len(codes) != 0 else [],
+                                                    categories=categories)
+    for column in ["prefix", "length"]:
+        columns[column] = np.concatenate([device[column] for device in loaded]) if len(loaded) != 0 \
+            else np.array([], dtype=np.uint32 if column == "prefix" else np.uint8)
+    return pd.DataFrame({column: columns[column] for column in ["device"] + COLUMNS})
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--inventory", help="Absolute path to inventory file to use", required=True)
+    parser.add_argument("--collection-dir", help="Directory for data collection", required=True)
+    parser.add_argument("--snapshot-name", help="Name of the snapshot to build the route store of", required=True)
+    parser.add_argument("--max-workers", help="Number of parsing processes. Default is one per CPU", type=int,
+                        default=None)
+
+    args = parser.parse_args()
+
+    if not Path(args.inventory).exists():
+        raise Exception(f"{args.inventory} does not exist")
+    if not Path(args.collection_dir).joinpath(args.snapshot_name, "show").exists():
+        raise Exception(f"No show data for snapshot {args.snapshot_name} in {args.collection_dir}")
+
+    start_time = time.time()
+    route_counts = build_route_store(get_inventory(args.inventory), args.collection_dir, args.snapshot_name,
+                                     args.max_workers)
+    store_dir = get_store_directory(args.collection_dir, args.snapshot_name)
+    store_size = sum(path.stat().st_size for path in Path(store_dir).glob("*.npz"))
+    print(f"### Stored {sum(route_counts.values())} routes of {len(route_counts)} devices in {store_dir}, "
+          f"{store_size / 1e6:.1f} MB, in {time.time() - start_time:.0f} seconds")
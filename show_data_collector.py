@@ -1,120 +1,304 @@
+import functools
 import os
+import threading
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 import configargparse
 import logging
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-from collection_helper import (get_inventory, write_output_to_file, custom_logger, RetryingNetConnect,
-                               CollectionStatus, AnsibleOsToNetmikoOs, get_show_commands, parse_genie)
+from collection_helper import (get_inventory, get_device_session, write_output_to_file, custom_logger,
+                               RetryingNetConnect, CollectionStatus, AnsibleOsToNetmikoOs, get_show_commands,
+                               stream_output_to_file, set_object_store, start_genie_parse_pool,
+                               stop_genie_parse_pool, DEFAULT_GENIE_WORKERS, CollectionRetry, LogPayload,
+                               SessionLogPolicy, set_session_log_policy, stop_log_writer, exec_output_to_file,
+                               ExecChannelUnavailable, get_ansible_connection, close_connection)
+from collection_engine import CollectionTask, ConcurrencyController, run_collection, parse_group_limits
+from duration_history import DurationHistory
+from preflight import preflight_tasks
+from instrumentation import set_span_tags, get_span_tags, span_context, start_timing_export, stop_timing_export
+from bgp_neighbors import get_bgp_neighbors, get_structured_bgp_neighbors
+from netconf_transport import NetconfSession
+from httpapi_transport import HttpApiSession
+from command_plan import CommandPlan, PlannedCommand, compile_command_plan, scope_bgp_neighbors
+from snapshot_store import ObjectStore, LINK_MODES
+from progress_journal import ProgressJournal
 
 
-def get_show_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger) -> Dict:
+# command groups whose output is streamed to disk when stream_output is set
+STREAMED_CMD_GROUPS = ["routes_v4", "bgp_v4"]
+
+# set with set_progress_journal to record the commands and devices that complete, for --resume
+_PROGRESS_JOURNAL = None
+
+
+def set_progress_journal(journal: Optional[ProgressJournal]) -> None:
     """
-    Show command collector for all operating systems
+    Record completed commands and devices in journal, and skip the commands it has as completed for a device
     """
-    start_time = time.time()
-    logger.info(f"Trying to connect to {device_name} at {start_time}")
-    status = {
-        "name": device_name,
-        "status": CollectionStatus.FAIL,
-        "failed_commands": [],
-        "message": "",
-    }
+    global _PROGRESS_JOURNAL
+    _PROGRESS_JOURNAL = journal
 
-    partial_collection = False
 
-    # todo: figure out to get logger name from the logger object that is passed in.
-    #  current setup just uses the device name for the logger name, so this works
-    try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
-    except Exception as e:
-        status['message'] = f"Connection failed. Exception {str(e)}"
-        status['failed_commands'].append("All")
-        return status
-
-    logger.info(f"Running show commands for {device_name} at {time.time()}")
+def run_on_exec_channels(net_connect: RetryingNetConnect, device_name: str, output_path: str,
+                         commands: List[PlannedCommand], stream: bool, channels: int,
+                         logger) -> Tuple[List[PlannedCommand], bool]:
+    """
+    Runs the commands on up to channels exec channels of the device at once and saves their outputs.
 
-    for cmd_group in cmd_dict.keys():
-        cmd_timer = 240     # set the general command timeout to 4 minutes
-
-        if cmd_group == "bgp_v4":
-            # todo: if you need per-neighbor RIB collection, write an OS specific function modeled after get_nxos_data
-            # todo: if VRF specific BGP data collection requires vrf name in command, write an OS specific function
-            # the generic show_data function will just grab BGP neighbors, summary, and RIBs for default and
-            # named VRF
-            cmd_timer = 1200  # set BGP command timer to 20 minutes
-            cmd_list = []
-
-            for scope, scope_cmds in cmd_dict['bgp_v4'].items():
-                if scope not in ["global", "vrf"]:
-                    logger.error(f"Unknown {scope} with commands {scope_cmds} under bgp_v4 command dict")
-                    continue
-                for subscope, cmds in scope_cmds.items():
-                    if subscope == "neighbor_ribs":
-                        logger.error(f"BGP neighbor RIB collection not supported on {device_name}")
-                        continue
-                    else:
-                        cmd_list.extend(cmds)
-        # handle global and vrf specific IPv4 route commands
-        elif cmd_group == "routes_v4":
-            cmd_timer = 1200  # set the RIB command timeout to 20 minutes
-            cmd_list = []
-            for scope, cmds in cmd_dict['routes_v4'].items():
-                cmd_list.extend(cmds)
-        else:
-            cmd_list = cmd_dict.get(cmd_group)
+    Returns the commands that failed, to be run on the interactive session, and whether the device allows exec
+    channels at all.
+    """
+    span_tags = get_span_tags()
+    unavailable = threading.Event()
 
-        for cmd in cmd_list:
-            logger.info(f"Running {cmd} on {device_name}")
+    def _run(command: PlannedCommand) -> bool:
+        if unavailable.is_set():
+            return False
+        with span_context(**span_tags):
             try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
+                exec_output_to_file(net_connect, device_name, output_path, command.cmd, command.timeout, stream)
+            except ExecChannelUnavailable as e:
+                if not unavailable.is_set():
+                    logger.warning(f"Exec channels not available, running commands on the interactive session. {e}")
+                unavailable.set()
+                return False
             except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                partial_collection = True
+                logger.error(f"{command.cmd} failed on an exec channel, will retry it on the interactive session. "
+                             f"Exception {str(e)}")
+                return False
+        return True
 
-    end_time = time.time()
-    logger.info(f"Completed operational data collection for {device_name} in {end_time - start_time:.2f} seconds")
-    if len(status['failed_commands']) == 0:
-        status['status'] = CollectionStatus.PASS
-        status['message'] = "Collection successful"
-    elif partial_collection:
-        status['status'] = CollectionStatus.PARTIAL
-        status['message'] = "Collection partially successful"
+    with ThreadPoolExecutor(channels) as pool:
+        succeeded = list(pool.map(_run, commands))
+    return [command for command, ok in zip(commands, succeeded) if not ok], not unavailable.is_set()
 
-    net_connect.close()
-    return status
 
-    end_time = time.time()
-    logger.info(f"Completed operational data collection for {device_name} in {end_time-start_time:.2f} seconds")
-    if len(status['failed_commands']) == 0:
-        status['status'] = CollectionStatus.PASS
-        status['message'] = "Collection successful"
-    elif partial_collection:
-        status['status'] = CollectionStatus.PARTIAL
-        status['message'] = "Collection partially successful"
+class DeviceCommandRunner(object):
+    """
+    Runs planned commands on one device and saves their outputs to files.
 
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
-    return status
+    Results are memoized for the device run: a command that already ran is not sent to the device again, and
+    outputs kept with keep_output, like the BGP neighbor outputs, are returned from memory.
 
+    With an HTTP API session, run_all sends the commands in batched requests instead of one by one.
+
+    With a progress journal, each command that succeeds is recorded in it, and the commands the journal has as
+    completed, by an earlier attempt at the device or an earlier run of the snapshot, are not run again unless
+    their output is needed.
+    """
 
-def get_nxos_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger) -> Dict:
+    def __init__(self, net_connect: RetryingNetConnect, device_name: str, output_path: str, status: Dict, logger,
+                 stream_output: bool = False, channels: int = 1, journal: ProgressJournal = None):
+        self._net_connect = net_connect
+        self._device_name = device_name
+        self._output_path = output_path
+        self._status = status
+        self._logger = logger
+        self._stream_output = stream_output
+        self._channels = channels
+        self._batched = isinstance(net_connect, HttpApiSession)
+        # command -> output if it was kept, True if it only succeeded, False if it failed
+        self._results = {}
+        self._journal = journal
+        # commands saved by an earlier attempt at the device or the run that was resumed
+        self._completed = journal.completed_commands(device_name) if journal is not None else set()
+        if len(self._completed) != 0:
+            logger.info(f"{len(self._completed)} commands completed on {device_name} in an earlier attempt, they "
+                        f"are not run again")
+
+    @property
+    def any_succeeded(self) -> bool:
+        return len(self._completed) != 0 or any(result is not False for result in self._results.values())
+
+    def _done(self, command: PlannedCommand) -> bool:
+        return command.cmd in self._results or command.cmd in self._completed
+
+    @property
+    def structured_output(self) -> bool:
+        """
+        Whether the session returns command outputs as JSON with run_structured
+        """
+        return self._batched
+
+    def _streamed(self, command: PlannedCommand) -> bool:
+        return self._stream_output and command.cmd_group in STREAMED_CMD_GROUPS
+
+    def _failed(self, cmd: str, exc: Exception) -> None:
+        self._status['message'] = f"{cmd} was last command to fail. Exception {str(exc)}"
+        self._status['failed_commands'].append(cmd)
+        self._logger.error(f"{cmd} failed")
+        self._results[cmd] = False
+
+    def _succeeded(self, cmd: str, result) -> None:
+        self._results[cmd] = result
+        if self._journal is not None:
+            self._journal.command_done(self._device_name, cmd)
+
+    def run(self, command: PlannedCommand, keep_output: bool = False):
+        """
+        Runs the command once per device run. Returns its output if keep_output is set, otherwise whether it
+        succeeded.
+        """
+        if command.cmd in self._results:
+            result = self._results[command.cmd]
+            self._logger.info(f"{command.cmd} already ran on {self._device_name}")
+            if keep_output and isinstance(result, bool):
+                # the output was not kept, or the command failed
+                return None
+            return result
+        if command.cmd in self._completed and not keep_output:
+            self._logger.info(f"{command.cmd} completed on {self._device_name} in an earlier attempt")
+            self._results[command.cmd] = True
+            return True
+
+        self._logger.info(f"Running {command.cmd} from {command.cmd_group} on {self._device_name}")
+        try:
+            if self._streamed(command) and not keep_output:
+                # RIB outputs can be hundreds of MB, write them to disk as they are read
+                stream_output_to_file(self._net_connect, self._device_name, self._output_path, command.cmd,
+                                      command.timeout)
+                output = None
+            else:
+                output = self._net_connect.run_command(command.cmd, command.timeout)
+                self._logger.debug("Command output: %s", LogPayload(output))
+                write_output_to_file(self._device_name, self._output_path, command.cmd, output)
+        except CollectionRetry:
+            raise
+        except Exception as e:
+            self._failed(command.cmd, e)
+            return None if keep_output else False
+        self._succeeded(command.cmd, output if keep_output else True)
+        return output if keep_output else True
+
+    def run_batch(self, commands: List[PlannedCommand]) -> None:
+        """
+        Runs the commands that did not run yet in as few requests as the HTTP API session allows. Commands whose
+        output is streamed are left for run.
+        """
+        if not self._batched:
+            return
+        commands = [command for command in commands if not self._done(command) and not self._streamed(command)]
+        if len(commands) == 0:
+            return
+        self._logger.info(f"Running {len(commands)} commands on {self._device_name} in batched requests")
+        try:
+            # the device runs the commands of a request one after the other
+            results = self._net_connect.run_commands([command.cmd for command in commands],
+                                                     sum(command.timeout for command in commands))
+        except CollectionRetry:
+            raise
+        except Exception as e:
+            for command in commands:
+                self._failed(command.cmd, e)
+            return
+        for command, (output, error) in zip(commands, results):
+            if error is not None:
+                self._failed(command.cmd, Exception(error))
+                continue
+            try:
+                write_output_to_file(self._device_name, self._output_path, command.cmd, output)
+            except Exception as e:
+                self._failed(command.cmd, e)
+                continue
+            self._succeeded(command.cmd, True)
+
+    def run_structured(self, command: PlannedCommand) -> Optional[Dict]:
+        """
+        Runs the command with JSON output, which is returned and not saved. Only for HTTP API sessions.
+        """
+        self._logger.info(f"Running {command.cmd} with JSON output on {self._device_name}")
+        return self._net_connect.run_structured_command(command.cmd, command.timeout)
+
+    def run_all(self, commands: List[PlannedCommand]) -> None:
+        """
+        Runs the commands that did not run yet, in batched requests with an HTTP API session, and on exec channels
+        if the runner has more than one channel
+        """
+        self.run_batch(commands)
+        commands = [command for command in commands if not self._done(command)]
+        if self._channels > 1 and len(commands) > 1:
+            stream = self._streamed(commands[0])
+            remaining, exec_available = run_on_exec_channels(self._net_connect, self._device_name,
+                                                             self._output_path, commands, stream, self._channels,
+                                                             self._logger)
+            for command in commands:
+                if command not in remaining:
+                    self._succeeded(command.cmd, True)
+            commands = remaining
+            if not exec_available:
+                self._channels = 1
+        for command in commands:
+            self.run(command)
+
+
+def find_bgp_neighbors(runner: DeviceCommandRunner, plan: CommandPlan, device_name: str,
+                       logger) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Runs the BGP neighbor discovery commands of the plan and returns the {scope: {vrf: [neighbor]}} found
     """
-    Show data collection for Cisco NXOS devices.
+    bgp_neighbors = {}
+    for scope, command, parser_os in plan.discovery:
+        if runner.structured_output:
+            # the text output is saved like for the CLI, the neighbors are taken from the JSON output
+            runner.run(command)
+            logger.info(f"Taking BGP neighbors from the JSON output of {command.cmd} on {device_name}")
+            neighbors = get_structured_bgp_neighbors(device_name, runner.run_structured(command), command.cmd,
+                                                     parser_os, logger)
+        else:
+            output = runner.run(command, keep_output=True)
+            if output is None:
+                continue
+            logger.info(f"Attempting to extract BGP neighbors from {command.cmd} on {device_name}")
+            neighbors = get_bgp_neighbors(device_name, output, command.cmd, parser_os, logger)
+        logger.debug("BGP neighbors: %s", LogPayload(neighbors))
+        for neighbors_scope, scope_neighbors in scope_bgp_neighbors(scope, neighbors).items():
+            bgp_neighbors.setdefault(neighbors_scope, {}).update(scope_neighbors)
+    if len(bgp_neighbors) == 0:
+        logger.info(f"No bgp neighbors found for {device_name}")
+    return bgp_neighbors
+
+
+def run_command_plan(runner: DeviceCommandRunner, command_plan: CommandPlan, status: Dict, device_name: str,
+                     logger) -> None:
+    """
+    Runs the commands of the plan group by group with runner, and records the time each group took in status
+    """
+    # HTTP API sessions run the whole plan, but the per neighbor and streamed commands, in the first requests. The
+    # time they take counts for the first group.
+    plan_start_time = time.time()
+    runner.run_batch([command for _, command, _ in command_plan.discovery]
+                     + [command for commands in command_plan.groups.values() for command in commands])
+
+    for i, cmd_group in enumerate(command_plan.cmd_groups):
+        group_start_time = plan_start_time if i == 0 else time.time()
+        set_span_tags(cmd_group=cmd_group)
+
+        commands = list(command_plan.groups[cmd_group])
+        if command_plan.needs_bgp_neighbors(cmd_group):
+            # the per neighbor RIB commands need the list of BGP neighbors per VRF
+            bgp_neighbors = find_bgp_neighbors(runner, command_plan, device_name, logger)
+            commands.extend(command_plan.expand_neighbor_commands(bgp_neighbors))
+        elif cmd_group == "bgp_v4":
+            for _, command, _ in command_plan.discovery:
+                runner.run(command)
+        runner.run_all(commands)
+
+        status['group_times'][cmd_group] = time.time() - group_start_time
+        set_span_tags(cmd_group=None)
+
+
+def run_show_plan(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+                  net_connect: RetryingNetConnect, stream_output: bool, channels: int,
+                  command_plan: Optional[CommandPlan], device_os: str,
+                  connection_class: Callable = RetryingNetConnect) -> Dict:
+    """
+    Runs the command plan of a device, compiled from cmd_dict if command_plan is not given. If no connection is
+    passed in, one is opened with connection_class.
     """
-    device_os = "nxos"  # used for cisco genie parsers
     start_time = time.time()
     logger.info(f"Trying to connect to {device_name} at {start_time}")
     status = {
@@ -122,300 +306,115 @@ def get_nxos_data(device_session: dict, device_name: str, output_path: str, cmd_
         "status": CollectionStatus.FAIL,
         "failed_commands": [],
         "message": "",
+        "group_times": {},
     }
 
-    partial_collection = False
+    if command_plan is None:
+        command_plan, warnings = compile_command_plan(cmd_dict, device_os)
+        for warning in warnings:
+            logger.error(warning)
 
+    # if a connection is passed in, it is owned (and closed) by the caller
+    own_connection = net_connect is None
     # todo: figure out to get logger name from the logger object that is passed in.
     #  current setup just uses the device name for the logger name, so this works
     try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
+        if own_connection:
+            net_connect = connection_class(device_name, device_session, device_name)
+    except CollectionRetry:
+        raise
     except Exception as e:
         status['message'] = f"Connection failed. Exception {str(e)}"
         status['failed_commands'].append("All")
+        logger.error(f"Connection failed")
         return status
 
     logger.info(f"Running show commands for {device_name} at {time.time()}")
+    runner = DeviceCommandRunner(net_connect, device_name, output_path, status, logger, stream_output, channels,
+                                 _PROGRESS_JOURNAL)
 
-    for cmd_group in cmd_dict.keys():
-        cmd_timer = 240     # set the general command timeout to 4 minutes
-
-        if cmd_group == "bgp_v4":
-            # need to get the list of BGP neighbors per VRF in order to collect per neighbor RIBs
-            # The  mechanism for this is to run the command "show bgp vrf all all summary" and
-            # use Cisco Genie parser to extract the list of { vrf, bgp_neighbor } maps
-            #
-            # rather than rely on this command being in the command list, if there are any commands
-            # under "bgp_v4", we will run this command.
-            #
-            cmd = "show bgp vrf all all summary"
-            cmd_timer = 300     # set BGP neighbor command timeout to 5 minutes
-            bgp_neighbors = {}
-            cmd_list = []
-            logger.info(f"Running {cmd} on {device_name}")
-            try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
-            except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                logger.info(f"Attempting to parse output of {cmd} on {device_name}")
-                parsed_output = parse_genie(device_name, output, cmd, device_os, logger)
-                logger.debug(f"Parsed Command output: {parsed_output}")
-                if parsed_output is not None:
-                    bgp_neighbors = parsed_output
-                partial_collection = True
-
-            cmd_timer = 1200  # set the BGP RIB command timeout to 20 minutes
-
-            for scope, scope_cmds in cmd_dict['bgp_v4'].items():
-                if scope == "global":
-                    for subscope, cmds in scope_cmds.items():
-                        if subscope == "neighbor_ribs":
-                            if len(bgp_neighbors) == 0:
-                                logger.info(f"No bgp neighbors found for {device_name}")
-                                continue
-                            for vrf, vrf_details in bgp_neighbors['vrf'].items():
-                                if vrf == 'default':
-                                    for bgp_neighbor in vrf_details['neighbor'].keys():
-                                        if ":" not in bgp_neighbor:
-                                            for cmd in cmds:
-                                                _cmd = cmd.replace("_neigh_", bgp_neighbor)
-                                                cmd_list.append(_cmd)
-                        else:
-                            cmd_list.extend(cmds)
-                elif scope == "vrf":
-                    for subscope, cmds in scope_cmds.items():
-                        if subscope == "neighbor_ribs":
-                            if len(bgp_neighbors) == 0:
-                                logger.info(f"No bgp neighbors found for {device_name}")
-                                continue
-                            for vrf, vrf_details in bgp_neighbors['vrf'].items():
-                                # ignore default VRF since it is already taken care of
-                                # ignore management VRF - mgmt and management are common names for it
-                                if vrf.lower() not in ['default', 'mgmt', 'management']:
-                                    for bgp_neighbor in vrf_details['neighbor'].keys():
-                                        if ":" not in bgp_neighbor:
-                                            for cmd in cmds:
-                                                _cmd = cmd.replace("_neigh_", bgp_neighbor)
-                                                _cmd = _cmd.replace("_vrf_", vrf)
-                                                cmd_list.append(_cmd)
-                        else:
-                            cmd_list.extend(cmds)
-                else:
-                    logger.error(f"Unknown {scope} with commands {scope_cmds} under bgp_v4 command dict")
-        # handle global and vrf specific IPv4 route commands
-        elif cmd_group == "routes_v4":
-            cmd_timer = 1200  # set the RIB command timeout to 20 minutes
-            cmd_list = []
-            for scope, cmds in cmd_dict['routes_v4'].items():
-                cmd_list.extend(cmds)
-        else:
-            cmd_list = cmd_dict.get(cmd_group)
-
-        for cmd in cmd_list:
-            logger.info(f"Running {cmd} on {device_name}")
-            try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
-            except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                partial_collection = True
+    try:
+        run_command_plan(runner, command_plan, status, device_name, logger)
+    except CollectionRetry:
+        # the device is collected again on a new connection. The commands that completed are in the progress
+        # journal, the next attempt does not run them again.
+        set_span_tags(cmd_group=None)
+        if own_connection:
+            close_connection(net_connect, logger)
+        raise
 
     end_time = time.time()
     logger.info(f"Completed operational data collection for {device_name} in {end_time - start_time:.2f} seconds")
     if len(status['failed_commands']) == 0:
         status['status'] = CollectionStatus.PASS
         status['message'] = "Collection successful"
-    elif partial_collection:
+        if _PROGRESS_JOURNAL is not None:
+            _PROGRESS_JOURNAL.device_done(device_name)
+    elif runner.any_succeeded:
         status['status'] = CollectionStatus.PARTIAL
         status['message'] = "Collection partially successful"
 
-    net_connect.close()
+    if own_connection:
+        close_connection(net_connect, logger)
     return status
 
-    end_time = time.time()
-    logger.info(f"Completed operational data collection for {device_name} in {end_time-start_time:.2f} seconds")
-    if len(status['failed_commands']) == 0:
-        status['status'] = CollectionStatus.PASS
-        status['message'] = "Collection successful"
-    elif partial_collection:
-        status['status'] = CollectionStatus.PARTIAL
-        status['message'] = "Collection partially successful"
 
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
-    return status
+def get_show_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+        net_connect: RetryingNetConnect = None, stream_output: bool = False,
+        command_plan: CommandPlan = None) -> Dict:
+    """
+    Show command collector for all operating systems
+    """
+    return run_show_plan(device_session, device_name, output_path, cmd_dict, logger, net_connect, stream_output,
+                         1, command_plan, device_session['device_type'])
 
 
-def get_xr_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger) -> Dict:
+def get_nxos_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+        net_connect: RetryingNetConnect = None, stream_output: bool = False, channels: int = 1,
+        command_plan: CommandPlan = None) -> Dict:
     """
-    Show data collector for Cisco IOS-XR devices.
+    Show data collection for Cisco NXOS devices, with per neighbor BGP RIBs for the neighbors in
+    "show bgp vrf all all summary".
+
+    If channels is more than 1, the commands of each group run on up to that many exec channels at once.
     """
-    device_os = "iosxr"  # used for cisco genie parsers
-    start_time = time.time()
-    logger.info(f"Trying to connect to {device_name} at {start_time}")
-    status = {
-        "name": device_name,
-        "status": CollectionStatus.FAIL,
-        "failed_commands": [],
-        "message": "",
-    }
+    return run_show_plan(device_session, device_name, output_path, cmd_dict, logger, net_connect, stream_output,
+                         channels, command_plan, "cisco_nxos")
 
-    partial_collection = False
 
-    # todo: figure out to get logger name from the logger object that is passed in.
-    #  current setup just uses the device name for the logger name, so this works
-    try:
-        net_connect = RetryingNetConnect(device_name, device_session, device_name)
-    except Exception as e:
-        status['message'] = f"Connection failed. Exception {str(e)}"
-        status['failed_commands'].append("All")
-        logger.error(f"Connection failed")
-        return status
+def get_xr_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+        net_connect: RetryingNetConnect = None, stream_output: bool = False, channels: int = 1,
+        command_plan: CommandPlan = None) -> Dict:
+    """
+    Show data collector for Cisco IOS-XR devices, with per neighbor BGP RIBs for the neighbors in
+    "show bgp all all neighbors" and "show bgp vrf all neighbors".
 
-    logger.info(f"Running show commands for {device_name} at {time.time()}")
+    If channels is more than 1, the commands of each group run on up to that many exec channels at once.
+    """
+    return run_show_plan(device_session, device_name, output_path, cmd_dict, logger, net_connect, stream_output,
+                         channels, command_plan, "cisco_xr")
 
-    for cmd_group in cmd_dict.keys():
-        cmd_timer = 240     # set the general command timeout to 4 minutes
-
-        if cmd_group == "bgp_v4":
-            # need to get the list of BGP neighbors per VRF in order to collect per neighbor RIBs
-            # need to run a command for default VRF "show bgp all all neighbors" and one for non-default
-            # VRFs "show bgp vrf all neighbors" and then parse the output using Cisco genie parser
-            #
-            # rather than rely on these commands being in the command list, if there are any commands
-            # under "bgp_v4", we will run this command.
-            #
-            # get BGP neighbors for default VRF
-            cmd_timer = 300     # set BGP neighbor command timeout to 5 minutes
-            global_bgp_neighbors = {}
-            vrf_bgp_neighbors = {}
-            cmd_list = []
-
-            # get BGP neighbors for default VRF
-            cmd = "show bgp all all neighbors"
-            logger.info(f"Running {cmd} on {device_name}")
-            try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
-            except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                logger.info(f"Attempting to parse output of {cmd} on {device_name}")
-                parsed_output = parse_genie(device_name, output, cmd, device_os, logger)
-                logger.debug(f"Parsed Command output: {parsed_output}")
-                if parsed_output is not None:
-                    global_bgp_neighbors = parsed_output
-                partial_collection = True
-
-            # get BGP neighbors for non-default VRFs
-            cmd = "show bgp vrf all neighbors"
-            logger.info(f"Running {cmd} on {device_name}")
-            try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
-            except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                logger.info(f"Attempting to parse output of {cmd} on {device_name}")
-                parsed_output = parse_genie(device_name, output, cmd, device_os, logger)
-                logger.debug(f"Parsed Command output: {parsed_output}")
-                if parsed_output is not None:
-                    vrf_bgp_neighbors = parsed_output
-                partial_collection = True
-
-            cmd_timer = 1200  # set the BGP RIB command timeout to 20 minutes
-
-            for scope, scope_cmds in cmd_dict['bgp_v4'].items():
-                if scope == "global":
-                    for subscope, cmds in scope_cmds.items():
-                        if subscope == "neighbor_ribs":
-                            if len(global_bgp_neighbors) == 0:
-                                logger.info(f"No bgp neighbors found for default VRF on {device_name}")
-                                continue
-                            for vrf, vrf_details in global_bgp_neighbors['instance']['all']['vrf'].items():
-                                for bgp_neighbor in vrf_details['neighbor'].keys():
-                                    if ":" not in bgp_neighbor:  # skip ipv6 peers
-                                        for cmd in cmds:
-                                            _cmd = cmd.replace("_neigh_", bgp_neighbor)
-                                            cmd_list.append(_cmd)
-                        else:
-                            cmd_list.extend(cmds)
-                elif scope == "vrf":
-                    for subscope, cmds in scope_cmds.items():
-                        if subscope == "neighbor_ribs":
-                            if len(vrf_bgp_neighbors) == 0:
-                                logger.info(f"No bgp neighbors found for non default VRFs on {device_name}")
-                                continue
-                            for vrf, vrf_details in vrf_bgp_neighbors['instance']['all']['vrf'].items():
-                                # ignore default VRF since it is already taken care of
-                                # ignore management VRF - mgmt and management are common names for it
-                                if vrf.lower() in ["mgmt", "management", "default"]:
-                                    continue
-                                for bgp_neighbor in vrf_details['neighbor'].keys():
-                                    if ":" not in bgp_neighbor:  # skip ipv6 peers
-                                        for cmd in cmds:
-                                            _cmd = cmd.replace("_neigh_", bgp_neighbor)
-                                            _cmd = _cmd.replace("_vrf_", vrf)
-                                            cmd_list.append(_cmd)
-                        else:
-                            cmd_list.extend(cmds)
-                else:
-                    logger.error(f"Unknown {scope} with commands {scope_cmds} under bgp_v4 command dict")
-        # handle global and vrf specific IPv4 route commands
-        elif cmd_group == "routes_v4":
-            cmd_timer = 1200  # set the RIB command timeout to 20 minutes
-            cmd_list = []
-            for scope, cmds in cmd_dict['routes_v4'].items():
-                cmd_list.extend(cmds)
-        else:
-            cmd_list = cmd_dict.get(cmd_group)
 
-        for cmd in cmd_list:
-            logger.info(f"Running {cmd} from {cmd_group} on {device_name}")
-            try:
-                output = net_connect.run_command(cmd, cmd_timer)
-                logger.debug(f"Command output: {output}")
-            except Exception as e:
-                status['message'] = f"{cmd} was last command to fail. Exception {str(e)}"
-                status['failed_commands'].append(cmd)
-                logger.error(f"{cmd} failed")
-            else:
-                write_output_to_file(device_name, output_path, cmd, output)
-                partial_collection = True
+def get_netconf_show_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+        net_connect: NetconfSession = None, stream_output: bool = False,
+        command_plan: CommandPlan = None) -> Dict:
+    """
+    Show data collector for Juniper devices with ansible_connection netconf, each show command is run with the
+    <command> RPC
+    """
+    return run_show_plan(device_session, device_name, output_path, cmd_dict, logger, net_connect, stream_output,
+                         1, command_plan, device_session['device_type'], NetconfSession)
 
-    end_time = time.time()
-    logger.info(f"Completed operational data collection for {device_name} in {end_time - start_time:.2f} seconds")
-    if len(status['failed_commands']) == 0:
-        status['status'] = CollectionStatus.PASS
-        status['message'] = "Collection successful"
-    elif partial_collection:
-        status['status'] = CollectionStatus.PARTIAL
-        status['message'] = "Collection partially successful"
 
-    try:
-        net_connect.close()
-    except Exception as e:
-        logger.exception(f"Exception when closing netmiko connection: {str(e)}")
-        pass
-    return status
+def get_httpapi_show_data(device_session: dict, device_name: str, output_path: str, cmd_dict: dict, logger,
+        net_connect: HttpApiSession = None, stream_output: bool = False,
+        command_plan: CommandPlan = None) -> Dict:
+    """
+    Show data collector for Arista and NX-OS devices with ansible_connection httpapi, the commands are sent to eAPI
+    or NX-API in batched requests and BGP neighbors are taken from JSON outputs
+    """
+    return run_show_plan(device_session, device_name, output_path, cmd_dict, logger, net_connect, stream_output,
+                         1, command_plan, device_session['device_type'], HttpApiSession)
 
 
 OS_SHOW_COLLECTOR_FUNCTION = {
@@ -428,17 +427,54 @@ OS_SHOW_COLLECTOR_FUNCTION = {
     "cisco_xr": get_xr_data,
     "juniper_junos": get_show_data
 }
+# collector functions for devices whose ansible_connection is not an SSH CLI session
+CONNECTION_SHOW_COLLECTOR_FUNCTION = {
+    "netconf": {
+        "juniper_junos": get_netconf_show_data,
+    },
+    "httpapi": {
+        "arista_eos": get_httpapi_show_data,
+        "cisco_nxos": get_httpapi_show_data,
+    },
+}
+# collector functions that can run commands on several exec channels of a device
+MULTI_CHANNEL_COLLECTOR_FUNCTIONS = [get_nxos_data, get_xr_data]
+
+
+def get_show_collector_function(device_os: str, connection: str, channels_per_device: int = 1):
+    """
+    The show data collector function for devices running device_os with ansible_connection connection
+    """
+    op_func = CONNECTION_SHOW_COLLECTOR_FUNCTION.get(connection, OS_SHOW_COLLECTOR_FUNCTION).get(device_os)
+    if op_func in MULTI_CHANNEL_COLLECTOR_FUNCTIONS and channels_per_device > 1:
+        op_func = functools.partial(op_func, channels=channels_per_device)
+    return op_func
 
 
 def main(inventory: Dict, max_threads: int, username: str, password: str, snapshot_name: str,
-         collection_directory: str, commands_file: str, log_level: int) -> None:
-    pool = ThreadPoolExecutor(max_threads)
-    future_list = []
-    task_info_list = []
+         collection_directory: str, commands_file: str, log_level: int, stream_output: bool = False,
+         object_store: bool = False, genie_workers: int = DEFAULT_GENIE_WORKERS, adaptive: bool = False,
+         login_rate: float = 0, group_limits: Dict = None, preflight: bool = False, timing_export: str = None,
+         session_log_policy: str = SessionLogPolicy.FULL.value, channels_per_device: int = 1,
+         resume: bool = False, object_store_link_mode: str = "hardlink") -> None:
+    task_list = []
+    task_cmd_groups = {}
 
     start_time = time.time()
     print(f"### Starting operational data collection: {time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(start_time))}")
 
+    if object_store:
+        set_object_store(ObjectStore(f"{collection_directory}/objects", snapshot_name, object_store_link_mode))
+    start_genie_parse_pool(genie_workers)
+    if timing_export is not None:
+        start_timing_export(timing_export, snapshot_name, "show")
+    set_session_log_policy(SessionLogPolicy(session_log_policy))
+    journal = ProgressJournal(collection_directory, snapshot_name, "show", resume)
+    set_progress_journal(journal)
+    completed_devices = journal.completed_devices
+    if resume:
+        print(f"### Resuming collection of {snapshot_name}, {len(completed_devices)} devices already collected")
+
     commands = None
     if commands_file is not None:
         commands = get_show_commands(commands_file)
@@ -451,8 +487,7 @@ def main(inventory: Dict, max_threads: int, username: str, password: str, snapsh
             print(f"Unsupported Ansible OS {grp_data['vars'].get('ansible_network_os')}, skipping...")
             continue
 
-        op_func = OS_SHOW_COLLECTOR_FUNCTION.get(device_os)
-        if op_func is None:
+        if OS_SHOW_COLLECTOR_FUNCTION.get(device_os) is None:
             print(f"No collection function for {device_os}, skipping...")
             continue
 
@@ -460,8 +495,13 @@ def main(inventory: Dict, max_threads: int, username: str, password: str, snapsh
         if cmd_dict is None:
             print(f"No command dictionary for devices in {grp}, skipping...")
             continue
+        command_plan, warnings = compile_command_plan(cmd_dict, device_os)
+        for warning in warnings:
+            print(f"{grp}: {warning}")
 
         for device_name, device_vars in grp_data.get('hosts').items():
+            if device_name in completed_devices:
+                continue
             log_file = f"{collection_directory}/logs/{snapshot_name}/{device_name}/show_data_collector.log"
             os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
@@ -469,48 +509,56 @@ def main(inventory: Dict, max_threads: int, username: str, password: str, snapsh
             logger.info(f"Starting collection for {device_name}")
             logger.info(f"Device vars are {device_vars}")
 
-            # by default use the device name specified in inventory
-            _host = device_name
-            # override it with the IP address if specified in the inventory
-            if device_vars is not None and device_vars.get("ansible_host", None) is not None:
-                _host = device_vars.get("ansible_host")
-                logger.info(f"Using IP {_host} to connect to {device_name}")
-
             # create device_session for netmiko connection handler
-            device_session = {
-                "device_type": device_os,
-                "host": _host,
-                "username": username,
-                "password": password,
-                "session_log": f"{collection_directory}/logs/{snapshot_name}/{device_name}/netmiko_session.log",
-                "fast_cli": False
-            }
+            connection = get_ansible_connection(grp_data['vars'], device_vars)
+            session_log = f"{collection_directory}/logs/{snapshot_name}/{device_name}/netmiko_session.log"
+            device_session = get_device_session(device_os, device_name, device_vars, username, password,
+                                                session_log, logger, connection, grp_data['vars'])
+
+            op_func = get_show_collector_function(device_os, connection, channels_per_device)
+            if op_func is None:
+                logger.error(f"No collection function for {device_name} running {device_os} over {connection}")
+                continue
 
             output_path = f"{collection_directory}/{snapshot_name}/show/"
-            # before sending the task save some information about each task, so you can get insight
-            # into which devices are taking too long to complete
-            task_info_list.append((device_name, op_func, device_session['device_type'], device_session['host']))
-
-            future = pool.submit(op_func, device_session=device_session, device_name=device_name,
-                                 output_path=output_path, cmd_dict=cmd_dict, logger=logger)
-            future_list.append(future)
-
-    while True:
-        time.sleep(10)
-        running_tasks = []
-        for f, task_info in zip(future_list, task_info_list):
-            if not f.done():
-                running_tasks.append(task_info)
-        if len(running_tasks) == 0:
-            break  # all tasks finished
-        elif len(running_tasks) < 10:
-            # now there's only less than 10 tasks running, some might be stuck, log things about the running task
-            for task_info in running_tasks:
-                print(f"{task_info}")
-
-    # and then the rest is the same, except you don't need as_completed
-    failed_devices = [future.result()['name'] for future in future_list if
-                      future.result()['status'] != CollectionStatus.PASS]
+            # save some information about each task, so you can get insight into which devices are taking
+            # too long to complete
+            task_info = (device_name, op_func, device_session['device_type'], device_session['host'])
+            task_list.append(CollectionTask(device_name, op_func,
+                                            dict(device_session=device_session, device_name=device_name,
+                                                 output_path=output_path, cmd_dict=cmd_dict, logger=logger,
+                                                 stream_output=stream_output, command_plan=command_plan),
+                                            info=task_info, group=grp))
+            task_cmd_groups[device_name] = cmd_dict.keys()
+
+    unreachable_results = []
+    if preflight:
+        task_list, unreachable_results = preflight_tasks(task_list)
+
+    # start the devices that took longest in previous runs first
+    history = DurationHistory(collection_directory, "show")
+    task_list = history.order_tasks(task_list, task_cmd_groups)
+    predicted = history.predict_makespan(task_list, max_threads)
+    print(f"### Predicted collection time: {predicted:.0f} seconds for {len(task_list)} devices")
+
+    controller = ConcurrencyController(max_threads, adaptive, login_rate, group_limits)
+    # every 10 seconds, print the tasks that are still running once there are fewer than 10 of them left
+    try:
+        results = run_collection(task_list, max_threads, progress_interval=10, controller=controller)
+    finally:
+        stop_genie_parse_pool()
+        stop_timing_export()
+        stop_log_writer()
+        set_progress_journal(None)
+        journal.close()
+
+    # a resumed run only has the durations of what was left to collect
+    if not resume:
+        history.record(task_list, results)
+        history.save()
+    results = results + unreachable_results
+
+    failed_devices = [result['name'] for result in results if result['status'] != CollectionStatus.PASS]
 
 
     # # TODO: revisit exception handling
@@ -531,13 +579,46 @@ if __name__ == "__main__":
     parser.add_argument("--inventory", help="Absolute path to inventory file to use", required=True)
     parser.add_argument("--username", help="Username to access devices", required=True, env_var="BF_COLLECTOR_USER")
     parser.add_argument("--password", help="Password to access devices", required=True, env_var="BF_COLLECTOR_PASSWORD")
-    parser.add_argument("--max-threads", help="Max threads for parallel collection. Default = 10, Maximum is 100",
+    parser.add_argument("--max-threads", help="Max devices collected in parallel. Default = 10",
                         type=int, default=10)
     parser.add_argument("--collection-dir", help="Directory for data collection", required=True)
     parser.add_argument("--snapshot-name", help="Name for the snapshot directory",
                         default=datetime.now().strftime("%Y%m%d_%H:%M:%S"))
     parser.add_argument("--command-file", help="YAML file with list of commands per OS", default=None)
     parser.add_argument("--log-level", help="Log level", default="warn")
+    parser.add_argument("--stream-output", help="Stream route and BGP RIB outputs to disk instead of buffering "
+                                                "them in memory", action="store_true", default=False)
+    parser.add_argument("--genie-workers", help="Number of processes for genie parsing, 0 parses on the collection "
+                                                f"threads. Default = {DEFAULT_GENIE_WORKERS}", type=int,
+                        default=DEFAULT_GENIE_WORKERS)
+    parser.add_argument("--adaptive", help="Adjust the number of concurrent sessions, up to --max-threads, to how "
+                                           "logins are going", action="store_true", default=False)
+    parser.add_argument("--login-rate", help="Max SSH logins per second. Default = 0, no limit", type=float,
+                        default=0)
+    parser.add_argument("--group-limit", help="Max concurrent sessions for an inventory group, as group:limit. Can "
+                                              "be repeated", action="append", default=[])
+    parser.add_argument("--preflight", help="Check that devices accept TCP connections on their SSH port before "
+                                            "collection, and skip the ones that do not", action="store_true",
+                        default=False)
+    parser.add_argument("--timing-export", help="Directory to write per device and per command timing spans "
+                                                "(JSON lines) and a Prometheus textfile summary to", default=None)
+    parser.add_argument("--session-log", help="Netmiko session logs: full, truncated to the first MB, compressed "
+                                              "or off. Default = full", choices=[policy.value for policy in
+                                                                                 SessionLogPolicy],
+                        default=SessionLogPolicy.FULL.value)
+    parser.add_argument("--channels-per-device", help="Run the show commands of IOS-XR and NX-OS devices on up to "
+                                                      "this many SSH exec channels per device at once. Default = 1, "
+                                                      "only the interactive session", type=int, default=1)
+    parser.add_argument("--object-store", help="Deduplicate collected files across snapshots through the object "
+                                               "store in the collection directory", action="store_true",
+                        default=False)
+    parser.add_argument("--object-store-link-mode", help="How snapshot files are linked to the object store: "
+                                                         "hardlinks, or reflinks (copy on write) on filesystems "
+                                                         "that support them. Default = hardlink",
+                        choices=LINK_MODES, default="hardlink")
+    parser.add_argument("--resume", help="Name of an interrupted snapshot to finish. Only the devices and commands "
+                                         "that did not complete are collected, into the existing snapshot directory",
+                        default=None)
 
     args = parser.parse_args()
 
@@ -553,5 +634,14 @@ if __name__ == "__main__":
     if not Path(args.collection_dir).exists():
         raise Exception(f"{args.collection_dir} does not exist. Please create the directory and re-run the script")
 
-    main(inventory, args.max_threads, args.username, args.password, args.snapshot_name, args.collection_dir,
-         args.command_file, log_level)
+    snapshot_name = args.snapshot_name
+    if args.resume is not None:
+        if not Path(args.collection_dir).joinpath(args.resume).exists():
+            raise Exception(f"Snapshot {args.resume} not found in {args.collection_dir}")
+        snapshot_name = args.resume
+
+    main(inventory, args.max_threads, args.username, args.password, snapshot_name, args.collection_dir,
+         args.command_file, log_level, args.stream_output, args.object_store,
+         args.genie_workers, args.adaptive, args.login_rate, parse_group_limits(args.group_limit),
+         args.preflight, args.timing_export, args.session_log, args.channels_per_device, args.resume is not None,
+         args.object_store_link_mode)
@@ -0,0 +1,313 @@
+import os
+import functools
+import time
+from typing import Dict, Callable
+
+import configargparse
+import logging
+from pathlib import Path
+from datetime import datetime
+
+import netmiko.exceptions
+
+from collection_helper import (get_inventory, get_device_session, custom_logger, RetryingNetConnect,
+                               CollectionStatus, CollectionFailureReason, AnsibleOsToNetmikoOs, get_show_commands,
+                               set_object_store, start_genie_parse_pool, stop_genie_parse_pool, DEFAULT_GENIE_WORKERS,
+                               CollectionRetry, SessionLogPolicy, set_session_log_policy, stop_log_writer,
+                               get_ansible_connection, close_connection)
+from collection_engine import CollectionTask, ConcurrencyController, run_collection, parse_group_limits
+from duration_history import DurationHistory
+from preflight import preflight_tasks
+from instrumentation import start_timing_export, stop_timing_export
+from snapshot_store import ObjectStore, LINK_MODES
+from config_collector import OS_COLLECTOR_FUNCTION, OS_CONFIG_COMMAND, get_config_a10, get_collector_function
+from show_data_collector import OS_SHOW_COLLECTOR_FUNCTION, get_show_collector_function, set_progress_journal
+from command_plan import CommandPlan, compile_command_plan
+from netconf_transport import NetconfSession
+from httpapi_transport import HttpApiSession
+from progress_journal import ProgressJournal
+
+# session classes for devices whose ansible_connection is not an SSH CLI session
+CONNECTION_CLASS = {
+    "netconf": NetconfSession,
+    "httpapi": HttpApiSession,
+}
+
+
+def get_device_data(device_session: dict, device_name: str, cfg_func: Callable, device_command: str,
+                    config_output_path: str, show_func: Callable, show_output_path: str, cmd_dict: dict,
+                    logger, stream_output: bool = False, command_plan: CommandPlan = None,
+                    connection_class: Callable = RetryingNetConnect) -> Dict:
+    """
+    Collects configuration and show data from a device over a single session, opened with connection_class.
+    """
+    logger.info(f"Trying to connect to {device_name}")
+    status = {
+        "name": device_name,
+        "status": CollectionStatus.FAIL,
+        "reason": CollectionFailureReason.OTHER,
+        "failed_commands": [],
+        "message": "",
+    }
+    # todo: figure out to get logger name from the logger object that is passed in.
+    #  current setup just uses the device name for the logger name, so this works
+    try:
+        net_connect = connection_class(device_name, device_session, device_name)
+    except netmiko.exceptions.NetmikoTimeoutException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.CONNECT_TIMEOUT
+        status['failed_commands'].append("All")
+        return status
+    except netmiko.exceptions.NetmikoAuthenticationException as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.AUTH
+        status['failed_commands'].append("All")
+        return status
+    except netmiko.exceptions.ReadTimeout as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['reason'] = CollectionFailureReason.READ_TIMEOUT
+        status['failed_commands'].append("All")
+        return status
+    except CollectionRetry:
+        raise
+    except Exception as e:
+        status['message'] = f"Connection failed. Exception {e}"
+        status['failed_commands'].append("All")
+        return status
+
+    # closed in any case, the device is collected again on a new connection if CollectionRetry is raised
+    try:
+        cfg_status = cfg_func(device_session=device_session, device_name=device_name, device_command=device_command,
+                              output_path=config_output_path, logger=logger, net_connect=net_connect)
+
+        show_status = None
+        if show_func is not None and cmd_dict is not None:
+            show_status = show_func(device_session=device_session, device_name=device_name,
+                                    output_path=show_output_path, cmd_dict=cmd_dict, logger=logger,
+                                    net_connect=net_connect, stream_output=stream_output,
+                                    command_plan=command_plan)
+    finally:
+        close_connection(net_connect, logger)
+
+    # the device passes only if both phases passed, and is partial if either phase got some data
+    status['reason'] = cfg_status['reason']
+    status['message'] = f"Configuration: {cfg_status['message']}"
+    if show_status is None:
+        status['status'] = cfg_status['status']
+        return status
+
+    status['failed_commands'] = show_status['failed_commands']
+    status['group_times'] = show_status['group_times']
+    status['message'] += f", Show data: {show_status['message']}"
+    if cfg_status['status'] == CollectionStatus.PASS and show_status['status'] == CollectionStatus.PASS:
+        status['status'] = CollectionStatus.PASS
+    elif cfg_status['status'] == CollectionStatus.FAIL and show_status['status'] == CollectionStatus.FAIL:
+        status['status'] = CollectionStatus.FAIL
+    else:
+        status['status'] = CollectionStatus.PARTIAL
+    return status
+
+
+def main(inventory: Dict, max_threads: int, username: str, password: str, snapshot_name: str,
+         collection_directory: str, commands_file: str, log_level: int, stream_output: bool = False,
+         object_store: bool = False, genie_workers: int = DEFAULT_GENIE_WORKERS, a10_partition_sessions: int = 0,
+         adaptive: bool = False, login_rate: float = 0, group_limits: Dict = None, preflight: bool = False,
+         timing_export: str = None, session_log_policy: str = SessionLogPolicy.FULL.value,
+         channels_per_device: int = 1, file_transfer: bool = False, object_store_link_mode: str = "hardlink") -> None:
+    task_list = []
+
+    start_time = time.time()
+    print(f"### Starting snapshot collection: {time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(start_time))}")
+
+    if object_store:
+        set_object_store(ObjectStore(f"{collection_directory}/objects", snapshot_name, object_store_link_mode))
+    start_genie_parse_pool(genie_workers)
+    if timing_export is not None:
+        start_timing_export(timing_export, snapshot_name, "snapshot")
+    set_session_log_policy(SessionLogPolicy(session_log_policy))
+    # show commands that complete are journaled, so a device collected again after a deferred retry skips them
+    journal = ProgressJournal(collection_directory, snapshot_name, "snapshot")
+    set_progress_journal(journal)
+
+    commands = {}
+    if commands_file is not None:
+        commands = get_show_commands(commands_file)
+
+    for grp, grp_data in inventory.items():
+        device_os = AnsibleOsToNetmikoOs.get(grp_data['vars'].get('ansible_network_os'), None)
+        if device_os is None:
+            # todo: setup global logger to log this message to, for now print will get it into the bash script logs
+            print(f"Unsupported Ansible OS {grp_data['vars'].get('ansible_network_os')}, skipping...")
+            continue
+
+        cfg_cmd = OS_CONFIG_COMMAND.get(device_os)
+        if OS_COLLECTOR_FUNCTION.get(device_os) is None or cfg_cmd is None:
+            print(f"No configuration collection function or command for {device_os}, skipping...")
+            continue
+
+        # show data is optional, devices without a show collector or command dictionary only get configs
+        cmd_dict = commands.get(grp, None)
+        if commands_file is not None and (OS_SHOW_COLLECTOR_FUNCTION.get(device_os) is None or cmd_dict is None):
+            print(f"No show data collection for devices in {grp}, collecting configuration only")
+        command_plan = None
+        if OS_SHOW_COLLECTOR_FUNCTION.get(device_os) is not None and cmd_dict is not None:
+            command_plan, warnings = compile_command_plan(cmd_dict, device_os)
+            for warning in warnings:
+                print(f"{grp}: {warning}")
+
+        for device_name, device_vars in grp_data.get('hosts').items():
+            log_file = f"{collection_directory}/logs/{snapshot_name}/{device_name}/snapshot_collector.log"
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+            logger = custom_logger(device_name, log_file, log_level)
+            logger.info(f"Starting collection for {device_name}")
+            logger.info(f"Device vars are {device_vars}")
+
+            # create device_session for netmiko connection handler
+            connection = get_ansible_connection(grp_data['vars'], device_vars)
+            session_log = f"{collection_directory}/logs/{snapshot_name}/{device_name}/netmiko_session.log"
+            device_session = get_device_session(device_os, device_name, device_vars, username, password,
+                                                session_log, logger, connection, grp_data['vars'])
+
+            cfg_func = get_collector_function(device_os, connection, file_transfer)
+            if cfg_func is get_config_a10 and a10_partition_sessions > 0:
+                cfg_func = functools.partial(get_config_a10, partition_sessions=a10_partition_sessions)
+            if cfg_func is None:
+                logger.error(f"No collection function for {device_name} running {device_os} over {connection}")
+                continue
+            show_func = get_show_collector_function(device_os, connection, channels_per_device)
+
+            task_info = (device_name, cfg_func, show_func, device_session['device_type'], device_session['host'])
+            task_list.append(CollectionTask(device_name, get_device_data,
+                                            dict(device_session=device_session, device_name=device_name,
+                                                 cfg_func=cfg_func, device_command=cfg_cmd,
+                                                 config_output_path=f"{collection_directory}/{snapshot_name}/configs/",
+                                                 show_func=show_func,
+                                                 show_output_path=f"{collection_directory}/{snapshot_name}/show/",
+                                                 cmd_dict=cmd_dict, logger=logger, stream_output=stream_output,
+                                                 command_plan=command_plan,
+                                                 connection_class=CONNECTION_CLASS.get(connection,
+                                                                                       RetryingNetConnect)),
+                                            info=task_info, group=grp))
+
+    unreachable_results = []
+    if preflight:
+        task_list, unreachable_results = preflight_tasks(task_list)
+
+    # start the devices that took longest in previous runs first
+    history = DurationHistory(collection_directory, "snapshot")
+    task_list = history.order_tasks(task_list)
+    predicted = history.predict_makespan(task_list, max_threads)
+    print(f"### Predicted collection time: {predicted:.0f} seconds for {len(task_list)} devices")
+
+    controller = ConcurrencyController(max_threads, adaptive, login_rate, group_limits)
+    try:
+        results = run_collection(task_list, max_threads, progress_interval=10, controller=controller)
+    finally:
+        set_progress_journal(None)
+        journal.close()
+        stop_genie_parse_pool()
+        stop_timing_export()
+        stop_log_writer()
+
+    history.record(task_list, results)
+    history.save()
+    results = results + unreachable_results
+
+    failed_devices = {
+        CollectionFailureReason.NO_FAILURE: [],
+        CollectionFailureReason.AUTH: [],
+        CollectionFailureReason.READ_TIMEOUT: [],
+        CollectionFailureReason.CONNECT_TIMEOUT: [],
+        CollectionFailureReason.OTHER: []
+    }
+    partial_devices = []
+    any_failures = False
+
+    for result in results:
+        if result['status'] == CollectionStatus.FAIL:
+            any_failures = True
+            failed_devices[result['reason']].append(result['name'])
+        elif result['status'] == CollectionStatus.PARTIAL:
+            partial_devices.append(result['name'])
+
+    end_time = time.time()
+
+    if any_failures:
+        print(f"### Collection failed for devices: \n {failed_devices}")
+    if len(partial_devices) != 0:
+        print(f"### Collection partially successful for {len(partial_devices)} devices: {partial_devices}")
+
+    print(f"### Completed snapshot collection: {time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(end_time))}")
+    print(f"### Total snapshot collection time: {end_time - start_time} seconds")
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--inventory", help="Absolute path to inventory file to use", required=True)
+    parser.add_argument("--username", help="Username to access devices", required=True, env_var="BF_COLLECTOR_USER")
+    parser.add_argument("--password", help="Password to access devices", required=True, env_var="BF_COLLECTOR_PASSWORD")
+    parser.add_argument("--max-threads", help="Max devices collected in parallel. Default = 10",
+                        type=int, default=10)
+    parser.add_argument("--collection-dir", help="Directory for data collection", required=True)
+    parser.add_argument("--snapshot-name", help="Name for the snapshot directory",
+                        default=datetime.now().strftime("%Y%m%d_%H:%M:%S"))
+    parser.add_argument("--command-file", help="YAML file with list of commands per OS. If not set, only "
+                                               "configuration is collected", default=None)
+    parser.add_argument("--log-level", help="Log level", default="warn")
+    parser.add_argument("--stream-output", help="Stream route and BGP RIB outputs to disk instead of buffering "
+                                                "them in memory", action="store_true", default=False)
+    parser.add_argument("--genie-workers", help="Number of processes for genie parsing, 0 parses on the collection "
+                                                f"threads. Default = {DEFAULT_GENIE_WORKERS}", type=int,
+                        default=DEFAULT_GENIE_WORKERS)
+    parser.add_argument("--a10-partition-sessions", help="Collect A10 partitions concurrently over this many "
+                                                         "sessions per device. Default = 0, one command for all "
+                                                         "partitions", type=int, default=0)
+    parser.add_argument("--adaptive", help="Adjust the number of concurrent sessions, up to --max-threads, to how "
+                                           "logins are going", action="store_true", default=False)
+    parser.add_argument("--login-rate", help="Max SSH logins per second. Default = 0, no limit", type=float,
+                        default=0)
+    parser.add_argument("--group-limit", help="Max concurrent sessions for an inventory group, as group:limit. Can "
+                                              "be repeated", action="append", default=[])
+    parser.add_argument("--preflight", help="Check that devices accept TCP connections on their SSH port before "
+                                            "collection, and skip the ones that do not", action="store_true",
+                        default=False)
+    parser.add_argument("--timing-export", help="Directory to write per device and per command timing spans "
+                                                "(JSON lines) and a Prometheus textfile summary to", default=None)
+    parser.add_argument("--session-log", help="Netmiko session logs: full, truncated to the first MB, compressed "
+                                              "or off. Default = full", choices=[policy.value for policy in
+                                                                                 SessionLogPolicy],
+                        default=SessionLogPolicy.FULL.value)
+    parser.add_argument("--channels-per-device", help="Run the show commands of IOS-XR and NX-OS devices on up to "
+                                                      "this many SSH exec channels per device at once. Default = 1, "
+                                                      "only the interactive session", type=int, default=1)
+    parser.add_argument("--object-store", help="Deduplicate collected files across snapshots through the object "
+                                               "store in the collection directory", action="store_true",
+                        default=False)
+    parser.add_argument("--object-store-link-mode", help="How snapshot files are linked to the object store: "
+                                                         "hardlinks, or reflinks (copy on write) on filesystems "
+                                                         "that support them. Default = hardlink",
+                        choices=LINK_MODES, default="hardlink")
+    parser.add_argument("--file-transfer", help="Fetch Cumulus and IOS configurations as files over SFTP or SCP "
+                                                "instead of the CLI", action="store_true", default=False)
+
+    args = parser.parse_args()
+
+    log_level = logging._nameToLevel.get(args.log_level.upper())
+    if not log_level:
+        raise Exception("Invalid log level: {}".format(args.log_level))
+
+    # check if inventory file exists
+    if not Path(args.inventory).exists():
+        raise Exception(f"{args.inventory} does not exist")
+    inventory = get_inventory(args.inventory)
+
+    if not Path(args.collection_dir).exists():
+        raise Exception(f"{args.collection_dir} does not exist. Please create the directory and re-run the script")
+
+    main(inventory, args.max_threads, args.username, args.password, args.snapshot_name, args.collection_dir,
+         args.command_file, log_level, args.stream_output, args.object_store,
+         args.genie_workers, args.a10_partition_sessions, args.adaptive, args.login_rate,
+         parse_group_limits(args.group_limit), args.preflight,
+         args.timing_export, args.session_log, args.channels_per_device, args.file_transfer,
+         args.object_store_link_mode)
@@ -37,30 +37,94 @@ fi
 SNAPSHOT_NAME=`date +"%Y%m%d_%H:%M:%S"`
 SNAPSHOT_DIR=${COLLECTION_DIR}/${SNAPSHOT_NAME}
 
-echo "Collecting configuration from devices"
-python ${SCRIPT_DIR}/config_collector.py \
-    --inventory ${INVENTORY} \
-    --collection-dir ${COLLECTION_DIR} \
-    --snapshot-name ${SNAPSHOT_NAME} \
-    --max-threads 60
+# COLLECTION_MODE=unified collects configuration and show data over a single login per device,
+# the default is to run the configuration and show data collectors one after the other
+COLLECTION_MODE=${COLLECTION_MODE:="separate"}
+# UPLOAD_MODE=pipelined uploads the configurations while the show data is collected and attaches the show data
+# afterwards as the snapshot ${SNAPSHOT_NAME}_show, the default is to upload the whole snapshot at the end
+UPLOAD_MODE=${UPLOAD_MODE:="whole"}
+# ROUTE_STORE=true parses the route and BGP RIB outputs into the columnar route store in routes/${SNAPSHOT_NAME}
+ROUTE_STORE=${ROUTE_STORE:="false"}
+BF_NETWORK=${BF_NETWORK:="MY_NETWORK"}
 
-#echo "Removing timestamps that lead to spurious config differences"
-#grep -rle '^!Running configuration last done at: ' ${SNAPSHOT_DIR} | xargs sed -i -E 's/^(!Running configuration last done at: ).*$/\1REMOVED/g'
-#grep -rle '^!Time: ' ${SNAPSHOT_DIR} | xargs sed -i 's/^!Time: .*$/!Time: REMOVED/g'
-#grep -rle '^# Exported by' ${SNAPSHOT_DIR} | xargs sed -i -E 's/^(# Exported by [^ ]+ on ).*$/\1REMOVED/g'
+if [[ ${COLLECTION_MODE} == "unified" && ${UPLOAD_MODE} == "pipelined" ]]; then
+    echo "UPLOAD_MODE=pipelined needs the configurations collected before the show data, it can not be used with COLLECTION_MODE=unified"
+    exit 1
+fi
 
+# if a later step fails, let the configuration upload finish instead of leaving it running in the background
+wait_for_config_upload() {
+    if [[ -n ${CONFIG_UPLOAD_PID+x} ]]; then
+        wait ${CONFIG_UPLOAD_PID} 2>/dev/null || true
+    fi
+}
+trap wait_for_config_upload EXIT
 
-echo "Collecting show commands from devices"
-python ${SCRIPT_DIR}/show_data_collector.py \
-    --inventory ${INVENTORY} \
-    --collection-dir ${COLLECTION_DIR} \
-    --snapshot-name ${SNAPSHOT_NAME} \
-    --command-file ${SCRIPT_DIR}/show_commands.yml \
-    --max-threads 60
+if [[ ${COLLECTION_MODE} == "unified" ]]; then
+    echo "Collecting configuration and show commands from devices"
+    python ${SCRIPT_DIR}/snapshot_collector.py \
+        --inventory ${INVENTORY} \
+        --collection-dir ${COLLECTION_DIR} \
+        --snapshot-name ${SNAPSHOT_NAME} \
+        --command-file ${SCRIPT_DIR}/show_commands.yml \
+        --stream-output \
+        --preflight \
+        --max-threads 60
+else
+    echo "Collecting configuration from devices"
+    python ${SCRIPT_DIR}/config_collector.py \
+        --inventory ${INVENTORY} \
+        --collection-dir ${COLLECTION_DIR} \
+        --snapshot-name ${SNAPSHOT_NAME} \
+        --preflight \
+        --max-threads 60
 
+    #echo "Removing timestamps that lead to spurious config differences"
+    #grep -rle '^!Running configuration last done at: ' ${SNAPSHOT_DIR} | xargs sed -i -E 's/^(!Running configuration last done at: ).*$/\1REMOVED/g'
+    #grep -rle '^!Time: ' ${SNAPSHOT_DIR} | xargs sed -i 's/^!Time: .*$/!Time: REMOVED/g'
+    #grep -rle '^# Exported by' ${SNAPSHOT_DIR} | xargs sed -i -E 's/^(# Exported by [^ ]+ on ).*$/\1REMOVED/g'
 
-BF_NETWORK=${BF_NETWORK:="MY_NETWORK"}
-echo "Uploading snapshot ${SNAPSHOT_NAME} to network ${BF_NETWORK}"
-python ${SCRIPT_DIR}/bfe_upload_snapshot.py \
-    --snapshot ${SNAPSHOT_DIR} \
-    --settings ${BF_SETTINGS}
+    if [[ ${UPLOAD_MODE} == "pipelined" ]]; then
+        echo "Uploading configurations of snapshot ${SNAPSHOT_NAME} to network ${BF_NETWORK}"
+        python ${SCRIPT_DIR}/bfe_upload_snapshot.py \
+            --snapshot ${SNAPSHOT_DIR} \
+            --settings ${BF_SETTINGS} \
+            --package-cache ${COLLECTION_DIR}/package_cache \
+            --part configs &
+        CONFIG_UPLOAD_PID=$!
+    fi
+
+    echo "Collecting show commands from devices"
+    python ${SCRIPT_DIR}/show_data_collector.py \
+        --inventory ${INVENTORY} \
+        --collection-dir ${COLLECTION_DIR} \
+        --snapshot-name ${SNAPSHOT_NAME} \
+        --command-file ${SCRIPT_DIR}/show_commands.yml \
+        --stream-output \
+        --preflight \
+        --max-threads 60
+fi
+
+if [[ ${ROUTE_STORE} == "true" ]]; then
+    echo "Building route store of snapshot ${SNAPSHOT_NAME}"
+    python ${SCRIPT_DIR}/route_store.py \
+        --inventory ${INVENTORY} \
+        --collection-dir ${COLLECTION_DIR} \
+        --snapshot-name ${SNAPSHOT_NAME}
+fi
+
+if [[ -n ${CONFIG_UPLOAD_PID+x} ]]; then
+    wait ${CONFIG_UPLOAD_PID}
+    echo "Attaching show data to snapshot ${SNAPSHOT_NAME} in network ${BF_NETWORK}"
+    python ${SCRIPT_DIR}/bfe_upload_snapshot.py \
+        --snapshot ${SNAPSHOT_DIR} \
+        --settings ${BF_SETTINGS} \
+        --package-cache ${COLLECTION_DIR}/package_cache \
+        --part show
+else
+    echo "Uploading snapshot ${SNAPSHOT_NAME} to network ${BF_NETWORK}"
+    python ${SCRIPT_DIR}/bfe_upload_snapshot.py \
+        --snapshot ${SNAPSHOT_DIR} \
+        --settings ${BF_SETTINGS} \
+        --package-cache ${COLLECTION_DIR}/package_cache
+fi
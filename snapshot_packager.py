@@ -0,0 +1,320 @@
+"""
+Builds the zip archive of a snapshot for upload.
+
+Each file is compressed by its own worker and the archive is written to a file, so the upload can stream it from
+disk instead of from an in-memory zip of the whole snapshot. With a cache directory, compressed files are kept
+by content between snapshots, and files that did not change since an earlier snapshot are not compressed again.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Text, Tuple
+
+import configargparse
+
+COMPRESS_LEVEL = 6
+READ_CHUNK_SIZE = 1024 * 1024
+# compressed files up to this size stay in memory until they are written to the archive, bigger ones spill to disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# files compressed ahead of the one being written to the archive, per worker
+PREFETCH_PER_WORKER = 2
+# cached files not used by any packaging for this long are removed
+CACHE_RETENTION_DAYS = 7
+# crc32 and uncompressed size at the start of a cached file, followed by the raw deflate data
+CACHE_HEADER = struct.Struct("<IQ")
+
+# zip format, see the PKWARE APPNOTE
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+ZIP64_END_OF_CENTRAL_DIR = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_DEFLATED = 8
+ZIP_UTF8_FLAG = 0x800
+ZIP_MADE_BY_UNIX = 3
+
+
+class PackageStats(object):
+    """
+    What a packaging run did, for the upload log
+    """
+
+    def __init__(self, files: int, size: int, archive_size: int, cached_files: int, seconds: float):
+        self.files = files
+        self.size = size
+        self.archive_size = archive_size
+        self.cached_files = cached_files
+        self.seconds = seconds
+
+    @property
+    def throughput(self) -> float:
+        # MB of snapshot files packaged per second
+        return self.size / 1e6 / max(self.seconds, 1e-3)
+
+    def __str__(self):
+        return (f"{self.files} files, {self.size / 1e6:.1f} MB, into a {self.archive_size / 1e6:.1f} MB archive in "
+                f"{self.seconds:.1f} seconds ({self.throughput:.1f} MB/s, {self.cached_files} files from cache)")
+
+
+class _CompressedFile(object):
+    """
+    A snapshot file compressed by a worker, waiting to be written to the archive
+    """
+
+    def __init__(self, crc: int, size: int, compressed_size: int, data: BinaryIO, cached: bool):
+        self.crc = crc
+        self.size = size
+        self.compressed_size = compressed_size
+        # positioned at the start of the compressed data
+        self.data = data
+        self.cached = cached
+
+
+class CompressedFileCache(object):
+    """
+    Compressed files named after the sha256 of their uncompressed content.
+
+    Snapshot files that did not change are usually hardlinks to the same object store blob, but they are looked up
+    by content, so unchanged files written again by a collection are found too.
+    """
+
+    def __init__(self, root: Text):
+        self._root = root
+        os.makedirs(f"{root}/tmp", exist_ok=True)
+
+    def _entry_path(self, digest: Text) -> Text:
+        return f"{self._root}/{digest[:2]}/{digest[2:]}"
+
+    def open(self, digest: Text) -> Optional[_CompressedFile]:
+        entry_path = self._entry_path(digest)
+        try:
+            f = open(entry_path, "rb")
+        except FileNotFoundError:
+            return None
+        # the modification time is when the entry was last used, see prune
+        os.utime(entry_path)
+        crc, size = CACHE_HEADER.unpack(f.read(CACHE_HEADER.size))
+        return _CompressedFile(crc, size, os.fstat(f.fileno()).st_size - CACHE_HEADER.size, f, cached=True)
+
+    def add(self, digest: Text, file_path: Text) -> _CompressedFile:
+        tmp_path = f"{self._root}/tmp/{uuid.uuid4().hex}"
+        with open(tmp_path, "wb") as f:
+            f.write(CACHE_HEADER.pack(0, 0))
+            crc, size, compressed_size = _deflate(file_path, f)
+            f.seek(0)
+            f.write(CACHE_HEADER.pack(crc, size))
+        entry_path = self._entry_path(digest)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        os.replace(tmp_path, entry_path)
+        f = open(entry_path, "rb")
+        f.seek(CACHE_HEADER.size)
+        return _CompressedFile(crc, size, compressed_size, f, cached=False)
+
+    def prune(self, retention_days: float = CACHE_RETENTION_DAYS) -> int:
+        """
+        Removes the entries not used in the last retention_days days, and returns how many were removed
+        """
+        oldest = time.time() - retention_days * 24 * 3600
+        removed = 0
+        for entry_dir in Path(self._root).iterdir():
+            if not entry_dir.is_dir() or entry_dir.name == "tmp":
+                continue
+            for entry in entry_dir.iterdir():
+                if entry.stat().st_mtime < oldest:
+                    entry.unlink()
+                    removed += 1
+        # leftovers from interrupted runs
+        for tmp_file in Path(self._root).joinpath("tmp").iterdir():
+            if tmp_file.stat().st_mtime < oldest:
+                tmp_file.unlink()
+        return removed
+
+
+def _deflate(file_path: Text, out: BinaryIO) -> Tuple[int, int, int]:
+    """
+    Writes the raw deflate stream of the file to out. Returns the crc32, size and compressed size.
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    compressed_size = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            compressed = compressor.compress(chunk)
+            compressed_size += len(compressed)
+            out.write(compressed)
+    compressed = compressor.flush()
+    compressed_size += len(compressed)
+    out.write(compressed)
+    return crc, size, compressed_size
+
+
+def _file_digest(file_path: Text) -> Text:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _compress_file(file_path: Text, cache: Optional[CompressedFileCache]) -> _CompressedFile:
+    if cache is not None:
+        digest = _file_digest(file_path)
+        cached = cache.open(digest)
+        if cached is not None:
+            return cached
+        return cache.add(digest, file_path)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    crc, size, compressed_size = _deflate(file_path, spool)
+    spool.seek(0)
+    return _CompressedFile(crc, size, compressed_size, spool, cached=False)
+
+
+def _dos_date_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class _ZipWriter(object):
+    """
+    Writes members that are already deflate compressed to a zip file, with zip64 records where the sizes or offsets
+    need them
+    """
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._central_dir = []
+
+    def add(self, name: Text, member: _CompressedFile, mtime: float, mode: int) -> None:
+        encoded_name = name.encode("utf-8")
+        dos_time, dos_date = _dos_date_time(mtime)
+        offset = self._f.tell()
+
+        zip64 = member.size >= ZIP64_LIMIT or member.compressed_size >= ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 1, 16, member.size, member.compressed_size) if zip64 else b""
+        version = ZIP64_VERSION if zip64 else ZIP_VERSION
+        self._f.write(LOCAL_HEADER.pack(0x04034b50, version, ZIP_UTF8_FLAG, ZIP_DEFLATED, dos_time, dos_date,
+                                        member.crc, ZIP64_LIMIT if zip64 else member.compressed_size,
+                                        ZIP64_LIMIT if zip64 else member.size, len(encoded_name), len(extra)))
+        self._f.write(encoded_name)
+        self._f.write(extra)
+        shutil.copyfileobj(member.data, self._f, READ_CHUNK_SIZE)
+
+        # the central directory zip64 field only has the values that do not fit, in this order
+        zip64_values = [value for value in [member.size, member.compressed_size, offset] if value >= ZIP64_LIMIT]
+        central_extra = struct.pack(f"<HH{len(zip64_values)}Q", 1, 8 * len(zip64_values), *zip64_values) \
+            if len(zip64_values) != 0 else b""
+        version = ZIP64_VERSION if len(zip64_values) != 0 else ZIP_VERSION
+        self._central_dir.append(CENTRAL_HEADER.pack(
+            0x02014b50, (ZIP_MADE_BY_UNIX << 8) | version, version, ZIP_UTF8_FLAG, ZIP_DEFLATED, dos_time, dos_date,
+            member.crc, min(member.compressed_size, ZIP64_LIMIT), min(member.size, ZIP64_LIMIT),
+            len(encoded_name), len(central_extra), 0, 0, 0, (mode & 0xFFFF) << 16, min(offset, ZIP64_LIMIT)) +
+            encoded_name + central_extra)
+
+    def close(self) -> None:
+        central_dir_offset = self._f.tell()
+        for entry in self._central_dir:
+            self._f.write(entry)
+        central_dir_size = self._f.tell() - central_dir_offset
+        count = len(self._central_dir)
+
+        if count >= ZIP64_COUNT_LIMIT or central_dir_offset >= ZIP64_LIMIT or central_dir_size >= ZIP64_LIMIT:
+            zip64_end_offset = self._f.tell()
+            self._f.write(ZIP64_END_OF_CENTRAL_DIR.pack(0x06064b50, ZIP64_END_OF_CENTRAL_DIR.size - 12,
+                                                        ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count,
+                                                        central_dir_size, central_dir_offset))
+            self._f.write(ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+        self._f.write(END_OF_CENTRAL_DIR.pack(0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT),
+                                              min(count, ZIP64_COUNT_LIMIT), min(central_dir_size, ZIP64_LIMIT),
+                                              min(central_dir_offset, ZIP64_LIMIT), 0))
+
+
+def get_snapshot_files(snapshot_dir: Text) -> List[Path]:
+    """
+    Returns the files of the snapshot, in a stable order so unchanged snapshots give identical archives
+    """
+    files = []
+    for root, dirs, file_names in os.walk(snapshot_dir):
+        dirs.sort()
+        files.extend(Path(root).joinpath(file_name) for file_name in sorted(file_names))
+    return files
+
+
+def package_snapshot(snapshot_dir: Text, archive_path: Text, workers: int = None,
+                     cache_dir: Text = None) -> PackageStats:
+    """
+    Writes the zip archive of the snapshot to archive_path, with the files under a folder named after the snapshot
+    folder as Batfish expects.
+
+    Files are compressed by up to workers threads, default is one per CPU, and written to the archive in order as
+    they are ready. With cache_dir, compressed files are kept there and reused for files with the same content.
+    """
+    start_time = time.time()
+    workers = workers or os.cpu_count() or 1
+    cache = CompressedFileCache(cache_dir) if cache_dir is not None else None
+    snapshot_path = Path(snapshot_dir)
+    files = get_snapshot_files(snapshot_dir)
+
+    size = 0
+    cached_files = 0
+    with open(archive_path, "wb") as f, ThreadPoolExecutor(workers) as pool:
+        writer = _ZipWriter(f)
+        # a bounded window of files compressed ahead, so the compressed files do not pile up while one is written
+        pending = deque()
+        next_file = 0
+        while next_file < len(files) or len(pending) != 0:
+            while next_file < len(files) and len(pending) < workers * PREFETCH_PER_WORKER:
+                pending.append((files[next_file], pool.submit(_compress_file, str(files[next_file]), cache)))
+                next_file += 1
+            file_path, future = pending.popleft()
+            member = future.result()
+            try:
+                stat = file_path.stat()
+                arcname = Path(snapshot_path.name).joinpath(file_path.relative_to(snapshot_path)).as_posix()
+                writer.add(arcname, member, stat.st_mtime, stat.st_mode)
+            finally:
+                member.data.close()
+            size += member.size
+            cached_files += member.cached
+        writer.close()
+        archive_size = f.tell()
+
+    if cache is not None:
+        cache.prune()
+    return PackageStats(len(files), size, archive_size, cached_files, time.time() - start_time)
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--snapshot", help="Absolute path to snapshot directory", required=True)
+    parser.add_argument("--output", help="Path of the zip file to write", required=True)
+    parser.add_argument("--workers", help="Number of compression threads. Default is one per CPU",
+                        type=int, default=None)
+    parser.add_argument("--cache-dir", help="Directory to keep compressed files in between snapshots. "
+                                            "Default is no cache", default=None)
+
+    args = parser.parse_args()
+
+    if not Path(args.snapshot).is_dir():
+        raise Exception(f"{args.snapshot} is not a directory")
+
+    stats = package_snapshot(args.snapshot, args.output, args.workers, args.cache_dir)
+    print(f"### Packaged {stats}")
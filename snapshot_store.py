@@ -0,0 +1,271 @@
+import os
+import hashlib
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Text, Tuple
+
+import configargparse
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# FICLONE ioctl from linux/fs.h, used to reflink a blob into a snapshot on filesystems that support it
+FICLONE = 0x40049409
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+LINK_MODES = ["hardlink", "reflink"]
+# lock file in the store, collectors hold it shared and garbage collection exclusive
+LOCK_FILE = "lock"
+# temporary files and unreferenced blobs modified more recently than this are left alone by garbage collection, in
+# case a collection is writing them on a system without file locks
+DEFAULT_GC_GRACE_PERIOD = 24 * 60 * 60
+
+# directories in the collection directory that are not snapshots
+NON_SNAPSHOT_DIRS = ["history", "logs", "manifests", "objects", "package_cache", "routes"]
+
+
+class ObjectStore(object):
+    """
+    Content addressed store for collected files.
+
+    Every file is stored once as a blob named after the sha256 of its content, and snapshot files are hardlinks
+    (or reflinks) to the blobs. Blobs are made read-only, so a file in one snapshot can not be changed in place
+    underneath the other snapshots that share it.
+
+    The store lock is held shared until the process exits, so garbage collection can not run while files are added.
+    """
+
+    def __init__(self, root: Text, snapshot_name: Text, link_mode: Text = "hardlink"):
+        if link_mode not in LINK_MODES:
+            raise Exception(f"Unknown link mode {link_mode}")
+        self._root = root
+        self._snapshot_name = snapshot_name
+        self._link_mode = link_mode
+        self._lock = threading.Lock()
+        os.makedirs(f"{root}/tmp", exist_ok=True)
+        os.makedirs(f"{root}/refs", exist_ok=True)
+        self._store_lock = open(f"{root}/{LOCK_FILE}", "a")
+        if fcntl is not None:
+            fcntl.flock(self._store_lock.fileno(), fcntl.LOCK_SH)
+
+    def _blob_path(self, digest: Text) -> Text:
+        return f"{self._root}/{digest[:2]}/{digest[2:]}"
+
+    def _tmp_path(self) -> Text:
+        return f"{self._root}/tmp/{uuid.uuid4().hex}"
+
+    def _add_ref(self, digest: Text) -> None:
+        # records which blobs a snapshot uses, this is what garbage collection keeps
+        with self._lock:
+            with open(f"{self._root}/refs/{self._snapshot_name}", "a") as f:
+                f.write(f"{digest}\n")
+
+    def _reuse_blob(self, blob_path: Text, digest: Text) -> None:
+        # the blob may only be used by pruned snapshots, restart its garbage collection grace period
+        os.utime(blob_path)
+        self._add_ref(digest)
+
+    def _add_blob(self, tmp_path: Text, digest: Text) -> Text:
+        """
+        Moves tmp_path into the store as the blob for digest, unless the blob already exists
+        """
+        blob_path = self._blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+            self._reuse_blob(blob_path, digest)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob_path)
+            self._add_ref(digest)
+        return blob_path
+
+    def _link(self, blob_path: Text, file_path: Text) -> None:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        if self._link_mode == "hardlink":
+            os.link(blob_path, file_path)
+            return
+
+        # reflink gives the snapshot its own, writable, copy on write file
+        with open(blob_path, "rb") as src, open(file_path, "wb") as dst:
+            try:
+                if fcntl is None:
+                    raise ImportError("fcntl is not available")
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (ImportError, OSError):
+                shutil.copyfileobj(src, dst)
+
+    def write(self, file_path: Text, data: bytes) -> None:
+        """
+        Materializes data at file_path, only writing it to disk if the store does not have it yet
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            tmp_path = self._tmp_path()
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            blob_path = self._add_blob(tmp_path, digest)
+        else:
+            self._reuse_blob(blob_path, digest)
+        self._link(blob_path, file_path)
+
+    def ingest(self, file_path: Text) -> None:
+        """
+        Moves an already written file into the store and replaces it with a link to its blob
+        """
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        tmp_path = self._tmp_path()
+        os.replace(file_path, tmp_path)
+        self._link(self._add_blob(tmp_path, sha.hexdigest()), file_path)
+
+    def copy(self, src_path: Text, file_path: Text) -> None:
+        """
+        Materializes the content of src_path, a file of another snapshot, at file_path. The content is only copied
+        if the store does not have it yet.
+        """
+        sha = hashlib.sha256()
+        with open(src_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            # a copy, the blob is made read-only and src_path may not be a link to the store
+            tmp_path = self._tmp_path()
+            shutil.copyfile(src_path, tmp_path)
+            blob_path = self._add_blob(tmp_path, digest)
+        else:
+            self._reuse_blob(blob_path, digest)
+        self._link(blob_path, file_path)
+
+
+@contextmanager
+def exclusive_store_lock(collection_directory: Text):
+    """
+    Holds the object store lock exclusively. Raises if a collection is using the store.
+    """
+    store_root = Path(f"{collection_directory}/objects")
+    if fcntl is None or not store_root.exists():
+        yield
+        return
+
+    with open(store_root.joinpath(LOCK_FILE), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Exception(f"A collection is using the object store in {collection_directory}, run this again "
+                            f"after it finishes")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_snapshots(collection_directory: Text) -> list:
+    """
+    Returns the snapshot names in the collection directory, oldest first
+    """
+    snapshots = [p for p in Path(collection_directory).iterdir()
+                 if p.is_dir() and p.name not in NON_SNAPSHOT_DIRS and
+                 (p.joinpath("configs").exists() or p.joinpath("show").exists())]
+    # names are free form with --snapshot-name, but a snapshot directory is only modified when it is created and its
+    # configs and show directories are added, so its mtime is the collection time
+    return [p.name for p in sorted(snapshots, key=lambda p: (p.stat().st_mtime, p.name))]
+
+
+def prune_snapshots(collection_directory: Text, retain: int) -> list:
+    """
+    Deletes all but the most recent retain snapshots, along with their logs, manifests, route stores and blob
+    references
+    """
+    snapshots = get_snapshots(collection_directory)
+    removed = snapshots[:max(len(snapshots) - retain, 0)]
+    for snapshot in removed:
+        shutil.rmtree(f"{collection_directory}/{snapshot}")
+        shutil.rmtree(f"{collection_directory}/logs/{snapshot}", ignore_errors=True)
+        shutil.rmtree(f"{collection_directory}/routes/{snapshot}", ignore_errors=True)
+        for path in [f"{collection_directory}/manifests/{snapshot}.json",
+                     f"{collection_directory}/objects/refs/{snapshot}"]:
+            if os.path.exists(path):
+                os.remove(path)
+    return removed
+
+
+def collect_garbage(collection_directory: Text, grace_period: int = DEFAULT_GC_GRACE_PERIOD) -> Tuple[int, int]:
+    """
+    Deletes blobs that are not referenced by any remaining snapshot and temporary files of interrupted writes, if
+    they were last modified more than grace_period seconds ago. Call it under exclusive_store_lock.
+
+    Returns the number of blobs and bytes removed.
+    """
+    store_root = Path(f"{collection_directory}/objects")
+    if not store_root.exists():
+        return 0, 0
+
+    snapshots = set(get_snapshots(collection_directory))
+    referenced = set()
+    for ref_file in store_root.joinpath("refs").iterdir():
+        if ref_file.name not in snapshots:
+            # snapshot directory was deleted by hand
+            ref_file.unlink()
+            continue
+        with open(ref_file) as f:
+            referenced.update(line.strip() for line in f)
+
+    cutoff = time.time() - grace_period
+    removed_blobs = 0
+    removed_bytes = 0
+    for blob_dir in store_root.iterdir():
+        if blob_dir.name in ["refs", "tmp"] or not blob_dir.is_dir():
+            continue
+        for blob in blob_dir.iterdir():
+            stat = blob.stat()
+            # a blob that is still hardlinked from a snapshot is in use even if the reference was lost
+            if f"{blob_dir.name}{blob.name}" in referenced or stat.st_nlink > 1 or stat.st_mtime > cutoff:
+                continue
+            blob.unlink()
+            removed_blobs += 1
+            removed_bytes += stat.st_size
+
+    # leftovers from interrupted writes
+    for tmp_file in store_root.joinpath("tmp").iterdir():
+        if tmp_file.stat().st_mtime <= cutoff:
+            tmp_file.unlink()
+
+    return removed_blobs, removed_bytes
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgParser()
+    parser.add_argument("--collection-dir", help="Directory for data collection", required=True)
+    parser.add_argument("--retain", help="Number of most recent snapshots to keep. Default is to keep all",
+                        type=int, default=None)
+    parser.add_argument("--grace-period", help="Keep unreferenced objects and temporary files modified less than "
+                                               f"this many seconds ago. Default = {DEFAULT_GC_GRACE_PERIOD}",
+                        type=int, default=DEFAULT_GC_GRACE_PERIOD)
+
+    args = parser.parse_args()
+
+    if not Path(args.collection_dir).exists():
+        raise Exception(f"{args.collection_dir} does not exist")
+
+    with exclusive_store_lock(args.collection_dir):
+        if args.retain is not None:
+            removed_snapshots = prune_snapshots(args.collection_dir, args.retain)
+            print(f"Removed {len(removed_snapshots)} snapshots: {removed_snapshots}")
+
+        blobs, size = collect_garbage(args.collection_dir, args.grace_period)
+        print(f"Removed {blobs} unreferenced objects, {size} bytes")